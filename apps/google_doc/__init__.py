@@ -0,0 +1 @@
+default_app_config = 'apps.google_doc.apps.GoogleDocConfig'
@@ -1,5 +1,47 @@
+import os
+import sys
+
 from django.apps import AppConfig
 
 
+# 加载本应用处理请求的服务程序，sys.argv[0](python -m启动时为其所在的包)的名称
+SERVER_PROGRAMS = ('gunicorn', 'uwsgi', 'uvicorn', 'daphne', 'hypercorn', 'mod_wsgi')
+
+
+def is_server_process():
+    """
+    是否为处理请求的进程：SERVER_PROGRAMS中的服务程序，或manage.py runserver(自动重载时为实际运行的子进程)；
+    migrate、test、shell、celery、pytest等其他进程不启动后台任务
+    """
+    argv0 = sys.argv[0] if sys.argv else ''
+    program = os.path.basename(argv0)
+    if program == '__main__.py':
+        program = os.path.basename(os.path.dirname(argv0))
+    if program in SERVER_PROGRAMS:
+        return True
+    if program not in ('manage.py', 'django-admin') or len(sys.argv) < 2 or sys.argv[1] != 'runserver':
+        return False
+    return os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv
+
+
 class GoogleDocConfig(AppConfig):
-    name = 'google_doc'
+    name = 'apps.google_doc'
+    label = 'google_doc'
+
+    def ready(self):
+        from apps.google_doc.changes import sync_invalidations
+        from common.authentication import connect_signals
+        from common.operator_pool import add_prepare_hook
+        from maze_google_doc import settings
+
+        connect_signals()
+        add_prepare_hook(sync_invalidations)
+        # 后台任务只注册信号，不在加载应用时访问数据库或启动线程(gunicorn --preload时加载应用的是fork前的master)
+        if settings.FOLDER_INDEX_WARM_ON_STARTUP and is_server_process():
+            from apps.google_doc.folder_index import warm_up_on_first_request
+
+            warm_up_on_first_request()
+        if settings.JOB_WORKER_MODE == 'in_process' and is_server_process():
+            from apps.google_doc.jobs import start_workers_on_first_request
+
+            start_workers_on_first_request()
@@ -0,0 +1,185 @@
+import math
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.db import close_old_connections
+from django.http import HttpResponse
+from rest_framework.renderers import JSONRenderer
+
+from apps.google_doc import documents
+from apps.google_doc.models import Document
+from apps.google_doc.views import CopyDocView, NewDocView
+from common.async_operator import get_async_operator
+from common.logger import logger, payload
+from common.rate_limit import RateLimitedError
+from common.utils import CheckParamMixin, ResponseCode, ValidationException
+
+# ASGI下使用的urlconf，new_doc、copy_doc指向本模块的async view，其余与ROOT_URLCONF相同
+ASGI_URLCONF = 'maze_google_doc.asgi_urls'
+
+
+def run_db(fn):
+    """
+    在线程池中执行访问数据库的同步函数；与django处理请求时一样，前后关闭过期的数据库连接
+
+    :param fn: 同步函数
+    :return: 协程函数
+    """
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(wrapper, thread_sensitive=False)
+
+
+def json_response(data, status=200, headers=None):
+    """
+    与DRF JSONRenderer相同格式的json响应，不需要django在线程中渲染
+    """
+    response = HttpResponse(JSONRenderer().render(data), status=status, content_type='application/json')
+    for key, value in (headers or {}).items():
+        response[key] = value
+    return response
+
+
+def rate_limited_response(e):
+    logger.warning(f'rate limited: {e}')
+    retry_after = max(1, math.ceil(e.retry_after or 1))
+    return json_response({'code': ResponseCode.RATE_LIMITED.value, 'message': settings.RATE_LIMITED_RESP_PROMPT,
+                          'data': {'retry_after': retry_after}}, headers={'Retry-After': str(retry_after)})
+
+
+def authenticate(view_class, request):
+    """
+    使用view_class的DRF认证、权限和限流设置(SessionAuthentication、CachedTokenAuthentication、IsAuthenticated等)
+    检查请求，失败时的响应与该view相同；访问数据库，需在线程池中执行
+
+    :param view_class: 对应的同步APIView
+    :param request: django HttpRequest
+    :return: (DRF Request, 失败时已渲染的响应，成功时为None)
+    """
+    view = view_class()
+    view.args, view.kwargs = (), {}
+    view.headers = view.default_response_headers
+    drf_request = view.request = view.initialize_request(request)
+    try:
+        view.initial(drf_request)
+    except Exception as exc:
+        response = view.finalize_response(drf_request, view.handle_exception(exc))
+        return drf_request, response.render()
+    return drf_request, None
+
+
+def is_async_path(request):
+    """
+    async=1(提交异步任务)和带Idempotency-Key的请求仍由同步的view处理
+    """
+    return not request.GET.get('async') and 'HTTP_IDEMPOTENCY_KEY' not in request.META
+
+
+class AsyncNewDocView(CheckParamMixin):
+    """
+    NewDocView的asyncio版本，等待google api时不占用线程；参数、认证和响应与NewDocView相同
+    """
+    sync_view_class = NewDocView
+
+    def accepts(self, request):
+        return is_async_path(request) and not settings.WARM_POOL_ENABLED
+
+    async def get(self, request):
+        try:
+            in_data = request.query_params
+            logger.info(payload(in_data))
+            for field in ('username', 'title', 'folder'):
+                self.validate_common_data(in_data, field)
+            params = {field: in_data[field] for field in ('username', 'title', 'folder')}
+
+            operator = await get_async_operator()
+            doc_id, web_link = await operator.create_doc(params['title'], params['username'], params['folder'])
+            await run_db(documents.record_documents)(
+                [documents.build_document(Document.KIND_NEW_DOC, doc_id, web_link, request.user, **params)])
+            return json_response({'code': ResponseCode.SUCCESS.value, 'message': 'ok',
+                                  'data': {'doc_id': doc_id, 'web_link': web_link}})
+        except ValidationException as e:
+            return json_response({'code': ResponseCode.REGULAR_ERROR.value, 'message': str(e)})
+        except RateLimitedError as e:
+            return rate_limited_response(e)
+        except Exception as e:
+            logger.exception(str(e))
+            return json_response({'code': ResponseCode.UNKNOWN_ERROR.value,
+                                  'message': settings.UNKNOWN_ERROR_RESP_PROMPT})
+
+
+class AsyncCopyDocView(CheckParamMixin):
+    """
+    CopyDocView的asyncio版本，参数、认证和响应与CopyDocView相同
+    """
+    sync_view_class = CopyDocView
+
+    def accepts(self, request):
+        return is_async_path(request)
+
+    async def get(self, request):
+        try:
+            in_data = request.query_params
+            for field in ('source_doc_id', 'title'):
+                self.validate_common_data(in_data, field)
+            params = {field: in_data[field] for field in ('source_doc_id', 'title')}
+
+            operator = await get_async_operator()
+            target_doc_id, web_link = await operator.make_copy(params['source_doc_id'], params['title'])
+            await run_db(documents.record_documents)(
+                [documents.build_document(Document.KIND_COPY_DOC, target_doc_id, web_link, request.user, **params)])
+            return json_response({'code': ResponseCode.SUCCESS.value, 'message': 'ok',
+                                  'data': {'target_doc_id': target_doc_id, 'web_link': web_link}})
+        except ValidationException as e:
+            return json_response({'code': ResponseCode.REGULAR_ERROR.value, 'message': str(e)})
+        except RateLimitedError as e:
+            return rate_limited_response(e)
+        except Exception as e:
+            logger.exception(str(e))
+            return json_response({'code': ResponseCode.UNKNOWN_ERROR.value,
+                                  'message': settings.UNKNOWN_ERROR_RESP_PROMPT})
+
+
+def as_async_view(view):
+    """
+    把async view包装成django的协程view：GET请求且view.accepts时，按同步view的DRF设置认证后由view.get处理，
+    其余请求(如async=1)交给同步的view
+
+    :param view: AsyncNewDocView() / AsyncCopyDocView()
+    """
+    sync_view = sync_to_async(view.sync_view_class.as_view(), thread_sensitive=True)
+
+    async def async_view(request, *args, **kwargs):
+        if request.method != 'GET' or not view.accepts(request):
+            return await sync_view(request, *args, **kwargs)
+        drf_request, response = await run_db(authenticate)(view.sync_view_class, request)
+        if response is not None:
+            return response
+        return await view.get(drf_request)
+
+    # 与DRF的APIView.as_view()一样不做csrf检查(SessionAuthentication中检查)；view_class用于指标中的view名称
+    async_view.csrf_exempt = True
+    async_view.view_class = type(view)
+    return async_view
+
+
+new_doc = as_async_view(AsyncNewDocView())
+copy_doc = as_async_view(AsyncCopyDocView())
+
+
+class AsyncViewsASGIHandler(ASGIHandler):
+    """
+    django的ASGI handler：ASYNC_VIEWS_ENABLED时请求使用ASGI_URLCONF，new_doc、copy_doc的GET请求由asyncio的view处理；
+    中间件(指标、session等)、DRF认证和日志与其他请求相同
+    """
+
+    def create_request(self, scope, body_file):
+        request, error_response = super().create_request(scope, body_file)
+        if request is not None and settings.ASYNC_VIEWS_ENABLED:
+            request.urlconf = ASGI_URLCONF
+        return request, error_response
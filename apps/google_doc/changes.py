@@ -0,0 +1,174 @@
+import threading
+import time
+from datetime import timedelta
+
+from django.utils import timezone
+
+from apps.google_doc.models import CacheInvalidation, DriveChangeCursor
+from common.doc_cache import doc_cache as default_doc_cache
+from common.folder_cache import folder_cache as default_folder_cache, parent_cache as default_parent_cache
+from common.locks import LockTimeout, db_lock
+from common.logger import logger
+from common.utils import FOLDER_MIME_TYPE
+from maze_google_doc import settings
+
+DEFAULT_CURSOR = 'drive'
+
+
+def is_under_root(operator, parents):
+    """
+    判断文件是否在DOC_ROOT_FOLDER_ID下：父目录是根目录或folder cache中的目录(本服务只会缓存根目录下的目录)
+
+    :param operator: GoogleDocOperator
+    :param parents: 文件的父目录id列表
+    """
+    return any(parent == settings.DOC_ROOT_FOLDER_ID or operator.folder_cache.find_folder(parent)
+               for parent in parents or [])
+
+
+def apply_change(operator, change, cached_files=()):
+    """
+    按一条drive修改更新operator的缓存
+
+    目录被改名、移动或删除时删除共享的folder cache中指向它的条目，仍在根目录下的按新的(父目录, 名称)重新缓存；
+    文件被修改、移动或删除时删除本进程的parent cache和doc cache。parent cache和doc cache是进程内缓存，
+    只有被某个进程缓存过parent的文件(如模板)才返回失效通知，由其他进程的InvalidationListener处理；
+    doc cache按drive version校验，不需要单独的通知
+
+    :param operator: GoogleDocOperator
+    :param change: changes().list结果中的一项
+    :param cached_files: 被任一进程缓存的file id，见ParentFolderCache.filter_cached
+    :return: [(CacheInvalidation.KIND_*, key)]
+    """
+    file_id = change['fileId']
+    file = change.get('file') or {}
+    # 永久删除(或失去访问权限)的修改不带file，无法判断是否为目录和所在位置，按id删除所有缓存
+    removed = bool(change.get('removed'))
+    invalidations = []
+    if removed or file.get('mimeType') == FOLDER_MIME_TYPE:
+        key = operator.folder_cache.evict_folder(file_id)
+        if key:
+            invalidations.append((CacheInvalidation.KIND_FOLDER, key))
+        parents = file.get('parents') or []
+        if not removed and not file.get('trashed') and parents and is_under_root(operator, parents):
+            operator.folder_cache.set(parents[0], file['name'], file_id)
+    operator.parent_cache.delete(file_id)
+    operator.doc_cache.delete(file_id)
+    # 模板等根目录外的文件也会被缓存，移出根目录的修改只带新的父目录，所以按是否被缓存而不是所在位置判断
+    if file_id in cached_files:
+        invalidations.append((CacheInvalidation.KIND_FILE, file_id))
+    return invalidations
+
+
+def poll_changes(operator, name=DEFAULT_CURSOR, max_pages=None):
+    """
+    从保存的page token开始读取drive changes，应用到缓存后保存新的page token；
+    第一次运行时只记录当前的startPageToken。持有数据库锁，同一时刻只有一个进程在轮询
+
+    :param operator: GoogleDocOperator
+    :param name: DriveChangeCursor的名称
+    :param max_pages: 本次最多读取的页数，为空时读到最后一页
+    :return: 应用的修改数量，其他进程正在轮询时返回0
+    """
+    try:
+        with db_lock(f'drive_changes:{name}', timeout=0):
+            cursor = DriveChangeCursor.objects.filter(name=name).first()
+            if cursor is None:
+                token = operator.get_changes_start_page_token()
+                DriveChangeCursor.objects.create(name=name, page_token=token)
+                logger.info(f'drive changes cursor {name} starts at {token}')
+                return 0
+            applied = 0
+            pages = 0
+            page_token = cursor.page_token
+            while page_token and (max_pages is None or pages < max_pages):
+                response = operator.list_changes(page_token)
+                page = response.get('changes') or []
+                cached_files = operator.parent_cache.filter_cached([change['fileId'] for change in page])
+                invalidations = []
+                for change in page:
+                    invalidations.extend(apply_change(operator, change, cached_files))
+                applied += len(page)
+                pages += 1
+                if invalidations:
+                    CacheInvalidation.objects.bulk_create(
+                        [CacheInvalidation(kind=kind, key=key) for kind, key in dict.fromkeys(invalidations)])
+                # 修改先应用再保存token，中途失败时下次重新应用同一页，重复应用不影响结果
+                next_token = response.get('nextPageToken') or response.get('newStartPageToken')
+                DriveChangeCursor.objects.filter(name=name).update(page_token=next_token, updated_at=timezone.now())
+                page_token = response.get('nextPageToken')
+            CacheInvalidation.objects.filter(
+                created_at__lt=timezone.now() - timedelta(seconds=settings.DRIVE_CHANGES_RETENTION)).delete()
+            if applied:
+                logger.info(f'applied {applied} drive changes from cursor {name}')
+            return applied
+    except LockTimeout:
+        return 0
+
+
+class InvalidationListener(object):
+    """
+    按id顺序读取CacheInvalidation，删除本进程内的folder cache、parent cache和doc cache条目；
+    operator池每个请求调用一次maybe_sync(见sync_invalidations)，每interval秒最多查询一次数据库
+    """
+
+    def __init__(self, folder_cache=None, parent_cache=None, doc_cache=None, interval=None):
+        """
+        :param interval: 两次同步的最小间隔(秒)
+        """
+        self.folder_cache = folder_cache if folder_cache is not None else default_folder_cache
+        self.parent_cache = parent_cache if parent_cache is not None else default_parent_cache
+        self.doc_cache = doc_cache if doc_cache is not None else default_doc_cache
+        self.interval = settings.DRIVE_CHANGES_SYNC_INTERVAL if interval is None else interval
+        self._last_id = None
+        self._next_sync = 0
+        self._lock = threading.Lock()
+
+    def sync(self):
+        """
+        :return: 处理的失效通知数量
+        """
+        if self._last_id is None:
+            # 进程启动前的通知与进程内缓存无关
+            last = CacheInvalidation.objects.order_by('-id').values_list('id', flat=True).first()
+            self._last_id = last or 0
+            return 0
+        count = 0
+        while True:
+            rows = list(CacheInvalidation.objects.filter(id__gt=self._last_id).order_by('id').values_list(
+                'id', 'kind', 'key')[:1000])
+            for row_id, kind, key in rows:
+                if kind == CacheInvalidation.KIND_FOLDER:
+                    self.folder_cache.delete_local(key)
+                else:
+                    self.parent_cache.delete(key)
+                    self.doc_cache.delete(key)
+                self._last_id = row_id
+            count += len(rows)
+            if len(rows) < 1000:
+                return count
+
+    def maybe_sync(self):
+        """
+        距上次同步超过interval秒时同步一次；其他线程正在同步时直接返回
+        """
+        if time.monotonic() < self._next_sync or not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._next_sync = time.monotonic() + self.interval
+            self.sync()
+        except Exception as e:
+            logger.exception(f'failed to sync cache invalidations: {e}')
+        finally:
+            self._lock.release()
+
+
+invalidation_listener = InvalidationListener()
+
+
+def sync_invalidations():
+    """
+    operator池的prepare hook，在AppConfig.ready中注册：DRIVE_CHANGES_ENABLED时同步其他进程写入的失效通知
+    """
+    if settings.DRIVE_CHANGES_ENABLED:
+        invalidation_listener.maybe_sync()
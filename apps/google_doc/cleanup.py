@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta, timezone
+
+from common.logger import logger
+from common.metrics import deleted_files
+from common.utils import DOCUMENT_MIME_TYPE, TEMP_DOC_APP_PROPERTY
+from maze_google_doc import settings
+
+
+def orphan_query(min_age=None, now=None):
+    """
+    遗留临时文档的查询条件：服务账号拥有、位于其drive根目录、带TEMP_DOC_APP_PROPERTY标记、创建超过min_age秒的
+    google doc；只有create_doc旧方式的临时文档带此标记，根目录下其他人共享或放入的文档不会被匹配
+
+    :param min_age: 创建后的最短时间(秒)，默认ORPHAN_SWEEP_MIN_AGE，应远大于一次请求的耗时
+    :return: drive查询条件
+    """
+    min_age = settings.ORPHAN_SWEEP_MIN_AGE if min_age is None else min_age
+    cutoff = (now or datetime.now(timezone.utc)) - timedelta(seconds=min_age)
+    key, value = TEMP_DOC_APP_PROPERTY
+    return f"'root' in parents and 'me' in owners and mimeType='{DOCUMENT_MIME_TYPE}' and trashed=false " \
+           f"and appProperties has {{ key='{key}' and value='{value}' }} " \
+           f"and createdTime < '{cutoff.strftime('%Y-%m-%dT%H:%M:%S')}Z'"
+
+
+def sweep_orphan_docs(operator, min_age=None, dry_run=False):
+    """
+    找出遗留的临时文档(删除队列满、删除失败或进程退出时未删除的)，通过batch请求删除
+
+    :param operator: GoogleDocOperator
+    :param min_age: 见orphan_query
+    :param dry_run: 只列出，不删除
+    :return: 形如：{'found': 10, 'deleted': 9, 'failed': 1}
+    """
+    # 先列出全部再删除，边列边删会使后续页的page token失效；每页1000为drive的上限
+    file_ids = [file['id'] for file in operator.list_files(orphan_query(min_age), page_size=1000)]
+    result = {'found': len(file_ids), 'deleted': 0, 'failed': 0}
+    if file_ids and not dry_run:
+        failed = operator.delete_files(file_ids)
+        for file_id, err in failed.items():
+            logger.warning(f'sweep_orphan_docs: failed to delete {file_id}: {err}')
+        result['deleted'], result['failed'] = len(file_ids) - len(failed), len(failed)
+        deleted_files.inc(result['deleted'], source='sweeper', status='deleted')
+        deleted_files.inc(result['failed'], source='sweeper', status='failed')
+    logger.info(f'sweep_orphan_docs: {result}')
+    return result
@@ -0,0 +1,104 @@
+from django.db import IntegrityError, transaction
+
+from apps.google_doc.models import Document
+from common.locks import LockTimeout, db_lock
+from common.logger import logger
+from common.utils import ValidationException
+
+# Idempotency-Key需要与之前的请求一致的参数
+IDEMPOTENT_FIELDS = ('title', 'username', 'folder', 'source_doc_id')
+
+
+class IdempotentRequestInProgress(Exception):
+    """ 同一Idempotency-Key的请求仍在处理中，等待超过DB_LOCK_TIMEOUT，客户端应稍后重试 """
+
+
+def stored_value(field, value):
+    """
+    :return: 参数在Document中保存的值，超过字段长度的部分被截断
+    """
+    return (value or '')[:Document._meta.get_field(field).max_length]
+
+
+def build_document(kind, doc_id, web_link, owner=None, idempotency_key=None, **fields):
+    """
+    :param kind: Document.KIND_NEW_DOC / Document.KIND_COPY_DOC
+    :param fields: title, username, folder, source_doc_id
+    :return: 未保存的Document
+    """
+    return Document(kind=kind, doc_id=doc_id, web_link=web_link or '', owner=owner,
+                    idempotency_key=idempotency_key or None,
+                    **{field: stored_value(field, fields.get(field)) for field in IDEMPOTENT_FIELDS})
+
+
+def record_documents(documents):
+    """
+    批量记录创建成功的文档，记录失败不影响已创建的文档返回给客户端
+
+    :param documents: [未保存的Document]
+    """
+    if not documents:
+        return
+    try:
+        Document.objects.bulk_create(documents, ignore_conflicts=True)
+    except Exception as e:
+        logger.exception(f'failed to record {len(documents)} documents: {e}')
+
+
+def get_idempotent_document(owner, idempotency_key, kind, params):
+    """
+    查找同一用户以该Idempotency-Key创建过的文档
+
+    :param owner: 请求的用户
+    :param idempotency_key: 请求头Idempotency-Key
+    :param kind: Document.KIND_NEW_DOC / Document.KIND_COPY_DOC
+    :param params: 本次请求的参数
+    :return: Document，没有时返回None；key曾用于参数不同的请求时抛出ValidationException
+    """
+    document = Document.objects.filter(owner=owner, idempotency_key=idempotency_key).first()
+    if document is None:
+        return None
+    # 与保存时相同地截断后比较，过长的参数重试时仍能匹配
+    if document.kind != kind or any(stored_value(field, params.get(field)) != getattr(document, field)
+                                    for field in IDEMPOTENT_FIELDS):
+        raise ValidationException(f'Idempotency-Key {idempotency_key} was used for a different request')
+    return document
+
+
+def run_idempotent(owner, idempotency_key, kind, params, fn):
+    """
+    执行创建文档的fn并记录结果；带Idempotency-Key时同一用户的同一个key只执行一次，重复或重试的请求直接返回记录的文档
+
+    :param owner: 请求的用户
+    :param idempotency_key: 请求头Idempotency-Key，为空时不做幂等处理
+    :param kind: Document.KIND_NEW_DOC / Document.KIND_COPY_DOC
+    :param params: 请求参数，title/username/folder/source_doc_id
+    :param fn: fn() -> (doc_id, web_link)
+    :return: (doc_id, web_link)；同一个key的请求仍在处理中时抛出IdempotentRequestInProgress
+    """
+    if not idempotency_key:
+        doc_id, web_link = fn()
+        record_documents([build_document(kind, doc_id, web_link, owner, **params)])
+        return doc_id, web_link
+
+    document = get_idempotent_document(owner, idempotency_key, kind, params)
+    if document is None:
+        # 同一个key的并发请求(如客户端超时后立即重试)等待第一个请求完成；
+        # fn中的google api调用(含重试和限流等待)可能超过DB_LOCK_LEASE，持有期间延长锁的有效期
+        try:
+            with db_lock(f'idempotency:{owner.pk if owner else ""}:{idempotency_key}', renew=True):
+                document = get_idempotent_document(owner, idempotency_key, kind, params)
+                if document is None:
+                    doc_id, web_link = fn()
+                    document = build_document(kind, doc_id, web_link, owner, idempotency_key, **params)
+                    try:
+                        with transaction.atomic():
+                            document.save()
+                    except IntegrityError as e:
+                        logger.exception(f'failed to record idempotent document {doc_id}: {e}')
+                    return document.doc_id, document.web_link
+        except LockTimeout as e:
+            raise IdempotentRequestInProgress(
+                f'a request with Idempotency-Key {idempotency_key} is still in progress') from e
+    logger.info(f'Idempotency-Key {idempotency_key} matched {document}, skipping google api')
+    return document.doc_id, document.web_link
@@ -0,0 +1,141 @@
+import threading
+import time
+
+from django.core.signals import request_started
+from django.db import connection
+
+from common.folder_cache import folder_cache as default_folder_cache
+from common.logger import logger
+from common.operator_pool import operator_pool
+from maze_google_doc import settings
+
+# 启动预热的去重标记：FOLDER_INDEX_WARM_INTERVAL秒内只有一个进程遍历google drive，其他进程直接使用共享层缓存
+WARM_UP_KEY = 'google_doc:folder_index:warmed'
+
+_warm_up_thread = None
+_warm_up_thread_lock = threading.Lock()
+
+
+def list_child_folders(operator, parent_ids, page_size=None, parents_per_query=None):
+    """
+    列出多个父目录下的子目录，每次查询合并多个父目录，只请求id、name、parents字段
+
+    :param operator: GoogleDocOperator
+    :param parent_ids: 父目录id列表
+    :param page_size: files().list每页的数量，默认FOLDER_INDEX_PAGE_SIZE
+    :param parents_per_query: 每次查询合并的父目录数量，默认FOLDER_INDEX_PARENTS_PER_QUERY
+    :return: 每页结果的生成器，每页为(parent folder id, folder name, folder id)的列表
+    """
+    page_size = page_size or settings.FOLDER_INDEX_PAGE_SIZE
+    parents_per_query = parents_per_query or settings.FOLDER_INDEX_PARENTS_PER_QUERY
+    parent_ids = list(parent_ids)
+    for start in range(0, len(parent_ids), parents_per_query):
+        chunk = parent_ids[start:start + parents_per_query]
+        q = '(' + ' or '.join(f"'{parent_id}' in parents" for parent_id in chunk) + ')'
+        page = []
+        for folder in operator.list_folders(q, page_size=page_size, fields='id, name, parents'):
+            # 同一目录可能有多个父目录，只取本次查询的
+            for parent_id in set(folder.get('parents', [])).intersection(chunk):
+                page.append((parent_id, folder['name'], folder['id']))
+            if len(page) >= page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+
+def iter_folder_tree(operator, root_folder_id, max_depth=None, page_size=None, parents_per_query=None):
+    """
+    按层遍历root下的目录树，见list_child_folders
+
+    :param operator: GoogleDocOperator
+    :param root_folder_id: 根目录
+    :param max_depth: 最多遍历的层数，为空时遍历整棵树
+    :return: 每页结果的生成器，每页为(parent folder id, folder name, folder id)的列表
+    """
+    level = [root_folder_id]
+    depth = 0
+    while level and (max_depth is None or depth < max_depth):
+        next_level = []
+        for page in list_child_folders(operator, level, page_size, parents_per_query):
+            next_level.extend(dict.fromkeys(folder_id for _, _, folder_id in page))
+            yield page
+        level = next_level
+        depth += 1
+
+
+def warm_folder_cache(operator, root_folder_id=None, folder_cache=None, max_depth=None, page_size=None):
+    """
+    遍历root下的整棵目录树，建立 名称路径 -> folder id 的索引并写入目录缓存，
+    之后get_or_create_folder对已有目录的查找不再访问google drive
+
+    同一父目录下有同名目录时保留先列出的一个，与get_or_create_folder取第一个查询结果一致
+
+    :param root_folder_id: 根目录，默认DOC_ROOT_FOLDER_ID
+    :param folder_cache: 写入的目录缓存，默认operator.folder_cache
+    :return: 形如：{'student1': '...', 'student1/essay': '...'}
+    """
+    root_folder_id = root_folder_id or settings.DOC_ROOT_FOLDER_ID
+    folder_cache = folder_cache if folder_cache is not None else operator.folder_cache
+    paths = {root_folder_id: ''}
+    seen = set()
+    index = {}
+    start = time.monotonic()
+    for page in iter_folder_tree(operator, root_folder_id, max_depth=max_depth, page_size=page_size):
+        entries = []
+        for parent_id, folder_name, folder_id in page:
+            if parent_id not in paths:
+                # 被忽略的同名目录下的子目录
+                continue
+            if (parent_id, folder_name) in seen:
+                logger.warning(f'duplicate folder {folder_name} under {parent_id}, ignored {folder_id}')
+                continue
+            seen.add((parent_id, folder_name))
+            path = f'{paths[parent_id]}/{folder_name}' if paths[parent_id] else folder_name
+            paths.setdefault(folder_id, path)
+            index[path] = folder_id
+            entries.append((parent_id, folder_name, folder_id))
+        folder_cache.set_many(entries)
+    logger.info(f'indexed {len(index)} folders under {root_folder_id} in {time.monotonic() - start:.1f}s')
+    return index
+
+
+def warm_up_async():
+    """
+    在后台线程中预热目录缓存，不阻塞进程启动；FOLDER_INDEX_WARM_INTERVAL秒内多个进程只有一个实际遍历
+
+    :return: 是否启动了预热线程
+    """
+    global _warm_up_thread
+    with _warm_up_thread_lock:
+        if _warm_up_thread is not None and _warm_up_thread.is_alive():
+            return False
+
+        def run():
+            try:
+                if not default_folder_cache.shared.add(WARM_UP_KEY, time.time(), settings.FOLDER_INDEX_WARM_INTERVAL):
+                    return
+                with operator_pool.checkout() as operator:
+                    warm_folder_cache(operator, folder_cache=default_folder_cache)
+            except Exception as e:
+                logger.exception(f'failed to warm up folder cache: {e}')
+                # 允许其他进程重试
+                default_folder_cache.shared.delete(WARM_UP_KEY)
+            finally:
+                connection.close()
+
+        _warm_up_thread = threading.Thread(target=run, name='folder-index-warm-up', daemon=True)
+        _warm_up_thread.start()
+        return True
+
+
+def warm_up_on_first_request():
+    """
+    web进程(包括fork出的子进程)处理第一个请求时调用warm_up_async；
+    加载应用时不访问google drive和缓存表，fork前的gunicorn master不会预热
+    """
+    def warm_up(**kwargs):
+        request_started.disconnect(dispatch_uid='google_doc_folder_index_warm_up')
+        warm_up_async()
+
+    request_started.connect(warm_up, weak=False, dispatch_uid='google_doc_folder_index_warm_up')
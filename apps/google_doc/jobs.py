@@ -0,0 +1,253 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.core.signals import request_started
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from apps.google_doc import documents, warm_pool
+from apps.google_doc.models import Document, Job
+from common.logger import logger
+from common.operator_pool import operator_pool
+from common.utils import ValidationException
+from maze_google_doc import settings
+
+
+def _create_once(job, fn):
+    """
+    包装创建文档的fn：创建后立即把doc id记录在任务上，任务重新执行(如worker在标记完成前退出)时直接返回记录的文档，
+    没有Idempotency-Key的任务也不会重复创建
+
+    :param fn: fn() -> (doc_id, web_link)
+    """
+    def run():
+        if job.doc_id:
+            logger.info(f'{job} already created {job.doc_id}, skipping google api')
+            return job.doc_id, job.web_link
+        doc_id, web_link = fn()
+        job.doc_id, job.web_link = doc_id, web_link or ''
+        Job.objects.filter(id=job.id).update(doc_id=job.doc_id, web_link=job.web_link)
+        return doc_id, web_link
+
+    return run
+
+
+def _run_new_doc(operator, job, params):
+    doc_id, web_link = documents.run_idempotent(
+        job.owner, job.idempotency_key, Document.KIND_NEW_DOC, params,
+        _create_once(job, lambda: warm_pool.create_doc(operator, params['title'], params['username'],
+                                                       params['folder'])))
+    return {'doc_id': doc_id, 'web_link': web_link}
+
+
+def _run_copy_doc(operator, job, params):
+    target_doc_id, web_link = documents.run_idempotent(
+        job.owner, job.idempotency_key, Document.KIND_COPY_DOC, params,
+        _create_once(job, lambda: operator.make_copy(params['source_doc_id'], params['title'])))
+    return {'target_doc_id': target_doc_id, 'web_link': web_link}
+
+
+JOB_HANDLERS = {
+    Job.KIND_NEW_DOC: _run_new_doc,
+    Job.KIND_COPY_DOC: _run_copy_doc,
+}
+
+
+def submit_job(kind, params, owner=None, idempotency_key=None):
+    """
+    新建一个待执行的任务；in_process模式下确保本进程的worker已启动
+
+    :param kind: Job.KIND_NEW_DOC / Job.KIND_COPY_DOC
+    :param params: 任务参数
+    :param owner: 提交任务的用户
+    :param idempotency_key: 请求头Idempotency-Key，同一用户的同一个key重复提交时返回已有的任务
+    :return: Job
+    """
+    params = json.dumps(params, ensure_ascii=False)
+    try:
+        with transaction.atomic():
+            job = Job.objects.create(kind=kind, params=params, owner=owner, idempotency_key=idempotency_key or None)
+    except IntegrityError:
+        job = Job.objects.filter(owner=owner, idempotency_key=idempotency_key).first()
+        if job is None:
+            raise
+        if job.kind != kind or job.params != params:
+            raise ValidationException(f'Idempotency-Key {idempotency_key} was used for a different request')
+        logger.info(f'Idempotency-Key {idempotency_key} matched {job}')
+        return job
+    if settings.JOB_WORKER_MODE == 'in_process':
+        get_in_process_worker_pool().wake_up()
+    return job
+
+
+def requeue_stale_jobs():
+    """
+    把lease已过期(worker重启或崩溃)的执行中任务重新排队
+
+    :return: 重新排队的任务数
+    """
+    count = Job.objects.filter(status=Job.STATUS_RUNNING, lease_expires_at__lt=timezone.now()).update(
+        status=Job.STATUS_PENDING, worker='', lease_expires_at=None)
+    if count:
+        logger.info(f'requeued {count} stale jobs')
+    return count
+
+
+def claim_next_job(worker):
+    """
+    领取一个待执行的任务，通过带状态条件的update保证同一任务只会被一个worker领取
+
+    :param worker: worker名称
+    :return: Job，没有待执行的任务时返回None
+    """
+    candidate_ids = Job.objects.filter(status=Job.STATUS_PENDING).order_by('id').values_list('id', flat=True)[:10]
+    for job_id in candidate_ids:
+        claimed = Job.objects.filter(id=job_id, status=Job.STATUS_PENDING).update(
+            status=Job.STATUS_RUNNING, worker=worker, attempts=F('attempts') + 1,
+            lease_expires_at=timezone.now() + timedelta(seconds=settings.JOB_LEASE_SECONDS))
+        if claimed:
+            return Job.objects.get(id=job_id)
+    return None
+
+
+def run_job(job):
+    """
+    执行一个已领取的任务并保存结果，失败且未超过最大尝试次数时重新排队
+
+    :param job: 已领取的Job
+    """
+    try:
+        params = json.loads(job.params)
+        with operator_pool.checkout() as operator:
+            result = JOB_HANDLERS[job.kind](operator, job, params)
+    except Exception as e:
+        logger.exception(f'{job} failed on attempt {job.attempts}: {e}')
+        status = Job.STATUS_PENDING if job.attempts < settings.JOB_MAX_ATTEMPTS else Job.STATUS_FAILED
+        Job.objects.filter(id=job.id, worker=job.worker).update(
+            status=status, error=str(e), worker='', lease_expires_at=None,
+            finished_at=timezone.now() if status == Job.STATUS_FAILED else None)
+        return
+    Job.objects.filter(id=job.id, worker=job.worker).update(
+        status=Job.STATUS_SUCCEEDED, result=json.dumps(result, ensure_ascii=False), error='',
+        lease_expires_at=None, finished_at=timezone.now())
+    logger.info(f'{job} succeeded')
+
+
+class JobWorkerPool(object):
+    """
+    执行任务的worker线程池，可在web进程内运行(JOB_WORKER_MODE = 'in_process')，
+    也可由 python manage.py run_job_worker 单独运行
+    """
+
+    def __init__(self, concurrency=None, poll_interval=None):
+        """
+        :param concurrency: worker线程数
+        :param poll_interval: 没有任务时的轮询间隔(秒)
+        """
+        self.concurrency = settings.JOB_WORKER_CONCURRENCY if concurrency is None else concurrency
+        self.poll_interval = settings.JOB_POLL_INTERVAL if poll_interval is None else poll_interval
+        self.name = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self._stop = threading.Event()
+        self._wake_up = threading.Event()
+        self._threads = []
+        self._requeue_lock = threading.Lock()
+        self._next_requeue = 0.0
+
+    def start(self):
+        self.maybe_requeue_stale_jobs()
+        connection.close()
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._loop, args=(f'{self.name}:{i}',), name=f'job-worker-{i}',
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f'job worker pool {self.name} started with {self.concurrency} threads')
+        return self
+
+    def wake_up(self):
+        self._wake_up.set()
+
+    def maybe_requeue_stale_jobs(self):
+        """
+        每JOB_LEASE_SECONDS / 2秒由池中的一个线程把lease过期的任务重新排队，其余线程不重复执行这个update
+        """
+        if not self._requeue_lock.acquire(blocking=False):
+            return
+        try:
+            now = time.monotonic()
+            if now < self._next_requeue:
+                return
+            self._next_requeue = now + settings.JOB_LEASE_SECONDS / 2
+            requeue_stale_jobs()
+        finally:
+            self._requeue_lock.release()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake_up.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _loop(self, worker):
+        while not self._stop.is_set():
+            close_old_connections()
+            try:
+                job = claim_next_job(worker)
+                if job is None:
+                    self.maybe_requeue_stale_jobs()
+                    self._wake_up.wait(self.poll_interval)
+                    self._wake_up.clear()
+                    continue
+                run_job(job)
+            except Exception as e:
+                logger.exception(f'job worker {worker} error: {e}')
+                self._stop.wait(self.poll_interval)
+        connection.close()
+
+
+_in_process_pool = None
+_in_process_pool_lock = threading.Lock()
+
+
+def get_in_process_worker_pool():
+    """
+    返回本进程的worker池，首次调用时启动
+    """
+    global _in_process_pool
+    with _in_process_pool_lock:
+        if _in_process_pool is None:
+            _in_process_pool = JobWorkerPool().start()
+        return _in_process_pool
+
+
+def _reset_in_process_pool():
+    # fork出的子进程(如gunicorn --preload的worker)中没有父进程的worker线程，需要重新启动
+    global _in_process_pool, _in_process_pool_lock
+    _in_process_pool = None
+    _in_process_pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_in_process_pool)
+
+
+def start_workers_on_first_request():
+    """
+    in_process模式下web进程(包括fork出的子进程)在处理第一个请求时启动worker池，
+    重启前未完成和lease过期的任务不必等到下一次提交任务才执行
+    """
+    def ensure_started(**kwargs):
+        if _in_process_pool is not None:
+            return
+        try:
+            get_in_process_worker_pool()
+        except Exception as e:
+            # 如数据库尚不可用，之后的请求或提交任务时再启动
+            logger.exception(f'failed to start job worker pool: {e}')
+
+    request_started.connect(ensure_started, weak=False, dispatch_uid='google_doc_job_workers')
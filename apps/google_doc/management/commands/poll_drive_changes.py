@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.google_doc.changes import DEFAULT_CURSOR, poll_changes
+from common.logger import logger
+from common.operator_pool import operator_pool
+from maze_google_doc import settings
+
+
+class Command(BaseCommand):
+    help = '轮询drive changes feed，按DOC_ROOT_FOLDER_ID下的修改失效目录、父目录和文档缓存'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cursor', default=DEFAULT_CURSOR, help='保存轮询位置的DriveChangeCursor名称')
+        parser.add_argument('--loop', action='store_true', help='持续运行，每隔--interval秒轮询一次')
+        parser.add_argument('--interval', type=float, default=settings.DRIVE_CHANGES_POLL_INTERVAL,
+                            help='--loop模式下的轮询间隔(秒)')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                with operator_pool.checkout() as operator:
+                    applied = poll_changes(operator, options['cursor'])
+                self.stdout.write(f'applied {applied} drive changes')
+            except Exception as e:
+                if not options['loop']:
+                    raise
+                logger.exception(f'failed to poll drive changes: {e}')
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
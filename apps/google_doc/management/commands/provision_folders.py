@@ -0,0 +1,25 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from apps.google_doc.provisioning import add_roster, load_roster, provision_roster
+from common.operator_pool import operator_pool
+from maze_google_doc import settings
+
+
+class Command(BaseCommand):
+    help = '按花名册批量预建 username/folder 目录，进度记录在RosterFolder表中，中断后以同一--roster重新执行即可继续'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help='花名册文件(csv: username,folder 或 json)，为空时只继续已有的花名册')
+        parser.add_argument('--roster', required=True, help='花名册名称，如学期')
+        parser.add_argument('--concurrency', type=int, default=settings.ROSTER_PROVISION_CONCURRENCY,
+                            help='并发发送batch请求的线程数')
+
+    def handle(self, *args, **options):
+        if options['path']:
+            total = add_roster(options['roster'], load_roster(options['path']))
+            self.stdout.write(f'roster {options["roster"]} has {total} folders')
+        with operator_pool.checkout() as operator:
+            progress = provision_roster(operator, options['roster'], concurrency=options['concurrency'])
+        self.stdout.write(json.dumps(progress))
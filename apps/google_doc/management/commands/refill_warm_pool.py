@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.google_doc.warm_pool import refill_warm_pool
+from common.logger import logger
+from common.operator_pool import operator_pool
+from maze_google_doc import settings
+
+
+class Command(BaseCommand):
+    help = '把new_doc使用的暂存空白文档池补充到high water数量'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--high-water', type=int, default=settings.WARM_POOL_HIGH_WATER,
+                            help='暂存池的目标文档数量')
+        parser.add_argument('--loop', action='store_true', help='持续运行，每隔--interval秒检查一次')
+        parser.add_argument('--interval', type=float, default=10, help='--loop模式下的检查间隔(秒)')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                with operator_pool.checkout() as operator:
+                    created = refill_warm_pool(operator, options['high_water'])
+                self.stdout.write(f'created {created} warm docs')
+            except Exception as e:
+                if not options['loop']:
+                    raise
+                logger.exception(f'failed to refill warm pool: {e}')
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,27 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from apps.google_doc.jobs import JobWorkerPool
+from maze_google_doc import settings
+
+
+class Command(BaseCommand):
+    help = '运行执行异步new_doc/copy_doc任务的worker，启动时会把lease已过期的执行中任务重新排队'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=settings.JOB_WORKER_CONCURRENCY,
+                            help='worker线程数')
+        parser.add_argument('--poll-interval', type=float, default=settings.JOB_POLL_INTERVAL,
+                            help='没有任务时的轮询间隔(秒)')
+
+    def handle(self, *args, **options):
+        stopped = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: stopped.set())
+        pool = JobWorkerPool(options['concurrency'], options['poll_interval']).start()
+        self.stdout.write(f'job worker pool {pool.name} started with {pool.concurrency} threads')
+        stopped.wait()
+        self.stdout.write('stopping job workers...')
+        pool.stop()
@@ -0,0 +1,35 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.google_doc.cleanup import sweep_orphan_docs
+from common.logger import logger
+from common.operator_pool import operator_pool
+from maze_google_doc import settings
+
+
+class Command(BaseCommand):
+    help = '删除服务账号drive根目录下遗留的临时文档(create_doc旧方式中未能删除的)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=settings.ORPHAN_SWEEP_MIN_AGE,
+                            help='只删除创建超过该时间(秒)的文档')
+        parser.add_argument('--dry-run', action='store_true', help='只统计，不删除')
+        parser.add_argument('--loop', action='store_true', help='持续运行，每隔--interval秒执行一次')
+        parser.add_argument('--interval', type=float, default=settings.ORPHAN_SWEEP_INTERVAL,
+                            help='--loop模式下的执行间隔(秒)')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                with operator_pool.checkout() as operator:
+                    result = sweep_orphan_docs(operator, options['min_age'], options['dry_run'])
+                self.stdout.write(json.dumps(result))
+            except Exception as e:
+                if not options['loop']:
+                    raise
+                logger.exception(f'failed to sweep orphan docs: {e}')
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from apps.google_doc.folder_index import warm_folder_cache
+from common.operator_pool import operator_pool
+from maze_google_doc import settings
+
+
+class Command(BaseCommand):
+    help = '遍历根目录下的整棵目录树，把 名称路径 -> folder id 写入目录缓存，用于部署后预热'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--root', default=settings.DOC_ROOT_FOLDER_ID, help='根目录的folder id')
+        parser.add_argument('--max-depth', type=int, help='最多遍历的层数，默认遍历整棵树')
+        parser.add_argument('--page-size', type=int, default=settings.FOLDER_INDEX_PAGE_SIZE,
+                            help='每次files().list返回的目录数量')
+
+    def handle(self, *args, **options):
+        with operator_pool.checkout() as operator:
+            index = warm_folder_cache(operator, options['root'], max_depth=options['max_depth'],
+                                      page_size=options['page_size'])
+        if options['verbosity'] > 1:
+            for path, folder_id in sorted(index.items()):
+                self.stdout.write(f'{path}\t{folder_id}')
+        self.stdout.write(f'indexed {len(index)} folders')
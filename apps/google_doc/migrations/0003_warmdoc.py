@@ -0,0 +1,28 @@
+# Generated by Django 3.0.3 on 2026-10-17 04:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('google_doc', '0002_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WarmDoc',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('doc_id', models.CharField(max_length=128, unique=True)),
+                ('folder_id', models.CharField(max_length=128)),
+                ('status', models.CharField(choices=[('ready', 'ready'), ('claimed', 'claimed')], default='ready', max_length=16)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='warmdoc',
+            index=models.Index(fields=['status', 'id'], name='google_doc__status_c4ba7c_idx'),
+        ),
+    ]
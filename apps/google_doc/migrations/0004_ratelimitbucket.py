@@ -0,0 +1,23 @@
+# Generated by Django 3.0.3 on 2026-10-17 04:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('google_doc', '0003_warmdoc'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateLimitBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('tokens', models.FloatField()),
+                ('refreshed_at', models.FloatField()),
+                ('version', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.0.3 on 2026-10-17 04:22
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('google_doc', '0004_ratelimitbucket'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='job',
+            unique_together={('owner', 'idempotency_key')},
+        ),
+        migrations.CreateModel(
+            name='Document',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('doc_id', models.CharField(max_length=128, unique=True)),
+                ('web_link', models.CharField(max_length=512)),
+                ('kind', models.CharField(choices=[('new_doc', 'new_doc'), ('copy_doc', 'copy_doc')], max_length=32)),
+                ('title', models.CharField(max_length=255)),
+                ('username', models.CharField(blank=True, default='', max_length=150)),
+                ('folder', models.CharField(blank=True, default='', max_length=128)),
+                ('source_doc_id', models.CharField(blank=True, default='', max_length=128)),
+                ('idempotency_key', models.CharField(blank=True, max_length=255, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('owner', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['username', 'folder', 'title'], name='google_doc__usernam_7a3ada_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['source_doc_id'], name='google_doc__source__115386_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='document',
+            unique_together={('owner', 'idempotency_key')},
+        ),
+    ]
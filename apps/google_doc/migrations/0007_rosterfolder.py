@@ -0,0 +1,35 @@
+# Generated by Django 3.0.3 on 2026-10-17 05:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('google_doc', '0006_drivechangecursor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RosterFolder',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('roster', models.CharField(max_length=128)),
+                ('username', models.CharField(max_length=150)),
+                ('folder', models.CharField(max_length=128)),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('done', 'done'), ('failed', 'failed')], default='pending', max_length=16)),
+                ('folder_id', models.CharField(blank=True, default='', max_length=128)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='rosterfolder',
+            index=models.Index(fields=['roster', 'status'], name='google_doc__roster_3c8710_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='rosterfolder',
+            unique_together={('roster', 'username', 'folder')},
+        ),
+    ]
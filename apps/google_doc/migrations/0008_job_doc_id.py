@@ -0,0 +1,23 @@
+# Generated by Django 3.0.3 on 2026-10-17 05:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('google_doc', '0007_rosterfolder'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='doc_id',
+            field=models.CharField(blank=True, default='', max_length=128),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='web_link',
+            field=models.CharField(blank=True, default='', max_length=512),
+        ),
+    ]
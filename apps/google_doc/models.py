@@ -1 +1,192 @@
-# Create your models here.
+from django.db import models
+
+
+class DbLock(models.Model):
+    """
+    跨worker进程的锁，一行代表一个被持有的锁，见common.locks.db_lock
+    """
+    lock_key = models.CharField(max_length=40, unique=True)
+    name = models.CharField(max_length=255)
+    owner = models.CharField(max_length=255)
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.name} held by {self.owner}'
+
+
+class Job(models.Model):
+    """
+    异步执行的new_doc/copy_doc任务，由apps.google_doc.jobs中的worker执行
+    """
+    KIND_NEW_DOC = 'new_doc'
+    KIND_COPY_DOC = 'copy_doc'
+    KIND_CHOICES = ((KIND_NEW_DOC, KIND_NEW_DOC), (KIND_COPY_DOC, KIND_COPY_DOC))
+
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = ((STATUS_PENDING, STATUS_PENDING), (STATUS_RUNNING, STATUS_RUNNING),
+                      (STATUS_SUCCEEDED, STATUS_SUCCEEDED), (STATUS_FAILED, STATUS_FAILED))
+
+    kind = models.CharField(max_length=32, choices=KIND_CHOICES)
+    # json格式的请求参数和执行结果
+    params = models.TextField()
+    result = models.TextField(blank=True, default='')
+    error = models.TextField(blank=True, default='')
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.IntegerField(default=0)
+    owner = models.ForeignKey('auth.User', null=True, blank=True, on_delete=models.SET_NULL)
+    # 客户端请求头Idempotency-Key，同一用户的同一个key只会提交一个任务
+    idempotency_key = models.CharField(max_length=255, null=True, blank=True)
+    # 已创建的文档，创建后立即记录；任务重新执行(如worker在标记完成前退出)时直接使用，不再重复创建
+    doc_id = models.CharField(max_length=128, blank=True, default='')
+    web_link = models.CharField(max_length=512, blank=True, default='')
+    # 执行中的任务由worker持有，lease过期后视为worker已退出，任务会被重新排队
+    worker = models.CharField(max_length=255, blank=True, default='')
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id']),
+        ]
+        unique_together = (('owner', 'idempotency_key'),)
+
+    def __str__(self):
+        return f'{self.kind} job {self.id} ({self.status})'
+
+
+class WarmDoc(models.Model):
+    """
+    预先在暂存目录中创建好的空白文档，new_doc时领取后移动到用户目录，见apps.google_doc.warm_pool
+    """
+    STATUS_READY = 'ready'
+    STATUS_CLAIMED = 'claimed'
+    STATUS_CHOICES = ((STATUS_READY, STATUS_READY), (STATUS_CLAIMED, STATUS_CLAIMED))
+
+    doc_id = models.CharField(max_length=128, unique=True)
+    # 文档所在的暂存目录
+    folder_id = models.CharField(max_length=128)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_READY)
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id']),
+        ]
+
+    def __str__(self):
+        return f'warm doc {self.doc_id} ({self.status})'
+
+
+class RateLimitBucket(models.Model):
+    """
+    所有worker进程共享的google api令牌桶状态，见common.rate_limit.TokenBucket
+    """
+    name = models.CharField(max_length=64, unique=True)
+    # 上次更新时桶内的令牌数，预约后可以为负数(表示之后的请求需要等待)
+    tokens = models.FloatField()
+    # 上次更新的时间戳(time.time())
+    refreshed_at = models.FloatField()
+    # 乐观锁版本号，按版本号条件更新，不需要行锁
+    version = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f'rate limit bucket {self.name} ({self.tokens:.1f} tokens)'
+
+
+class Document(models.Model):
+    """
+    本服务创建的google文档，new_doc/copy_doc(包括批量接口和异步任务)成功后记录，见apps.google_doc.documents
+    """
+    KIND_NEW_DOC = 'new_doc'
+    KIND_COPY_DOC = 'copy_doc'
+    KIND_CHOICES = ((KIND_NEW_DOC, KIND_NEW_DOC), (KIND_COPY_DOC, KIND_COPY_DOC))
+
+    doc_id = models.CharField(max_length=128, unique=True)
+    web_link = models.CharField(max_length=512)
+    kind = models.CharField(max_length=32, choices=KIND_CHOICES)
+    title = models.CharField(max_length=255)
+    # new_doc的目标目录；拷贝到源文件所在目录时为空
+    username = models.CharField(max_length=150, blank=True, default='')
+    folder = models.CharField(max_length=128, blank=True, default='')
+    source_doc_id = models.CharField(max_length=128, blank=True, default='')
+    owner = models.ForeignKey('auth.User', null=True, blank=True, on_delete=models.SET_NULL)
+    # 客户端请求头Idempotency-Key，同一用户的同一个key只会创建一个文档
+    idempotency_key = models.CharField(max_length=255, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['username', 'folder', 'title']),
+            models.Index(fields=['source_doc_id']),
+        ]
+        unique_together = (('owner', 'idempotency_key'),)
+
+    def __str__(self):
+        return f'{self.kind} doc {self.doc_id} ({self.title})'
+
+
+class DriveChangeCursor(models.Model):
+    """
+    drive changes feed的轮询位置，见apps.google_doc.changes.poll_changes
+    """
+    name = models.CharField(max_length=64, unique=True)
+    # 下次轮询从这个token开始列出修改
+    page_token = models.CharField(max_length=255)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'drive changes cursor {self.name} at {self.page_token}'
+
+
+class CacheInvalidation(models.Model):
+    """
+    changes轮询进程写入的进程内缓存失效通知，各worker进程按id顺序读取后删除自己的进程内缓存
+    """
+    # key为FolderCache.make_key生成的缓存key
+    KIND_FOLDER = 'folder'
+    # key为file id，对应parent cache和doc cache
+    KIND_FILE = 'file'
+    KIND_CHOICES = ((KIND_FOLDER, KIND_FOLDER), (KIND_FILE, KIND_FILE))
+
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    key = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f'invalidate {self.kind} {self.key}'
+
+
+class RosterFolder(models.Model):
+    """
+    按花名册批量预建的 [username, folder] 目录，同一roster可重复执行，已完成的不再处理，见apps.google_doc.provisioning
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = ((STATUS_PENDING, STATUS_PENDING), (STATUS_DONE, STATUS_DONE), (STATUS_FAILED, STATUS_FAILED))
+
+    # 花名册名称，如学期
+    roster = models.CharField(max_length=128)
+    username = models.CharField(max_length=150)
+    folder = models.CharField(max_length=128)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    folder_id = models.CharField(max_length=128, blank=True, default='')
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['roster', 'status']),
+        ]
+        unique_together = (('roster', 'username', 'folder'),)
+
+    def __str__(self):
+        return f'{self.roster} folder {self.username}/{self.folder} ({self.status})'
@@ -0,0 +1,164 @@
+import csv
+import json
+from collections import defaultdict
+from contextlib import ExitStack
+
+from django.db.models import Count
+from django.utils import timezone
+
+from apps.google_doc.folder_index import list_child_folders
+from apps.google_doc.models import RosterFolder
+from common.logger import logger
+from common.operator_pool import operator_pool as default_operator_pool
+from common.utils import folder_lock
+from maze_google_doc import settings
+
+
+def load_roster(path):
+    """
+    读取花名册文件：.json为 [[username, folder], ...] 或 [{'username': ..., 'folder': ...}, ...]，
+    其他按csv读取，每行 username,folder，第一行为 username,folder 时作为表头跳过
+
+    :return: 去重后的(username, folder)列表，保持文件中的顺序
+    """
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        if path.endswith('.json'):
+            rows = [(row['username'], row['folder']) if isinstance(row, dict) else tuple(row) for row in json.load(f)]
+        else:
+            rows = [tuple(row[:2]) for row in csv.reader(f) if row and any(row)]
+            if rows and rows[0] == ('username', 'folder'):
+                rows = rows[1:]
+    pairs = []
+    for row in rows:
+        if len(row) != 2 or not all(isinstance(value, str) and value.strip() for value in row):
+            raise ValueError(f'invalid roster row: {row}')
+        pairs.append((row[0].strip(), row[1].strip()))
+    return list(dict.fromkeys(pairs))
+
+
+def add_roster(roster, pairs):
+    """
+    把(username, folder)加入花名册，已有的不重复添加
+
+    :return: 花名册中的条目总数
+    """
+    RosterFolder.objects.bulk_create(
+        [RosterFolder(roster=roster, username=username, folder=folder) for username, folder in pairs],
+        batch_size=500, ignore_conflicts=True)
+    return RosterFolder.objects.filter(roster=roster).count()
+
+
+def create_folders(operator, items):
+    """
+    持有与new_doc查找或创建目录时相同的(父目录, 目录名)数据库锁，通过batch请求创建目录；
+    列出子目录之后、取得锁之前已被其他请求创建(已写入folder cache)的目录不再创建
+
+    :param items: [(parent folder id, folder name)]，不能重复
+    :return: {(parent folder id, folder name): folder id或该项失败的异常}
+    """
+    with ExitStack() as stack:
+        # 按固定顺序加锁，多个预建进程同时执行时不会死锁
+        for parent_id, folder_name in sorted(items):
+            stack.enter_context(folder_lock(parent_id, folder_name))
+        results = {}
+        for parent_id, folder_name in items:
+            folder_id = operator.folder_cache.get(parent_id, folder_name)
+            if folder_id:
+                results[(parent_id, folder_name)] = folder_id
+        missing = [key for key in items if key not in results]
+        if missing:
+            results.update(operator.create_folders(missing))
+        return results
+
+
+def ensure_folders(operator, parents, skip_listing=(), pool=None, concurrency=None):
+    """
+    确保各父目录下存在指定名称的子目录：每个父目录只列出一次子目录(多个父目录合并查询)，
+    不存在的通过batch请求创建(见create_folders)，多个batch由pool中的operator并发发送，经过共享的令牌桶限流
+
+    :param parents: {parent folder id: 子目录名称集合}
+    :param skip_listing: 不需要列出子目录的父目录，如刚刚创建的目录
+    :return: 结果的生成器，每项为{(parent folder id, folder name): folder id或该项失败的异常}，
+        先是已存在的目录，之后每个batch一项
+    """
+    pool = pool or default_operator_pool
+    concurrency = concurrency or settings.ROSTER_PROVISION_CONCURRENCY
+    existing = {}
+    for page in list_child_folders(operator, [parent_id for parent_id in parents if parent_id not in skip_listing]):
+        for parent_id, folder_name, folder_id in page:
+            if folder_name in parents[parent_id]:
+                existing.setdefault((parent_id, folder_name), folder_id)
+    operator.folder_cache.set_many([key + (folder_id,) for key, folder_id in existing.items()])
+    yield existing
+
+    missing = [(parent_id, folder_name) for parent_id, names in parents.items() for folder_name in sorted(names)
+               if (parent_id, folder_name) not in existing]
+    logger.info(f'ensure_folders: {len(existing)} folders exist, creating {len(missing)}')
+    chunks = [missing[start:start + settings.GOOGLE_BATCH_SIZE]
+              for start in range(0, len(missing), settings.GOOGLE_BATCH_SIZE)]
+    yield from pool.imap_unordered(create_folders, chunks, concurrency)
+
+
+def _save(rows, status, error=''):
+    """
+    更新条目的状态，folder_id使用各条目上已设置的值
+    """
+    now = timezone.now()
+    for row in rows:
+        row.status, row.error, row.updated_at = status, error, now
+    RosterFolder.objects.bulk_update(rows, ['status', 'folder_id', 'error', 'updated_at'], batch_size=500)
+
+
+def provision_roster(operator, roster, pool=None, concurrency=None):
+    """
+    为花名册中未完成的条目预建 DOC_ROOT_FOLDER_ID/username/folder 目录，每个batch完成后把结果写入RosterFolder，
+    中断或部分失败后重新执行只处理未完成的条目，已存在的目录通过列出子目录找到，不会重复创建
+
+    :param operator: 用于列出子目录的GoogleDocOperator
+    :param roster: 花名册名称
+    :return: 形如：{'done': 1000, 'failed': 0, 'pending': 0}
+    """
+    rows = defaultdict(list)
+    for row in RosterFolder.objects.filter(roster=roster).exclude(status=RosterFolder.STATUS_DONE):
+        rows[row.username].append(row)
+    if not rows:
+        return roster_progress(roster)
+
+    user_folders = {}
+    # 本次新建的用户目录下不会有子目录，不需要列出
+    created = set()
+    results = ensure_folders(operator, {settings.DOC_ROOT_FOLDER_ID: set(rows)}, pool=pool, concurrency=concurrency)
+    for i, chunk in enumerate(results):
+        for (_, username), folder_id in chunk.items():
+            if isinstance(folder_id, Exception):
+                logger.warning(f'provision_roster: failed to create folder {username}: {folder_id}')
+                _save(rows[username], RosterFolder.STATUS_FAILED, error=str(folder_id))
+                continue
+            user_folders[folder_id] = username
+            if i:
+                created.add(folder_id)
+
+    parents = {folder_id: {row.folder for row in rows[username]} for folder_id, username in user_folders.items()}
+    by_key = {(row.username, row.folder): row for user_rows in rows.values() for row in user_rows}
+    results = ensure_folders(operator, parents, skip_listing=created, pool=pool, concurrency=concurrency)
+    for chunk in results:
+        done = []
+        for (parent_id, folder_name), folder_id in chunk.items():
+            row = by_key[(user_folders[parent_id], folder_name)]
+            if isinstance(folder_id, Exception):
+                _save([row], RosterFolder.STATUS_FAILED, error=str(folder_id))
+            else:
+                row.folder_id = folder_id
+                done.append(row)
+        _save(done, RosterFolder.STATUS_DONE)
+    return roster_progress(roster)
+
+
+def roster_progress(roster):
+    """
+    :return: 花名册各状态的条目数，形如：{'done': 1000, 'failed': 0, 'pending': 0}
+    """
+    progress = {status: 0 for status, _ in RosterFolder.STATUS_CHOICES}
+    for row in RosterFolder.objects.filter(roster=roster).values('status').annotate(count=Count('id')):
+        progress[row['status']] = row['count']
+    return progress
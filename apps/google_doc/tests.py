@@ -0,0 +1,2259 @@
+import asyncio
+import datetime
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httplib2
+import mock
+import requests
+from google.auth.credentials import AnonymousCredentials
+from django.apps import apps as django_apps
+from django.core.cache import caches
+from django.core.signals import request_started
+from django.db import connection
+from django.http import StreamingHttpResponse
+from django.contrib.auth.models import User
+from django.test import RequestFactory, TransactionTestCase, override_settings
+from django.utils import timezone
+from googleapiclient.errors import HttpError
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIClient
+
+from apps.google_doc.jobs import claim_next_job, requeue_stale_jobs, run_job
+from apps.google_doc import changes, cleanup, documents, folder_index, provisioning, warm_pool
+from apps.google_doc.async_views import AsyncViewsASGIHandler
+from apps.google_doc.models import CacheInvalidation, DbLock, Document, DriveChangeCursor, Job, RateLimitBucket, \
+    RosterFolder, WarmDoc
+from benchmarks.fake_google import FOLDER_MIME_TYPE, FakeDriveApi, FakeGoogleServer, FaultInjector
+from common import async_operator, metrics
+from common.api_executor import GoogleApiExecutor, get_call_timings, reset_call_timings
+from common.async_http import AsyncHttpClient
+from common.authentication import CachedTokenAuthentication, TokenCache, token_cache
+from common.credentials import SharedTokenCredentials
+from common.delete_queue import DeleteQueue
+from common.doc_cache import DocumentCache
+from common.doc_text import iter_doc_blocks
+from benchmarks.doc_text import make_document
+from common.folder_cache import FolderCache, ParentFolderCache
+from common.locks import LockTimeout, db_lock
+from common.log_queue import DroppingQueueHandler, JsonFormatter, LogQueue
+from common.logger import payload
+from common.operator_pool import GoogleDocOperatorPool
+from common.rate_limit import RateLimitedError, TokenBucket
+from common.single_flight import SingleFlight
+from common.transport import RequestsHttp
+from common.utils import DOCUMENT_MIME_TYPE, TEMP_DOC_APP_PROPERTY, DocCreateMode, GoogleDocOperator, \
+    folder_single_flight
+from maze_google_doc import settings
+
+
+class FakeRequest(object):
+    def __init__(self, fn):
+        self.fn = fn
+
+    def execute(self):
+        return self.fn()
+
+
+class FakeDriveFiles(object):
+    FOLDER_QUERY = re.compile(r"name='(?P<name>[^']*)' and '(?P<parent>[^']*)' in parents")
+
+    def __init__(self, drive):
+        self.drive = drive
+
+    def list(self, q, **kwargs):
+        def run():
+            match = self.FOLDER_QUERY.search(q)
+            time.sleep(self.drive.latency)
+            with self.drive.lock:
+                self.drive.calls['list'] += 1
+                files = [{'id': file_id, 'name': meta['name']} for file_id, meta in self.drive.files.items()
+                         if meta['name'] == match.group('name') and match.group('parent') in meta['parents']]
+            return {'files': files}
+        return FakeRequest(run)
+
+    def create(self, body, **kwargs):
+        def run():
+            time.sleep(self.drive.latency)
+            with self.drive.lock:
+                self.drive.calls['create'] += 1
+                file_id = uuid.uuid4().hex
+                self.drive.files[file_id] = {'name': body['name'], 'parents': list(body.get('parents', []))}
+            return {'id': file_id}
+        return FakeRequest(run)
+
+
+class FakeDrive(object):
+    """
+    内存中的google drive，只实现测试用到的files().list/create，每次调用会sleep latency秒放大并发窗口
+    """
+
+    def __init__(self, latency=0.02):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.files = {}
+        self.calls = {'list': 0, 'create': 0}
+
+    def files_named(self, name):
+        return [file_id for file_id, meta in self.files.items() if meta['name'] == name]
+
+    def service(self):
+        drive = self
+        return mock.Mock(files=lambda: FakeDriveFiles(drive))
+
+
+def make_operator(drive, folder_cache=None, single_flight=None):
+    operator = GoogleDocOperator.__new__(GoogleDocOperator)
+    operator.doc_service = None
+    operator.drive_service = drive.service()
+    operator.folder_cache = folder_cache if folder_cache is not None else FolderCache(alias='default')
+    operator.parent_cache = ParentFolderCache()
+    operator.single_flight = single_flight if single_flight is not None else folder_single_flight
+    operator.executor = GoogleApiExecutor(buckets={})
+    operator.doc_cache = DocumentCache()
+    operator.delete_queue = DeleteQueue(batch_size=1000)
+    return operator
+
+
+def run_concurrently(count, fn):
+    results = [None] * count
+    errors = []
+    barrier = threading.Barrier(count)
+
+    def worker(index):
+        try:
+            barrier.wait()
+            results[index] = fn(index)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+class SingleFlightTest(TransactionTestCase):
+
+    def test_concurrent_callers_share_one_execution(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.05)
+            return 'value'
+
+        results, errors = run_concurrently(16, lambda i: single_flight.do('key', slow))
+        self.assertEqual(errors, [])
+        self.assertEqual(results, ['value'] * 16)
+        self.assertEqual(len(calls), 1)
+
+    def test_error_is_shared_and_key_released(self):
+        single_flight = SingleFlight()
+
+        def fail():
+            time.sleep(0.05)
+            raise ValueError('boom')
+
+        results, errors = run_concurrently(8, lambda i: single_flight.do('key', fail))
+        self.assertEqual(len(errors), 8)
+        self.assertTrue(all(isinstance(e, ValueError) for e in errors))
+        self.assertEqual(single_flight.do('key', lambda: 'retry'), 'retry')
+
+
+class DbLockTest(TransactionTestCase):
+
+    def test_lock_is_released(self):
+        with db_lock('folder:a/b'):
+            self.assertEqual(DbLock.objects.count(), 1)
+        self.assertEqual(DbLock.objects.count(), 0)
+
+    def test_held_lock_times_out(self):
+        with db_lock('folder:a/b'):
+            with self.assertRaises(LockTimeout):
+                with db_lock('folder:a/b', timeout=0.1):
+                    pass
+
+    def test_expired_lock_is_taken_over(self):
+        with db_lock('folder:a/b', lease=-1):
+            with db_lock('folder:a/b', timeout=0.1):
+                self.assertEqual(DbLock.objects.count(), 1)
+
+    def test_lease_is_renewed_while_held(self):
+        with db_lock('idempotency:a', lease=0.3, renew=True):
+            time.sleep(0.6)
+            with self.assertRaises(LockTimeout):
+                with db_lock('idempotency:a', timeout=0.1):
+                    pass
+        self.assertEqual(DbLock.objects.count(), 0)
+
+
+class FolderCacheTest(TransactionTestCase):
+    """
+    目录缓存的命中、未命中和失效
+    """
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_miss_then_hit(self):
+        folder_cache = FolderCache(alias='default', local_maxsize=10, local_ttl=60)
+        self.assertIsNone(folder_cache.get('root', 'student1'))
+        folder_cache.set('root', 'student1', 'folder1')
+        self.assertEqual(folder_cache.get('root', 'student1'), 'folder1')
+        # 其他进程从共享层读到后放入自己的进程内缓存
+        other_process = FolderCache(alias='default', local_maxsize=10, local_ttl=60)
+        self.assertEqual(other_process.get('root', 'student1'), 'folder1')
+        caches['default'].clear()
+        self.assertEqual(other_process.get('root', 'student1'), 'folder1')
+        self.assertIsNone(FolderCache(alias='default', local_maxsize=0).get('root', 'student1'))
+
+    def test_names_are_hashed_into_keys(self):
+        folder_cache = FolderCache(alias='default')
+        folder_cache.set('root', '学生 1', 'folder1')
+        self.assertEqual(folder_cache.get('root', '学生 1'), 'folder1')
+        self.assertIsNone(folder_cache.get('other-root', '学生 1'))
+        self.assertRegex(folder_cache.make_key('root', '学生 1'), r'^google_doc:folder:[0-9a-f]{40}$')
+
+    def test_delete_invalidates_both_tiers(self):
+        folder_cache = FolderCache(alias='default', local_maxsize=10, local_ttl=60)
+        folder_cache.set('root', 'student1', 'folder1')
+        folder_cache.delete('root', 'student1')
+        self.assertIsNone(folder_cache.get('root', 'student1'))
+
+    def test_invalidate_path(self):
+        folder_cache = FolderCache(alias='default', local_maxsize=10, local_ttl=60)
+        folder_cache.set('root', 'student1', 'folder1')
+        folder_cache.set('folder1', 'essay', 'folder2')
+        folder_cache.set('root', 'student2', 'folder3')
+        self.assertEqual(folder_cache.resolve_path(['student1', 'essay'], 'root'), 'folder2')
+        folder_cache.invalidate_path(['student1', 'essay'], 'root')
+        self.assertEqual([folder_cache.get('root', 'student1'), folder_cache.get('folder1', 'essay')], [None, None])
+        self.assertIsNone(folder_cache.resolve_path(['student1', 'essay'], 'root'))
+        self.assertEqual(folder_cache.get('root', 'student2'), 'folder3')
+
+    def test_cached_path_needs_no_drive_calls(self):
+        drive = FakeDrive(latency=0)
+        folder_cache = FolderCache(alias='default')
+        folder_id = make_operator(drive, folder_cache).get_or_create_folder(['student3', 'essay'])
+        calls = dict(drive.calls)
+        self.assertEqual(make_operator(drive, folder_cache).get_or_create_folder(['student3', 'essay']), folder_id)
+        self.assertEqual(drive.calls, calls)
+
+
+class ConcurrentFolderCreationTest(TransactionTestCase):
+    """
+    多线程并发请求同一个新学生的目录时，每层目录只能被创建一次
+    """
+    THREADS = 16
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_single_flight_in_one_process(self):
+        drive = FakeDrive()
+        folder_cache = FolderCache(alias='default')
+        with mock.patch.object(settings, 'FOLDER_DB_LOCK_ENABLED', False):
+            results, errors = run_concurrently(
+                self.THREADS,
+                lambda i: make_operator(drive, folder_cache).get_or_create_folder(['student1', 'essay']))
+        self.assertEqual(errors, [])
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(len(drive.files_named('student1')), 1)
+        self.assertEqual(len(drive.files_named('essay')), 1)
+        self.assertEqual(drive.calls['create'], 2)
+
+    def test_db_lock_across_workers(self):
+        # 每个线程使用独立的SingleFlight且不共享缓存，模拟不同的worker进程，只有数据库锁能阻止重复创建
+        drive = FakeDrive()
+        no_cache = mock.Mock(get=mock.Mock(return_value=None))
+        results, errors = run_concurrently(
+            self.THREADS,
+            lambda i: make_operator(drive, no_cache, SingleFlight()).get_or_create_folder(['student2', 'essay']))
+        self.assertEqual(errors, [])
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(len(drive.files_named('student2')), 1)
+        self.assertEqual(len(drive.files_named('essay')), 1)
+        self.assertEqual(DbLock.objects.count(), 0)
+
+
+def not_found_error():
+    return HttpError(httplib2.Response({'status': 404}), b'{"error": {"code": 404}}')
+
+
+def rate_limit_error(status=403, reason='userRateLimitExceeded'):
+    content = {'error': {'code': status, 'errors': [{'domain': 'usageLimits', 'reason': reason}]}}
+    return HttpError(httplib2.Response({'status': status}), json.dumps(content).encode())
+
+
+class TokenBucketTest(TransactionTestCase):
+
+    def test_burst_then_wait(self):
+        bucket = TokenBucket('drive', rate=10, capacity=2, local_reserve=1)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1, delta=0.02)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, delta=0.02)
+
+    def test_bucket_is_shared_between_processes(self):
+        # 两个同名令牌桶相当于两个worker进程
+        first = TokenBucket('drive', rate=10, capacity=4, local_reserve=4)
+        second = TokenBucket('drive', rate=10, capacity=4, local_reserve=4)
+        self.assertEqual(first.reserve(), 0)
+        self.assertGreater(second.reserve(), 0)
+        self.assertEqual(first.reserve(), 0)
+        self.assertEqual(RateLimitBucket.objects.get(name='drive').version, 2)
+
+    def test_max_wait(self):
+        bucket = TokenBucket('docs', rate=1, capacity=1, local_reserve=1)
+        bucket.reserve()
+        with self.assertRaises(RateLimitedError) as cm:
+            bucket.reserve(max_wait=0.5)
+        self.assertGreater(cm.exception.retry_after, 0.5)
+
+    def test_shared_bucket_is_not_accessed_under_lock(self):
+        bucket = TokenBucket('drive', rate=100, capacity=100, local_reserve=5)
+        bucket.reserve()
+        entered, release = threading.Event(), threading.Event()
+        take_shared = bucket._take_shared
+
+        def slow_take_shared(*args):
+            entered.set()
+            release.wait(5)
+            return take_shared(*args)
+
+        with mock.patch.object(bucket, '_take_shared', side_effect=slow_take_shared):
+            # batch请求需要的令牌超过预取的，正在访问数据库
+            thread = threading.Thread(target=bucket.reserve, args=(10,))
+            thread.start()
+            self.assertTrue(entered.wait(5))
+            start = time.monotonic()
+            self.assertEqual(bucket.reserve(), 0)
+            self.assertLess(time.monotonic() - start, 1)
+            release.set()
+            thread.join()
+
+    def test_concurrent_refills_are_coalesced(self):
+        bucket = TokenBucket('drive', rate=100, capacity=100, local_reserve=8)
+        with mock.patch.object(bucket, '_take_shared', wraps=bucket._take_shared) as take_shared:
+            results, errors = run_concurrently(8, lambda i: bucket.reserve())
+        self.assertEqual((errors, results), ([], [0] * 8))
+        self.assertEqual(take_shared.call_count, 1)
+
+
+class GoogleApiExecutorTest(TransactionTestCase):
+
+    def setUp(self):
+        self.executor = GoogleApiExecutor(buckets={}, max_attempts=2, backoff_base=0.001, backoff_max=0.01)
+        self.request = mock.Mock(methodId='drive.files.create')
+        reset_call_timings()
+
+    def test_rate_limit_errors_are_retried(self):
+        self.request.execute.side_effect = [rate_limit_error(), rate_limit_error(429), {'id': 'doc1'}]
+        self.assertEqual(self.executor.execute(self.request), {'id': 'doc1'})
+        timings = get_call_timings()
+        self.assertEqual((timings.calls, timings.retries), (3, 2))
+
+    def test_other_errors_are_not_retried(self):
+        self.request.execute.side_effect = [rate_limit_error(403, 'insufficientFilePermissions'), {'id': 'doc1'}]
+        with self.assertRaises(HttpError):
+            self.executor.execute(self.request)
+        self.assertEqual(self.request.execute.call_count, 1)
+
+    def test_exhausted_retries_raise_rate_limited(self):
+        self.request.execute.side_effect = rate_limit_error(429)
+        with self.assertRaises(RateLimitedError):
+            self.executor.execute(self.request)
+        self.assertEqual(self.request.execute.call_count, 3)
+
+    def test_server_errors_are_retried_only_for_idempotent_methods(self):
+        self.request.execute.side_effect = [rate_limit_error(503, 'backendError'), {'id': 'doc1'}]
+        with self.assertRaises(HttpError):
+            self.executor.execute(self.request)
+        self.assertEqual(self.request.execute.call_count, 1)
+
+        request = mock.Mock(methodId='drive.files.get')
+        request.execute.side_effect = [rate_limit_error(503, 'backendError'), {'id': 'doc1'}]
+        self.assertEqual(self.executor.execute(request), {'id': 'doc1'})
+        self.assertEqual(request.execute.call_count, 2)
+
+    def test_limiter_wait_is_recorded(self):
+        executor = GoogleApiExecutor(buckets={'drive': TokenBucket('drive', rate=20, capacity=1, local_reserve=1)})
+        self.request.execute.return_value = {}
+        executor.execute(self.request)
+        executor.execute(self.request)
+        self.assertGreater(get_call_timings().limiter_wait, 0.03)
+
+    def test_rate_limited_batch_items_are_retried(self):
+        create_file = FakeDriveApi.create_file
+        failures = []
+
+        def flaky_create_file(api, body):
+            if len(failures) < 2:
+                failures.append(body['name'])
+                return 403, {'error': {'code': 403, 'errors': [{'reason': 'userRateLimitExceeded'}]}}
+            return create_file(api, body)
+
+        with FakeGoogleServer() as server, \
+                mock.patch.object(settings, 'GOOGLE_API_ROOT_URL', server.root_url), \
+                mock.patch.object(FakeDriveApi, 'create_file', flaky_create_file):
+            operator = GoogleDocOperator(credentials=AnonymousCredentials(), folder_cache=FolderCache(alias='default'))
+            operator.executor = self.executor
+            doc_ids = operator.create_blank_docs('root', 4)
+            self.assertEqual(len(doc_ids), 4)
+            self.assertEqual(server.state.calls['batch'], 2)
+
+    def test_rate_limited_batch_keeps_earlier_results(self):
+        with FakeGoogleServer() as server, \
+                mock.patch.object(settings, 'GOOGLE_API_ROOT_URL', server.root_url), \
+                mock.patch.object(settings, 'GOOGLE_BATCH_SIZE', 2), \
+                mock.patch.object(self.executor, '_acquire', side_effect=[0.0, RateLimitedError('limited'), 0.0]):
+            operator = GoogleDocOperator(credentials=AnonymousCredentials(), folder_cache=FolderCache(alias='default'))
+            operator.executor = self.executor
+            requests = [(i, operator.drive_service.files().create(body={'name': f'doc{i}'}, fields='id'))
+                        for i in range(5)]
+            results = self.executor.execute_batch(operator.drive_service, requests)
+            self.assertEqual(sorted(results), list(range(5)))
+            for i in (0, 1, 4):
+                self.assertIn(results[i]['id'], server.state.files)
+            for i in (2, 3):
+                self.assertIsInstance(results[i], RateLimitedError)
+            self.assertEqual(server.state.calls['batch'], 2)
+
+
+class FakeTokenSource(object):
+    """
+    代替service_account.Credentials，每次refresh生成新token并计数
+    """
+    service_account_email = 'test@test.iam.gserviceaccount.com'
+    scopes = GoogleDocOperator.SCOPES
+
+    def __init__(self, lifetime=3600):
+        self.lifetime = lifetime
+        self.refreshes = 0
+        self.token = None
+        self.expiry = None
+
+    def refresh(self, request):
+        self.refreshes += 1
+        self.token = f'token-{uuid.uuid4().hex}'
+        self.expiry = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.lifetime)
+
+
+class SharedTokenCredentialsTest(TransactionTestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_token_is_shared_between_processes(self):
+        source = FakeTokenSource()
+        first = SharedTokenCredentials(source, alias='default')
+        first.refresh(None)
+        # 另一个进程中新建的凭证直接使用缓存中的token
+        second = SharedTokenCredentials(FakeTokenSource(), alias='default')
+        second.refresh(None)
+        self.assertTrue(second.valid)
+        self.assertEqual(second.token, first.token)
+        self.assertEqual(second.source.refreshes, 0)
+        self.assertEqual(source.refreshes, 1)
+
+    def test_rejected_token_is_refreshed(self):
+        credentials = SharedTokenCredentials(FakeTokenSource(), alias='default')
+        credentials.refresh(None)
+        token = credentials.token
+        # token在有效期内仍被要求刷新(google返回401)
+        credentials.refresh(None)
+        self.assertNotEqual(credentials.token, token)
+        self.assertEqual(credentials.source.refreshes, 2)
+
+    def test_refresh_before_expiry(self):
+        credentials = SharedTokenCredentials(FakeTokenSource(lifetime=300), alias='default')
+        self.assertTrue(credentials.refresh_if_expiring(None, margin=600))
+        self.assertTrue(credentials.refresh_if_expiring(None, margin=600))
+        self.assertFalse(credentials.refresh_if_expiring(None, margin=60))
+        self.assertEqual(credentials.source.refreshes, 2)
+
+
+class OperatorPoolTest(TransactionTestCase):
+    """
+    operator的复用、并发checkout和fork后的重置
+    """
+
+    def setUp(self):
+        self.created = []
+
+        def create(*args, **kwargs):
+            operator = mock.Mock()
+            self.created.append(operator)
+            return operator
+
+        patcher = mock.patch('common.operator_pool.GoogleDocOperator', side_effect=create)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = GoogleDocOperatorPool(max_idle=2, credentials=AnonymousCredentials())
+
+    def test_checkout_reuses_operator(self):
+        with self.pool.checkout() as first:
+            pass
+        with self.pool.checkout() as second:
+            self.assertEqual(self.pool.idle_count(), 0)
+        self.assertIs(first, second)
+        self.assertEqual((len(self.created), self.pool.idle_count()), (1, 1))
+
+    def test_operator_is_returned_on_error(self):
+        with self.assertRaises(ValueError):
+            with self.pool.checkout():
+                raise ValueError('boom')
+        self.assertEqual(self.pool.idle_count(), 1)
+
+    def test_idle_operators_are_limited(self):
+        operators = [self.pool.acquire() for _ in range(3)]
+        self.assertEqual(len(set(map(id, operators))), 3)
+        for operator in operators:
+            self.pool.release(operator)
+        self.assertEqual(self.pool.idle_count(), 2)
+
+    def test_concurrent_checkout(self):
+        in_use = set()
+        lock = threading.Lock()
+        shared = []
+
+        def work(i):
+            for _ in range(50):
+                with self.pool.checkout() as operator:
+                    with lock:
+                        if operator in in_use:
+                            shared.append(operator)
+                        in_use.add(operator)
+                    time.sleep(0.0005)
+                    with lock:
+                        in_use.discard(operator)
+
+        results, errors = run_concurrently(8, work)
+        self.assertEqual(errors, [])
+        # 同一operator不会同时被两个线程使用，最多同时存在8个
+        self.assertEqual(shared, [])
+        self.assertLessEqual(len(self.created), 8)
+        self.assertEqual(self.pool.idle_count(), 2)
+
+    def test_reset_after_fork(self):
+        parent_operator = self.pool.acquire()
+        self.pool.release(parent_operator)
+        with mock.patch('common.operator_pool.os.getpid', return_value=os.getpid() + 1), \
+                mock.patch('common.operator_pool.reset_shared_adapter') as reset_shared_adapter:
+            child_operator = self.pool.acquire()
+            self.assertIsNot(child_operator, parent_operator)
+            reset_shared_adapter.assert_called_once_with()
+            self.pool.release(child_operator)
+            self.assertIs(self.pool.acquire(), child_operator)
+        # 回到父进程pid后归还的operator不再放回池中
+        self.pool.release(parent_operator)
+        self.assertEqual(self.pool.idle_count(), 0)
+
+
+class CreateDocTest(TransactionTestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.folder_cache = FolderCache(alias='default')
+        self.folder_cache.set(settings.DOC_ROOT_FOLDER_ID, 'student1', 'user-folder')
+        self.folder_cache.set('user-folder', 'essay', 'essay-folder')
+        self.operator = make_operator(FakeDrive(), self.folder_cache)
+        self.operator.drive_service = mock.MagicMock()
+        self.operator.doc_service = mock.MagicMock()
+        self.files = self.operator.drive_service.files.return_value
+
+    def test_drive_create_is_one_call(self):
+        self.files.create.return_value.execute.return_value = {'id': 'doc1', 'webViewLink': 'link1'}
+        result = self.operator.create_doc('title', 'student1', 'essay', mode=DocCreateMode.DRIVE_CREATE)
+        self.assertEqual(result, ('doc1', 'link1'))
+        self.files.create.assert_called_once_with(
+            body={'name': 'title', 'mimeType': DOCUMENT_MIME_TYPE, 'parents': ['essay-folder']},
+            fields='id,webViewLink')
+        self.assertEqual(self.files.copy.call_count + self.files.delete.call_count + self.files.get.call_count, 0)
+        self.operator.doc_service.documents.assert_not_called()
+
+    def test_stale_folder_is_invalidated_and_retried(self):
+        self.files.create.return_value.execute.side_effect = [
+            not_found_error(), {'id': 'new-essay-folder'}, {'id': 'doc1', 'webViewLink': 'link1'}]
+        self.files.list.return_value.execute.side_effect = [{'files': [{'id': 'user-folder'}]}, {'files': []}]
+        with mock.patch.object(settings, 'FOLDER_DB_LOCK_ENABLED', False):
+            result = self.operator.create_doc('title', 'student1', 'essay', mode=DocCreateMode.DRIVE_CREATE)
+        self.assertEqual(result, ('doc1', 'link1'))
+        self.assertEqual(self.files.create.call_args.kwargs['body']['parents'], ['new-essay-folder'])
+        self.assertEqual(self.folder_cache.get('user-folder', 'essay'), 'new-essay-folder')
+
+    def test_copy_mode_deletes_temporary_doc(self):
+        self.operator.doc_service.documents.return_value.create.return_value.execute.return_value = {
+            'documentId': 'tmp'}
+        self.files.copy.return_value.execute.return_value = {'id': 'doc1'}
+        self.files.get.return_value.execute.return_value = {'webViewLink': 'link1'}
+        result = self.operator.create_doc('title', 'student1', 'essay', mode=DocCreateMode.DOCS_COPY)
+        self.assertEqual(result, ('doc1', 'link1'))
+        # 临时文档带有标记，sweep_orphan_docs只清理带标记的文档；拷贝出的文档清除该标记
+        self.files.update.assert_called_once_with(
+            fileId='tmp', body={'appProperties': {'mazeGoogleDocTemp': 'true'}}, fields='id')
+        self.files.copy.assert_called_once_with(fileId='tmp', body={
+            'name': 'title', 'parents': ['essay-folder'], 'appProperties': {'mazeGoogleDocTemp': None}})
+        # 临时文档由删除队列在后台删除
+        self.files.delete.assert_not_called()
+        self.assertEqual(list(self.operator.delete_queue._pending), ['tmp'])
+        self.operator.delete_queue._pending.clear()
+
+        with mock.patch.object(settings, 'DELETE_QUEUE_ENABLED', False):
+            self.operator.create_doc('title', 'student1', 'essay', mode=DocCreateMode.DOCS_COPY)
+        self.files.delete.assert_called_once_with(fileId='tmp')
+
+
+class MakeCopyTest(TransactionTestCase):
+
+    def setUp(self):
+        self.operator = make_operator(FakeDrive())
+        self.operator.drive_service = mock.MagicMock()
+        self.files = self.operator.drive_service.files.return_value
+        self.files.get.return_value.execute.return_value = {'parents': ['template-folder']}
+        self.files.copy.return_value.execute.return_value = {
+            'id': 'copy1', 'webViewLink': 'link1', 'parents': ['template-folder']}
+
+    def drive_calls(self):
+        return self.files.get.call_count + self.files.copy.call_count
+
+    def test_copy_returns_link_from_copy_response(self):
+        self.assertEqual(self.operator.make_copy('template', 'title'), ('copy1', 'link1'))
+        self.assertEqual(self.drive_calls(), 2)
+        self.files.copy.assert_called_once_with(
+            fileId='template', body={'name': 'title', 'parents': ['template-folder']},
+            fields='id,webViewLink,parents')
+
+    def test_hot_template_costs_one_call(self):
+        self.operator.make_copy('template', 'title1')
+        self.files.get.reset_mock()
+        self.files.copy.reset_mock()
+        for i in range(5):
+            self.assertEqual(self.operator.make_copy('template', f'title{i}'), ('copy1', 'link1'))
+        self.assertEqual(self.files.get.call_count, 0)
+        self.assertEqual(self.files.copy.call_count, 5)
+
+    def test_stale_cached_parent_is_refreshed(self):
+        self.operator.parent_cache.set('template', ['deleted-folder'])
+        self.files.copy.return_value.execute.side_effect = [
+            not_found_error(), {'id': 'copy1', 'webViewLink': 'link1', 'parents': ['template-folder']}]
+        self.assertEqual(self.operator.make_copy('template', 'title'), ('copy1', 'link1'))
+        self.assertEqual(self.files.get.call_count, 1)
+        self.assertEqual(self.files.copy.call_args.kwargs['body']['parents'], ['template-folder'])
+        self.assertEqual(self.operator.parent_cache.get('template'), ['template-folder'])
+
+
+class CreateDocsTest(TransactionTestCase):
+    """
+    通过本地替身服务验证batch请求的批量创建
+    """
+
+    def setUp(self):
+        caches['default'].clear()
+        self.server = FakeGoogleServer().start()
+        self.addCleanup(self.server.stop)
+        for name, value in (('GOOGLE_API_ROOT_URL', self.server.root_url), ('GOOGLE_BATCH_SIZE', 3)):
+            patcher = mock.patch.object(settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.server.state.add_file('root', FOLDER_MIME_TYPE, file_id=settings.DOC_ROOT_FOLDER_ID)
+        self.operator = GoogleDocOperator(credentials=AnonymousCredentials(), folder_cache=FolderCache(alias='default'))
+
+    def test_results_keep_input_order(self):
+        items = [{'username': f'student{i % 2}', 'folder': 'essay', 'title': f'doc{i}'} for i in range(7)]
+        results = self.operator.create_docs(items)
+        self.assertEqual(len(results), 7)
+        for item, (doc_id, web_link) in zip(items, results):
+            self.assertEqual(self.server.state.files[doc_id]['name'], item['title'])
+            self.assertIn(doc_id, web_link)
+        self.assertEqual(self.server.state.calls['batch'], 3)
+        self.assertEqual(self.server.state.calls['files.list'], 4)
+
+    def test_per_item_errors(self):
+        resolve = self.operator.get_or_create_folder
+
+        def get_or_create_folder(folder_list, *args):
+            if folder_list[0] == 'bad':
+                raise ValueError('boom')
+            return resolve(folder_list, *args)
+
+        with mock.patch.object(self.operator, 'get_or_create_folder', side_effect=get_or_create_folder):
+            results = self.operator.create_docs([
+                {'username': 'bad', 'folder': 'essay', 'title': 'doc0'},
+                {'username': 'student0', 'folder': 'essay', 'title': 'doc1'},
+            ])
+        self.assertIsInstance(results[0], ValueError)
+        self.assertEqual(self.server.state.files[results[1][0]]['name'], 'doc1')
+
+    def test_stale_folder_is_retried(self):
+        self.operator.folder_cache.set(settings.DOC_ROOT_FOLDER_ID, 'student0', 'missing-folder')
+        self.operator.folder_cache.set('missing-folder', 'essay', 'missing-essay-folder')
+        doc_id, _ = self.operator.create_docs([{'username': 'student0', 'folder': 'essay', 'title': 'doc0'}])[0]
+        self.assertEqual(self.server.state.files[doc_id]['name'], 'doc0')
+        self.assertEqual(self.server.state.calls['batch'], 2)
+
+
+class BulkNewDocViewTest(TransactionTestCase):
+    """
+    POST /api/v1/new_docs/
+    """
+
+    def setUp(self):
+        caches['default'].clear()
+        self.server = FakeGoogleServer().start()
+        self.addCleanup(self.server.stop)
+        for patcher in (mock.patch.object(settings, 'GOOGLE_API_ROOT_URL', self.server.root_url),
+                        mock.patch.object(settings, 'GOOGLE_BATCH_SIZE', 2),
+                        mock.patch('common.utils.default_folder_cache', FolderCache(alias='default')),
+                        mock.patch('apps.google_doc.views.operator_pool',
+                                   GoogleDocOperatorPool(credentials=AnonymousCredentials()))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.server.state.add_file('root', FOLDER_MIME_TYPE, file_id=settings.DOC_ROOT_FOLDER_ID)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('teacher'))
+
+    def post(self, data):
+        return self.client.post('/api/v1/new_docs/', data, format='json').json()
+
+    def test_results_keep_input_order(self):
+        docs = [{'username': f'student{i % 2}', 'folder': 'essay', 'title': f'doc{i}'} for i in range(5)]
+        docs[1:1] = [{'username': 'student0', 'folder': 'essay'}, 'doc']
+        result = self.post({'docs': docs})
+        self.assertEqual(result['code'], 200)
+        results = result['data']['results']
+        self.assertEqual(len(results), 7)
+        self.assertEqual(results[1], {'code': 400, 'message': 'title is required'})
+        self.assertEqual(results[2], {'code': 400, 'message': 'each doc should be an object'})
+        for doc, item in zip(docs, results):
+            if item['code'] == 200:
+                self.assertEqual(self.server.state.files[item['doc_id']]['name'], doc['title'])
+        self.assertEqual([item['code'] for item in results], [200, 400, 400, 200, 200, 200, 200])
+        self.assertEqual(sorted(Document.objects.filter(kind=Document.KIND_NEW_DOC).values_list('title', flat=True)),
+                         [f'doc{i}' for i in range(5)])
+
+    def test_failing_item_does_not_fail_batch(self):
+        resolve = GoogleDocOperator.get_or_create_folder
+
+        def get_or_create_folder(operator, folder_list, *args):
+            if folder_list[0] == 'bad':
+                raise ValueError('boom')
+            if folder_list[0] == 'limited':
+                raise RateLimitedError('limited', retry_after=1)
+            return resolve(operator, folder_list, *args)
+
+        docs = [{'username': username, 'folder': 'essay', 'title': f'doc{i}'}
+                for i, username in enumerate(['student0', 'bad', 'limited', 'student1'])]
+        with mock.patch.object(GoogleDocOperator, 'get_or_create_folder', autospec=True,
+                               side_effect=get_or_create_folder):
+            result = self.post({'docs': docs})
+        self.assertEqual(result['code'], 200)
+        self.assertEqual([item['code'] for item in result['data']['results']], [200, 500, 429, 200])
+        self.assertEqual(Document.objects.count(), 2)
+
+    @override_settings(BULK_NEW_DOC_MAX_ITEMS=2)
+    def test_invalid_request(self):
+        for data in ({}, {'docs': []}, {'docs': {'username': 'student0'}}):
+            self.assertEqual(self.post(data), {'code': 400, 'message': 'invalid value of docs'})
+        doc = {'username': 'student0', 'folder': 'essay', 'title': 'doc'}
+        self.assertEqual(self.post({'docs': [doc] * 3}), {'code': 400, 'message': 'at most 2 docs per request'})
+        self.assertNotIn('files.create', self.server.state.calls)
+        self.assertEqual(Document.objects.count(), 0)
+
+
+@override_settings(BULK_COPY_DOC_BATCH_SIZE=2)
+class BulkCopyDocViewTest(TransactionTestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.server = FakeGoogleServer().start()
+        self.addCleanup(self.server.stop)
+        for patcher in (mock.patch.object(settings, 'GOOGLE_API_ROOT_URL', self.server.root_url),
+                        mock.patch('common.utils.default_folder_cache', FolderCache(alias='default')),
+                        mock.patch('apps.google_doc.views.operator_pool',
+                                   GoogleDocOperatorPool(credentials=AnonymousCredentials()))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.server.state.add_file('root', FOLDER_MIME_TYPE, file_id=settings.DOC_ROOT_FOLDER_ID)
+        self.template_folder = self.server.state.add_file('templates', FOLDER_MIME_TYPE)['id']
+        self.template = self.server.state.add_file('template', parents=[self.template_folder])['id']
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('teacher'))
+
+    def post(self, data):
+        response = self.client.post('/api/v1/copy_doc/bulk/', data, format='json')
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, content
+
+    def test_streams_one_line_per_copy(self):
+        copies = [{'title': f'copy{i}'} for i in range(5)] + [
+            {'title': 'copy5', 'username': 'student1', 'folder': 'essay'}]
+        response, content = self.post({'source_doc_id': self.template, 'copies': copies})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual(sorted(line['index'] for line in lines), list(range(6)))
+        for line in lines:
+            self.assertEqual(line['code'], 200)
+            copied = self.server.state.files[line['target_doc_id']]
+            self.assertEqual(copied['name'], copies[line['index']]['title'])
+            if line['index'] < 5:
+                self.assertEqual(copied['parents'], [self.template_folder])
+        self.assertEqual(self.server.state.calls['files.get'], 1)
+        self.assertEqual(self.server.state.calls['batch'], 3)
+
+    def test_invalid_request(self):
+        response, content = self.post({'source_doc_id': self.template, 'copies': [{'username': 'x'}]})
+        self.assertEqual(json.loads(content)['code'], 400)
+
+
+class DocViewTest(TransactionTestCase):
+
+    def setUp(self):
+        self.operator = make_operator(FakeDrive())
+        self.operator.drive_service = mock.MagicMock()
+        self.operator.doc_service = mock.MagicMock()
+        self.metadata = self.operator.drive_service.files.return_value.get.return_value.execute
+        self.metadata.return_value = {'version': '7', 'modifiedTime': '2023-06-01T08:00:00.000Z'}
+        self.document = self.operator.doc_service.documents.return_value.get.return_value.execute
+        self.document.return_value = {'documentId': 'doc1', 'title': '文书', 'revisionId': 'rev1'}
+        patcher = mock.patch('apps.google_doc.views.operator_pool.acquire', return_value=self.operator)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('teacher'))
+
+    def get(self, **headers):
+        return self.client.get('/api/v1/doc/doc1/', **headers)
+
+    def test_unchanged_doc_is_served_from_cache(self):
+        response = self.get()
+        self.assertEqual(response['ETag'], '"rev1"')
+        self.assertEqual(response.json(), {'code': 200, 'message': 'ok', 'data': self.document.return_value})
+        self.assertEqual(self.get().json()['data']['title'], '文书')
+        self.assertEqual(self.document.call_count, 1)
+        self.assertEqual(self.metadata.call_count, 2)
+        self.operator.drive_service.files.return_value.get.assert_called_with(
+            fileId='doc1', fields='version,modifiedTime')
+
+    def test_if_none_match(self):
+        self.get()
+        response = self.get(HTTP_IF_NONE_MATCH='"other", W/"rev1"')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(self.document.call_count, 1)
+
+    def test_changed_doc_is_refetched(self):
+        self.get()
+        self.metadata.return_value = {'version': '8'}
+        self.document.return_value = {'documentId': 'doc1', 'revisionId': 'rev2'}
+        response = self.get(HTTP_IF_NONE_MATCH='"rev1"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], '"rev2"')
+        self.assertEqual(self.document.call_count, 2)
+
+    def test_cache_is_bounded_by_bytes(self):
+        cache = DocumentCache(max_bytes=100, max_doc_bytes=60)
+        cache.set('a', '1', {'text': 'a' * 30})
+        cache.set('b', '1', {'text': 'b' * 30})
+        self.assertIsNotNone(cache.get('a', '1'))
+        cache.set('c', '1', {'text': 'c' * 30})
+        # b最久未使用，被淘汰
+        self.assertIsNone(cache.get('b', '1'))
+        self.assertIsNotNone(cache.get('a', '1'))
+        self.assertLessEqual(cache.size, 100)
+        cache.set('d', '1', {'text': 'd' * 80})
+        self.assertIsNone(cache.get('d', '1'))
+        self.assertIsNone(cache.get('a', '2'))
+
+
+class DocTextTest(TransactionTestCase):
+
+    def paragraph(self, text, start_index, style='NORMAL_TEXT', **extra):
+        paragraph = dict({'elements': [{'textRun': {'content': text}}], 'paragraphStyle': {'namedStyleType': style}},
+                         **extra)
+        return {'startIndex': start_index, 'paragraph': paragraph}
+
+    def test_blocks_in_document_order(self):
+        cell = {'content': [self.paragraph('cell\n', 30)]}
+        document = {'body': {'content': [
+            {'sectionBreak': {}},
+            self.paragraph('Title\n', 1, 'HEADING_1'),
+            self.paragraph('\n', 7),
+            self.paragraph('Body text\n', 8),
+            self.paragraph('Point\n', 18, bullet={'nestingLevel': 1}),
+            {'startIndex': 25, 'table': {'tableRows': [{'tableCells': [cell, {'content': []}]}]}},
+        ]}}
+        self.assertEqual(list(iter_doc_blocks(document)), [
+            {'type': 'heading', 'text': 'Title', 'start_index': 1, 'level': 1},
+            {'type': 'paragraph', 'text': 'Body text', 'start_index': 8},
+            {'type': 'list_item', 'text': 'Point', 'start_index': 18, 'level': 1},
+            {'type': 'table_cell', 'text': 'cell', 'start_index': 25, 'table': 25, 'row': 0, 'column': 0},
+            {'type': 'table_cell', 'text': '', 'start_index': 25, 'table': 25, 'row': 0, 'column': 1},
+        ])
+
+    def test_streaming_endpoint(self):
+        operator = make_operator(FakeDrive())
+        operator.drive_service = mock.MagicMock()
+        operator.drive_service.files.return_value.get.return_value.execute.return_value = {'version': '1'}
+        operator.doc_service = mock.MagicMock()
+        document = make_document(200 * 1024)
+        operator.doc_service.documents.return_value.get.return_value.execute.return_value = document
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('teacher'))
+        with mock.patch('apps.google_doc.views.operator_pool.acquire', return_value=operator):
+            response = client.get('/api/v1/doc/doc1/text/', {'output': 'ndjson'})
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            chunks = list(response.streaming_content)
+            self.assertGreater(len(chunks), 1)
+            lines = b''.join(chunks).decode().splitlines()
+            self.assertEqual([json.loads(line) for line in lines], list(iter_doc_blocks(document)))
+
+            response = client.get('/api/v1/doc/doc1/text/')
+            self.assertTrue(b''.join(response.streaming_content).decode().startswith('第1部分'))
+            self.assertEqual(client.get('/api/v1/doc/doc1/text/', {'output': 'pdf'}).json()['code'], 400)
+
+
+class DriveChangesTest(TransactionTestCase):
+    """
+    通过替身服务的changes feed验证缓存的增量失效
+    """
+
+    def setUp(self):
+        caches['default'].clear()
+        self.server = FakeGoogleServer().start()
+        self.addCleanup(self.server.stop)
+        for patcher in (mock.patch.object(settings, 'GOOGLE_API_ROOT_URL', self.server.root_url),
+                        mock.patch.object(settings, 'FOLDER_DB_LOCK_ENABLED', False),
+                        mock.patch.object(settings, 'DRIVE_CHANGES_ENABLED', True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.server.state.add_file('root', FOLDER_MIME_TYPE, file_id=settings.DOC_ROOT_FOLDER_ID)
+        self.operator = GoogleDocOperator(credentials=AnonymousCredentials(), folder_cache=FolderCache(alias='default'))
+        self.operator.parent_cache = ParentFolderCache(alias='default')
+        self.operator.doc_cache = DocumentCache()
+        self.student_id = self.operator.get_or_create_folder(['student1'])
+        self.essay_id = self.operator.get_or_create_folder(['student1', 'essay'])
+        self.assertEqual(changes.poll_changes(self.operator), 0)
+
+    def update(self, file_id, **body):
+        self.operator.drive_service.files().update(fileId=file_id, body=body).execute()
+
+    def test_first_poll_saves_start_token(self):
+        self.assertEqual(DriveChangeCursor.objects.get(name='drive').page_token,
+                         str(len(self.server.state.changes) + 1))
+        self.assertEqual(changes.poll_changes(self.operator), 0)
+
+    def test_renamed_folder(self):
+        self.update(self.essay_id, name='essays')
+        self.assertEqual(changes.poll_changes(self.operator), 1)
+        folder_cache = self.operator.folder_cache
+        self.assertIsNone(folder_cache.get(self.student_id, 'essay'))
+        self.assertEqual(folder_cache.get(self.student_id, 'essays'), self.essay_id)
+        self.assertTrue(CacheInvalidation.objects.filter(
+            kind=CacheInvalidation.KIND_FOLDER, key=folder_cache.make_key(self.student_id, 'essay')).exists())
+
+        calls = self.server.state.calls['files.list']
+        self.assertNotEqual(self.operator.get_or_create_folder(['student1', 'essay']), self.essay_id)
+        self.assertEqual(self.server.state.calls['files.list'], calls + 1)
+
+    def test_deleted_folder(self):
+        self.operator.drive_service.files().delete(fileId=self.student_id).execute()
+        self.assertEqual(changes.poll_changes(self.operator), 1)
+        self.assertIsNone(self.operator.folder_cache.get(settings.DOC_ROOT_FOLDER_ID, 'student1'))
+        self.assertEqual(self.operator.folder_cache.get(self.student_id, 'essay'), self.essay_id)
+
+    def test_changed_doc(self):
+        doc = self.server.state.add_file('doc', parents=[self.essay_id])
+        outside = self.server.state.add_file('other', parents=['elsewhere'])
+        for file_id in (doc['id'], outside['id']):
+            self.operator.parent_cache.set(file_id, ['parent'])
+            self.operator.doc_cache.set(file_id, '1', {'revisionId': 'r1'})
+        self.update(doc['id'], trashed=True)
+        self.update(outside['id'], name='renamed')
+        # 没有被缓存的文件(如新建的文档)不产生失效通知
+        created = self.server.state.add_file('created', parents=[self.essay_id])
+
+        self.assertEqual(changes.poll_changes(self.operator), 5)
+        # 根目录外的文件(如模板)同样失效
+        for file_id in (doc['id'], outside['id']):
+            self.assertIsNone(self.operator.parent_cache.get(file_id))
+            self.assertIsNone(self.operator.doc_cache.get(file_id, '1'))
+        self.assertEqual(set(CacheInvalidation.objects.filter(kind=CacheInvalidation.KIND_FILE).values_list(
+            'key', flat=True)), {doc['id'], outside['id']})
+        self.assertNotIn(created['id'], CacheInvalidation.objects.values_list('key', flat=True))
+
+    def test_listener_is_a_pool_hook(self):
+        # common不依赖apps，由AppConfig.ready注册
+        from common import operator_pool as pool_module
+
+        self.assertIn(changes.sync_invalidations, pool_module._prepare_hooks)
+        with mock.patch.object(changes.invalidation_listener, 'maybe_sync') as maybe_sync:
+            GoogleDocOperatorPool(credentials=AnonymousCredentials()).prepare()
+            maybe_sync.assert_called_once_with()
+            with mock.patch.object(settings, 'DRIVE_CHANGES_ENABLED', False):
+                GoogleDocOperatorPool(credentials=AnonymousCredentials()).prepare()
+            maybe_sync.assert_called_once_with()
+
+    def test_doc_moved_out_of_root(self):
+        doc = self.server.state.add_file('template', parents=[self.essay_id])
+        self.assertEqual(changes.poll_changes(self.operator), 1)
+        self.operator.parent_cache.set(doc['id'], [self.essay_id])
+        CacheInvalidation.objects.all().delete()
+        self.operator.drive_service.files().update(fileId=doc['id'], addParents='root',
+                                                   removeParents=self.essay_id).execute()
+        self.assertEqual(changes.poll_changes(self.operator), 1)
+        self.assertEqual(self.server.state.files[doc['id']]['parents'], ['root'])
+        self.assertIsNone(self.operator.parent_cache.get(doc['id']))
+        self.assertEqual(list(CacheInvalidation.objects.values_list('kind', 'key')),
+                         [(CacheInvalidation.KIND_FILE, doc['id'])])
+
+    def test_pages_and_listener(self):
+        doc_ids = [self.server.state.add_file(f'doc{i}', parents=[self.essay_id])['id'] for i in range(5)]
+        other_process = ParentFolderCache(alias='default')
+        listener = changes.InvalidationListener(FolderCache(alias='default'), other_process, DocumentCache(),
+                                                interval=0)
+        listener.sync()
+        for doc_id in doc_ids:
+            other_process.set(doc_id, [self.essay_id])
+
+        with mock.patch.object(settings, 'DRIVE_CHANGES_PAGE_SIZE', 2):
+            self.assertEqual(changes.poll_changes(self.operator, max_pages=1), 2)
+            self.assertEqual(changes.poll_changes(self.operator), 3)
+        self.assertEqual(self.server.state.calls['changes.list'], 3)
+        self.assertEqual(DriveChangeCursor.objects.get(name='drive').page_token,
+                         str(len(self.server.state.changes) + 1))
+
+        self.assertEqual(listener.sync(), 5)
+        self.assertTrue(all(other_process.get(doc_id) is None for doc_id in doc_ids))
+        self.assertEqual(listener.sync(), 0)
+
+
+class FolderIndexTest(TransactionTestCase):
+    """
+    按层遍历目录树预热目录缓存
+    """
+
+    def setUp(self):
+        caches['default'].clear()
+        self.server = FakeGoogleServer().start()
+        self.addCleanup(self.server.stop)
+        for patcher in (mock.patch.object(settings, 'GOOGLE_API_ROOT_URL', self.server.root_url),
+                        mock.patch.object(settings, 'FOLDER_DB_LOCK_ENABLED', False)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        state = self.server.state
+        state.add_file('root', FOLDER_MIME_TYPE, file_id=settings.DOC_ROOT_FOLDER_ID)
+        self.folders = {}
+        for i in range(5):
+            student = state.add_file(f'student{i}', FOLDER_MIME_TYPE, [settings.DOC_ROOT_FOLDER_ID])['id']
+            self.folders[f'student{i}'] = student
+            self.folders[f'student{i}/essay'] = state.add_file('essay', FOLDER_MIME_TYPE, [student])['id']
+            state.add_file('doc', parents=[self.folders[f'student{i}/essay']])
+        self.folders['student0/essay/draft'] = state.add_file(
+            'draft', FOLDER_MIME_TYPE, [self.folders['student0/essay']])['id']
+        trashed = state.add_file('student9', FOLDER_MIME_TYPE, [settings.DOC_ROOT_FOLDER_ID])['id']
+        state.files[trashed]['trashed'] = True
+        self.operator = GoogleDocOperator(credentials=AnonymousCredentials(), folder_cache=FolderCache(alias='default'))
+
+    def test_warm_folder_cache(self):
+        with mock.patch.object(settings, 'FOLDER_INDEX_PARENTS_PER_QUERY', 2):
+            index = folder_index.warm_folder_cache(self.operator, page_size=3)
+        self.assertEqual(index, self.folders)
+        # 第1层1次查询2页，第2层3次查询(2+2+1个父目录)，第3层3次查询，第4层1次查询
+        self.assertEqual(self.server.state.calls['files.list'], 9)
+
+        calls = dict(self.server.state.calls)
+        operator = GoogleDocOperator(credentials=AnonymousCredentials(), folder_cache=FolderCache(alias='default'))
+        self.assertEqual(operator.get_or_create_folder(['student3', 'essay']), self.folders['student3/essay'])
+        self.assertEqual(operator.get_or_create_folder(['student0', 'essay', 'draft']),
+                         self.folders['student0/essay/draft'])
+        self.assertEqual(self.server.state.calls, calls)
+
+    def test_max_depth(self):
+        index = folder_index.warm_folder_cache(self.operator, max_depth=1)
+        self.assertEqual(sorted(index), [f'student{i}' for i in range(5)])
+
+    def test_get_or_create_folder_pages(self):
+        folders = list(self.operator.list_folders(f"'{settings.DOC_ROOT_FOLDER_ID}' in parents", page_size=2))
+        self.assertEqual(sorted(folder['name'] for folder in folders), [f'student{i}' for i in range(5)])
+        self.assertEqual(self.server.state.calls['files.list'], 3)
+
+        # 已删除(回收站中)的同名目录不再被使用
+        folder_id = self.operator.get_or_create_folder(['student9'])
+        self.assertFalse(self.server.state.files[folder_id]['trashed'])
+
+    def test_warm_up_async(self):
+        folder_cache = FolderCache(alias='default')
+        pool = GoogleDocOperatorPool(credentials=AnonymousCredentials())
+        with mock.patch.object(folder_index, 'operator_pool', pool), \
+                mock.patch.object(folder_index, 'default_folder_cache', folder_cache):
+            for _ in range(2):
+                self.assertTrue(folder_index.warm_up_async())
+                folder_index._warm_up_thread.join()
+        # 第二次在FOLDER_INDEX_WARM_INTERVAL内，不再遍历
+        self.assertEqual(self.server.state.calls['files.list'], 4)
+        self.assertEqual(folder_cache.resolve_path(['student0', 'essay', 'draft'], settings.DOC_ROOT_FOLDER_ID),
+                         self.folders['student0/essay/draft'])
+
+    def test_warm_up_on_first_request(self):
+        from apps.google_doc import apps
+
+        config = django_apps.get_app_config('google_doc')
+        with mock.patch.object(folder_index, 'warm_up_async') as warm_up_async, \
+                mock.patch.object(settings, 'FOLDER_INDEX_WARM_ON_STARTUP', True), \
+                mock.patch.object(settings, 'JOB_WORKER_MODE', 'command'):
+            self.addCleanup(request_started.disconnect, dispatch_uid='google_doc_folder_index_warm_up')
+            # 管理命令不预热
+            with mock.patch.object(sys, 'argv', ['manage.py', 'migrate']):
+                config.ready()
+            request_started.send(sender=None)
+            warm_up_async.assert_not_called()
+
+            # web进程加载应用时不预热，第一个请求时预热一次
+            with mock.patch.object(apps, 'is_server_process', return_value=True):
+                config.ready()
+            warm_up_async.assert_not_called()
+            request_started.send(sender=None)
+            request_started.send(sender=None)
+            warm_up_async.assert_called_once_with()
+
+
+class RosterProvisioningTest(TransactionTestCase):
+    """
+    按花名册批量预建目录
+    """
+
+    def setUp(self):
+        caches['default'].clear()
+        self.server = FakeGoogleServer().start()
+        self.addCleanup(self.server.stop)
+        self.pool = GoogleDocOperatorPool(credentials=AnonymousCredentials())
+        for patcher in (mock.patch.object(settings, 'GOOGLE_API_ROOT_URL', self.server.root_url),
+                        mock.patch.object(settings, 'GOOGLE_BATCH_SIZE', 2),
+                        mock.patch.object(settings, 'FOLDER_DB_LOCK_ENABLED', False),
+                        mock.patch('common.utils.default_folder_cache', FolderCache(alias='default')),
+                        mock.patch('apps.google_doc.provisioning.default_operator_pool', self.pool)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        state = self.server.state
+        state.add_file('root', FOLDER_MIME_TYPE, file_id=settings.DOC_ROOT_FOLDER_ID)
+        student0 = state.add_file('student0', FOLDER_MIME_TYPE, [settings.DOC_ROOT_FOLDER_ID])['id']
+        self.essay0 = state.add_file('essay', FOLDER_MIME_TYPE, [student0])['id']
+        state.add_file('student1', FOLDER_MIME_TYPE, [settings.DOC_ROOT_FOLDER_ID])
+        self.pairs = [(f'student{i}', 'essay') for i in range(5)] + [('student0', 'notes')]
+
+    def provision(self):
+        with self.pool.checkout() as operator:
+            return provisioning.provision_roster(operator, 'term')
+
+    def test_provision_roster(self):
+        self.assertEqual(provisioning.add_roster('term', self.pairs), 6)
+        self.assertEqual(provisioning.add_roster('term', self.pairs[:2]), 6)
+        self.assertEqual(self.provision(), {'pending': 0, 'done': 6, 'failed': 0})
+        calls = self.server.state.calls
+        # 根目录和已存在的student0、student1各列出一次子目录；新建3个用户目录、5个子目录，每个batch 2个
+        self.assertEqual([calls['files.list'], calls['files.create'], calls['batch']], [2, 8, 5])
+        self.assertEqual(RosterFolder.objects.get(username='student0', folder='essay').folder_id, self.essay0)
+
+        operator = GoogleDocOperator(credentials=AnonymousCredentials(), folder_cache=FolderCache(alias='default'))
+        for row in RosterFolder.objects.all():
+            self.assertEqual(operator.get_or_create_folder([row.username, row.folder]), row.folder_id)
+        self.assertEqual(calls['files.list'], 2)
+        self.assertEqual(self.provision(), {'pending': 0, 'done': 6, 'failed': 0})
+        self.assertEqual(calls['files.list'], 2)
+
+    def test_resume_after_failure(self):
+        provisioning.add_roster('term', self.pairs)
+        self.server.faults.fail('files.create', 400)
+        self.assertEqual(self.provision(), {'pending': 0, 'done': 5, 'failed': 1})
+        # 并发的batch中先到达的一个创建请求失败
+        failed = RosterFolder.objects.get(status=RosterFolder.STATUS_FAILED)
+        self.assertIn('injected error', failed.error)
+
+        self.assertEqual(self.provision(), {'pending': 0, 'done': 6, 'failed': 0})
+        state = self.server.state
+        user_folders = [file_id for file_id, meta in state.files.items() if meta['name'] == failed.username]
+        self.assertEqual(len(user_folders), 1)
+        failed.refresh_from_db()
+        self.assertEqual(state.files[failed.folder_id]['parents'], user_folders)
+
+    @mock.patch.object(settings, 'FOLDER_DB_LOCK_ENABLED', True)
+    def test_batch_holds_folder_locks(self):
+        root = settings.DOC_ROOT_FOLDER_ID
+        new_doc_results = []
+
+        def new_doc():
+            # new_doc请求使用独立的operator查找或创建同一目录
+            try:
+                worker = GoogleDocOperator(credentials=AnonymousCredentials(), folder_cache=operator.folder_cache)
+                new_doc_results.append(worker.get_or_create_folder(['student3']))
+            finally:
+                connection.close()
+
+        with self.pool.checkout() as operator:
+            # 列出子目录之后由new_doc创建的目录不再创建
+            existing = operator.get_or_create_folder(['student2'])
+            create_folders = operator.create_folders
+            thread = threading.Thread(target=new_doc)
+
+            def create_with_concurrent_new_doc(items):
+                thread.start()
+                thread.join(0.3)
+                # batch进行中new_doc等待同一目录的锁
+                self.assertTrue(thread.is_alive())
+                return create_folders(items)
+
+            with mock.patch.object(operator, 'create_folders', side_effect=create_with_concurrent_new_doc):
+                results = provisioning.create_folders(operator, [(root, 'student2'), (root, 'student3')])
+            thread.join()
+        self.assertEqual(results[(root, 'student2')], existing)
+        self.assertEqual(new_doc_results, [results[(root, 'student3')]])
+        names = [meta['name'] for meta in self.server.state.files.values()]
+        self.assertEqual((names.count('student2'), names.count('student3')), (1, 1))
+
+    def test_load_roster(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'roster.csv')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('username,folder\nstudent1,essay\n\nstudent1, essay\nstudent2,essay\n')
+            self.assertEqual(provisioning.load_roster(path), [('student1', 'essay'), ('student2', 'essay')])
+            path = os.path.join(directory, 'roster.json')
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump([['student1', 'essay'], {'username': 'student2', 'folder': 'notes'}], f)
+            self.assertEqual(provisioning.load_roster(path), [('student1', 'essay'), ('student2', 'notes')])
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump([['student1']], f)
+            with self.assertRaises(ValueError):
+                provisioning.load_roster(path)
+
+
+def call_asgi(application, path, query='', headers=()):
+    """
+    :return: (status, 响应头dict, 响应json)
+    """
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(),
+             'headers': [(key.lower().encode(), value.encode()) for key, value in headers]}
+    asyncio.run(application(scope, receive, send))
+    start, body = messages[0], b''.join(message.get('body', b'') for message in messages[1:])
+    return start['status'], {k.decode().lower(): v.decode() for k, v in start['headers']}, json.loads(body)
+
+
+class AsyncViewTest(TransactionTestCase):
+    """
+    ASGI下new_doc、copy_doc的asyncio view，经过django的ASGI handler，google api请求通过AsyncHttpClient发到替身服务
+    """
+
+    def setUp(self):
+        caches['default'].clear()
+        self.server = FakeGoogleServer(latency=0.05).start()
+        self.addCleanup(self.server.stop)
+        self.pool = GoogleDocOperatorPool(credentials=AnonymousCredentials())
+        folder_cache = FolderCache(alias='default')
+        for patcher in (mock.patch.object(settings, 'GOOGLE_API_ROOT_URL', self.server.root_url),
+                        mock.patch.object(settings, 'GOOGLE_RATE_LIMIT_ENABLED', False),
+                        mock.patch.object(settings, 'FOLDER_DB_LOCK_ENABLED', False),
+                        mock.patch.object(settings, 'JOB_WORKER_MODE', 'command'),
+                        mock.patch('common.utils.default_folder_cache', folder_cache),
+                        mock.patch.object(async_operator, 'default_folder_cache', folder_cache),
+                        mock.patch('common.operator_pool.operator_pool', self.pool),
+                        mock.patch('apps.google_doc.views.operator_pool', self.pool),
+                        mock.patch.object(async_operator, '_async_http', AsyncHttpClient()),
+                        mock.patch.object(async_operator, '_async_operator', None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.server.state.add_file('root', FOLDER_MIME_TYPE, file_id=settings.DOC_ROOT_FOLDER_ID)
+        with self.pool.checkout() as operator:
+            self.folder_id = operator.get_or_create_folder(['student1', 'essay'])
+        self.application = AsyncViewsASGIHandler()
+        self.user = User.objects.create_user('teacher')
+        self.auth = ('Authorization', 'Token ' + Token.objects.create(user=self.user).key)
+
+    def test_concurrent_new_doc(self):
+        query = 'username=student1&folder=essay&title=essay{}'
+
+        async def run():
+            results = []
+
+            async def one(i):
+                messages = []
+
+                async def receive():
+                    return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+                async def send(message):
+                    messages.append(message)
+                scope = {'type': 'http', 'method': 'GET', 'path': '/api/v1/new_doc/',
+                         'query_string': query.format(i).encode(),
+                         'headers': [(self.auth[0].lower().encode(), self.auth[1].encode())]}
+                await self.application(scope, receive, send)
+                results.append(json.loads(messages[1]['body']))
+            start = time.monotonic()
+            await asyncio.gather(*(one(i) for i in range(50)))
+            return results, time.monotonic() - start
+
+        results, elapsed = asyncio.run(run())
+        self.assertTrue(all(result['code'] == 200 for result in results))
+        self.assertEqual(sorted(self.server.state.files[result['data']['doc_id']]['name'] for result in results),
+                         sorted(f'essay{i}' for i in range(50)))
+        self.assertTrue(all(self.server.state.files[result['data']['doc_id']]['parents'] == [self.folder_id]
+                            for result in results))
+        # 50个请求同时等待google，而不是逐个执行
+        self.assertLess(elapsed, 50 * 0.05 / 2)
+        self.assertEqual(Document.objects.filter(kind=Document.KIND_NEW_DOC).count(), 50)
+
+    def test_copy_doc_shares_one_async_operator(self):
+        source = self.server.state.add_file('template', parents=[self.folder_id])
+        count = metrics.http_request_duration.get(view='AsyncCopyDocView', method='GET', status=200)[0]
+        operators = set()
+        for i in range(3):
+            status, headers, result = call_asgi(self.application, '/api/v1/copy_doc/',
+                                                f'source_doc_id={source["id"]}&title=copy{i}', [self.auth])
+            self.assertEqual(status, 200)
+            self.assertEqual(self.server.state.files[result['data']['target_doc_id']]['parents'], [self.folder_id])
+            # 经过MetricsMiddleware
+            self.assertIn('drive.files.copy;dur=', headers['server-timing'])
+            # 所有请求共用一个AsyncGoogleDocOperator，不从池中取出同步的operator
+            operators.add(async_operator._async_operator)
+            self.assertEqual(self.pool.idle_count(), 1)
+        self.assertEqual(len(operators), 1)
+        self.assertIs(async_operator._async_operator.credentials, self.pool.get_credentials())
+        self.assertEqual(metrics.http_request_duration.get(view='AsyncCopyDocView', method='GET', status=200)[0],
+                         count + 3)
+        self.assertEqual(self.server.state.calls['files.get'], 1)
+
+        status, _, result = call_asgi(self.application, '/api/v1/copy_doc/', 'source_doc_id=missing&title=copy',
+                                      [self.auth])
+        self.assertEqual(result['code'], 500)
+        self.assertEqual(call_asgi(self.application, '/api/v1/copy_doc/', 'title=copy', [self.auth])[2]['code'], 400)
+        self.assertEqual(self.pool.idle_count(), 1)
+
+    def test_auth_is_the_same_as_sync_views(self):
+        client = APIClient()
+        for headers in ((), (('Authorization', 'Token wrong'),)):
+            status, _, result = call_asgi(self.application, '/api/v1/new_doc/', 'username=a&folder=b&title=c',
+                                          headers)
+            response = client.get('/api/v1/new_doc/?username=a&folder=b&title=c', **{
+                f'HTTP_{key.upper()}': value for key, value in headers})
+            self.assertEqual((status, result), (response.status_code, response.json()))
+            self.assertIn(status, (401, 403))
+
+        # django session登录的用户(SessionAuthentication)
+        client.force_login(self.user)
+        cookie = '; '.join(f'{key}={morsel.value}' for key, morsel in client.cookies.items())
+        status, _, result = call_asgi(self.application, '/api/v1/new_doc/', 'username=student1&folder=essay&title=c',
+                                      [('Cookie', cookie)])
+        self.assertEqual((status, result['code']), (200, 200))
+        self.assertEqual(Document.objects.get(doc_id=result['data']['doc_id']).owner, self.user)
+
+    def test_fallback_to_sync_views(self):
+        status, _, result = call_asgi(self.application, '/api/v1/new_doc/',
+                                      'username=student1&folder=essay&title=c&async=1', [self.auth])
+        self.assertEqual(result['data']['status'], Job.STATUS_PENDING)
+        status, _, result = call_asgi(self.application, '/api/v1/new_doc/', 'username=student1&folder=essay&title=c',
+                                      [self.auth, ('Idempotency-Key', 'k')])
+        self.assertEqual(result['code'], 200)
+        self.assertEqual(Document.objects.get(idempotency_key='k').doc_id, result['data']['doc_id'])
+
+    def test_async_http_client(self):
+        http = AsyncHttpClient(max_connections=2)
+
+        async def run():
+            responses = await asyncio.gather(*(
+                http.request('GET', f'{self.server.root_url}drive/v3/files/{self.folder_id}?fields=id,name')
+                for _ in range(4)))
+            await http.aclose()
+            return responses
+
+        responses = asyncio.run(run())
+        self.assertEqual([response.status for response in responses], [200] * 4)
+        self.assertEqual(json.loads(responses[0].content)['id'], self.folder_id)
+        self.assertIn('content-type', responses[0].headers)
+
+    def test_async_http_client_is_closed_with_its_loop(self):
+        http = AsyncHttpClient()
+        url = f'{self.server.root_url}drive/v3/files/{self.folder_id}?fields=id'
+
+        async def request():
+            await http.request('GET', url)
+            return http._client
+
+        # asyncio.run结束时关闭该事件循环的client
+        first = asyncio.run(request())
+        self.assertTrue(first.is_closed)
+
+        # 换到另一个事件循环时，仍在运行的原事件循环中的client被关闭
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        try:
+            second = asyncio.run_coroutine_threadsafe(request(), loop).result()
+            third = asyncio.run(request())
+            self.assertIsNot(second, third)
+            for _ in range(50):
+                if second.is_closed:
+                    break
+                time.sleep(0.01)
+            self.assertTrue(second.is_closed)
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+
+class TokenAuthCacheTest(TransactionTestCase):
+
+    def setUp(self):
+        token_cache.clear_local()
+        self.addCleanup(token_cache.clear_local)
+        self.user = User.objects.create_user('teacher')
+        self.token = Token.objects.create(user=self.user)
+
+    def authenticate(self, key=None):
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION=f'Token {key or self.token.key}')
+        return CachedTokenAuthentication().authenticate(request)
+
+    def test_cached_token_skips_db(self):
+        self.assertEqual(self.authenticate()[0], self.user)
+        with self.assertNumQueries(0):
+            user, token = self.authenticate()
+        self.assertEqual((user.pk, token.key), (self.user.pk, self.token.key))
+        # 无效token不缓存
+        for _ in range(2):
+            with self.assertNumQueries(1), self.assertRaises(AuthenticationFailed):
+                self.authenticate('wrong')
+
+    def test_token_delete_and_user_deactivation_invalidate(self):
+        self.authenticate()
+        self.token.delete()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+        token = Token.objects.create(user=self.user)
+        self.authenticate(token.key)
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaisesRegex(AuthenticationFailed, 'inactive'):
+            self.authenticate(token.key)
+
+    def test_unrelated_user_updates_keep_cache(self):
+        self.authenticate()
+        # 登录时只更新last_login，不查询token也不删除缓存
+        with self.assertNumQueries(1):
+            self.user.last_login = timezone.now()
+            self.user.save(update_fields=['last_login'])
+        with self.assertNumQueries(0):
+            self.authenticate()
+
+        self.user.is_active = False
+        self.user.save(update_fields=['is_active'])
+        with self.assertRaisesRegex(AuthenticationFailed, 'inactive'):
+            self.authenticate()
+
+    def test_shared_tier(self):
+        caches['default'].clear()
+        writer, reader = TokenCache(alias='default'), TokenCache(alias='default')
+        writer.set(self.token.key, (self.user, self.token))
+        self.assertNotIn(self.token.key, writer.make_key(self.token.key))
+        self.assertEqual(reader.get(self.token.key)[0], self.user)
+        writer.delete(self.token.key)
+        self.assertIsNone(caches['default'].get(writer.make_key(self.token.key)))
+        self.assertIsNone(TokenCache(alias='default').get(self.token.key))
+
+    @mock.patch.object(settings, 'AUTH_TOKEN_CACHE_ENABLED', False)
+    def test_disabled(self):
+        self.authenticate()
+        with self.assertNumQueries(1):
+            self.authenticate()
+
+
+class ListHandler(logging.Handler):
+    def __init__(self, level=logging.NOTSET):
+        super().__init__(level)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class FakeGoogleServerTest(TransactionTestCase):
+    """
+    替身服务的docs接口和错误注入
+    """
+
+    def setUp(self):
+        caches['default'].clear()
+        self.server = FakeGoogleServer(faults=FaultInjector(seed=1)).start()
+        self.addCleanup(self.server.stop)
+        patcher = mock.patch.object(settings, 'GOOGLE_API_ROOT_URL', self.server.root_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server.state.add_file('root', FOLDER_MIME_TYPE, file_id=settings.DOC_ROOT_FOLDER_ID)
+        self.operator = GoogleDocOperator(credentials=AnonymousCredentials(), folder_cache=FolderCache(alias='default'))
+        self.operator.executor = GoogleApiExecutor(buckets={}, max_attempts=2, backoff_base=0.001, backoff_max=0.01)
+
+    @mock.patch.object(settings, 'DOC_CREATE_MODE', DocCreateMode.DOCS_COPY.value)
+    @mock.patch.object(settings, 'FOLDER_DB_LOCK_ENABLED', False)
+    def test_docs_copy_mode(self):
+        self.operator.delete_queue = DeleteQueue()
+        self.addCleanup(self.operator.delete_queue.stop)
+        doc_id, web_link = self.operator.create_doc('文书', 'student1', 'essay')
+        calls = self.server.state.calls
+        temp_docs = [meta for meta in self.server.state.files.values() if meta.get('appProperties')]
+        self.assertEqual([(meta['parents'], meta['appProperties']) for meta in temp_docs],
+                         [(['root'], {'mazeGoogleDocTemp': 'true'})])
+        self.assertNotIn('mazeGoogleDocTemp', self.server.state.files[doc_id].get('appProperties') or {})
+        # 临时文档放入删除队列，不在请求中删除
+        self.assertEqual([calls.get(name) for name in ('documents.create', 'files.copy', 'files.delete')],
+                         [1, 1, None])
+        self.assertEqual(self.operator.delete_queue.flush(self.operator), 1)
+        self.assertEqual(calls['files.delete'], 1)
+        self.assertEqual(web_link, self.server.state.files[doc_id]['webViewLink'])
+        document = self.operator.get_doc(doc_id)
+        self.assertEqual((document['documentId'], document['title']), (doc_id, '文书'))
+        with self.assertRaises(HttpError):
+            self.operator.get_doc('missing')
+
+    def test_injected_errors_are_retried(self):
+        self.server.faults.fail('files.create', 429)
+        self.assertEqual(len(self.operator.create_blank_docs(settings.DOC_ROOT_FOLDER_ID, 1)), 1)
+        self.assertEqual(self.server.state.calls.get('files.create:429'), 1)
+        self.server.faults.fail('files.get', 503)
+        self.assertEqual(self.operator.get_parent_folders(settings.DOC_ROOT_FOLDER_ID, use_cache=False), [])
+        self.assertEqual(self.server.state.calls.get('files.get:503'), 1)
+
+        # google可能已经创建了文件，create的5xx不重试
+        self.server.faults.fail('files.create', 503)
+        creates = self.server.state.calls['files.create']
+        self.assertEqual(self.operator.create_blank_docs(settings.DOC_ROOT_FOLDER_ID, 1), [])
+        self.assertEqual((self.server.state.calls['files.create:503'], self.server.state.calls['files.create']),
+                         (1, creates))
+
+        self.server.faults.error_rate = 1
+        self.server.faults.error_statuses = (429,)
+        with self.assertRaises(RateLimitedError):
+            self.operator.get_parent_folders(settings.DOC_ROOT_FOLDER_ID, use_cache=False)
+        self.assertEqual(self.server.state.calls['files.get:429'], 3)
+
+
+class TransportTestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/gzip')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path == '/slow':
+            time.sleep(0.5)
+        data = gzip.compress(b'{"id": "doc1"}')
+        self.send_response(201, 'Created')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('X-Goog-Request', 'abc')
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class TransportTestServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 超时的测试中客户端先断开连接
+        pass
+
+
+class RequestsHttpTest(TransactionTestCase):
+    """
+    googleapiclient通过RequestsHttp访问google api，返回值与httplib2.Http.request一致
+    """
+
+    def setUp(self):
+        server = TransportTestServer(('127.0.0.1', 0), TransportTestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = f'http://127.0.0.1:{server.server_address[1]}'
+        self.http = RequestsHttp(AnonymousCredentials(), adapter=requests.adapters.HTTPAdapter(), timeout=5)
+        self.addCleanup(self.http.close)
+
+    def test_response_is_mapped_to_httplib2(self):
+        response, content = self.http.request(self.url + '/gzip')
+        self.assertIsInstance(response, httplib2.Response)
+        self.assertEqual((response.status, response['status'], response.reason), (201, '201', 'Created'))
+        self.assertEqual((response['content-type'], response['x-goog-request']), ('application/json', 'abc'))
+        # 已解压的内容，不再带content-encoding，长度按解压后计算
+        self.assertEqual(content, b'{"id": "doc1"}')
+        self.assertNotIn('content-encoding', response)
+        self.assertEqual(response['content-length'], str(len(content)))
+
+    def test_redirections(self):
+        response, _ = self.http.request(self.url + '/redirect', redirections=0)
+        self.assertEqual((response.status, response['location']), (302, '/gzip'))
+        response, content = self.http.request(self.url + '/redirect')
+        self.assertEqual((response.status, content), (201, b'{"id": "doc1"}'))
+
+    def test_timeout(self):
+        http = RequestsHttp(AnonymousCredentials(), adapter=requests.adapters.HTTPAdapter(), timeout=0.1)
+        self.addCleanup(http.close)
+        with self.assertRaises(requests.exceptions.Timeout):
+            http.request(self.url + '/slow')
+
+    def test_batch_request(self):
+        server = FakeGoogleServer().start()
+        self.addCleanup(server.stop)
+        server.state.add_file('root', FOLDER_MIME_TYPE, file_id=settings.DOC_ROOT_FOLDER_ID)
+        with mock.patch.object(settings, 'GOOGLE_API_ROOT_URL', server.root_url), \
+                mock.patch.object(settings, 'GOOGLE_HTTP_TRANSPORT', 'requests'):
+            operator = GoogleDocOperator(credentials=AnonymousCredentials(), folder_cache=FolderCache(alias='default'))
+            self.assertIsInstance(operator.http, RequestsHttp)
+            doc_ids = operator.create_blank_docs(settings.DOC_ROOT_FOLDER_ID, 3)
+        self.assertEqual(len(doc_ids), 3)
+        self.assertTrue(all(server.state.files[doc_id]['parents'] == [settings.DOC_ROOT_FOLDER_ID]
+                            for doc_id in doc_ids))
+        self.assertEqual((server.state.calls['batch'], server.state.calls['files.create']), (1, 3))
+
+
+class CleanupTest(TransactionTestCase):
+    """
+    临时文档的删除队列和遗留文档清理
+    """
+
+    def setUp(self):
+        self.server = FakeGoogleServer().start()
+        self.addCleanup(self.server.stop)
+        for patcher in (mock.patch.object(settings, 'GOOGLE_API_ROOT_URL', self.server.root_url),
+                        mock.patch.object(settings, 'GOOGLE_BATCH_SIZE', 2)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.server.state.add_file('root', FOLDER_MIME_TYPE, file_id=settings.DOC_ROOT_FOLDER_ID)
+        self.operator = GoogleDocOperator(credentials=AnonymousCredentials(), folder_cache=FolderCache(alias='default'))
+
+    def add_doc(self, age, parents=('root',), marked=True):
+        meta = self.server.state.add_file('temp', parents=list(parents),
+                                          app_properties=dict([TEMP_DOC_APP_PROPERTY]) if marked else None)
+        created = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=age)
+        self.server.state.files[meta['id']]['createdTime'] = created.isoformat().replace('+00:00', 'Z')
+        return meta['id']
+
+    def test_flush_in_batches(self):
+        queue = DeleteQueue(maxsize=5, flush_interval=60, batch_size=100)
+        self.addCleanup(queue.stop)
+        doc_ids = [self.add_doc(0) for _ in range(4)] + ['missing']
+        dropped = metrics.deleted_files.get(source='queue', status='dropped')
+        self.assertTrue(all(queue.put(doc_id) for doc_id in doc_ids))
+        self.assertFalse(queue.put('overflow'))
+        self.assertEqual(metrics.deleted_files.get(source='queue', status='dropped'), dropped + 1)
+        self.assertEqual(metrics.delete_queue_length.get(), 5)
+
+        # 已不存在的文件视为删除成功
+        self.assertEqual(queue.flush(self.operator), 5)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(metrics.delete_queue_length.get(), 0)
+        self.assertEqual(self.server.state.calls['batch'], 3)
+        self.assertFalse(set(doc_ids) & set(self.server.state.files))
+
+    def test_background_flush(self):
+        queue = DeleteQueue(flush_interval=0.01)
+        self.addCleanup(queue.stop)
+        doc_id = self.add_doc(0)
+        pool = GoogleDocOperatorPool(credentials=AnonymousCredentials())
+        with mock.patch('common.operator_pool.operator_pool', pool):
+            queue.put(doc_id)
+            deadline = time.monotonic() + 5
+            while doc_id in self.server.state.files and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertNotIn(doc_id, self.server.state.files)
+
+    def test_sweep_orphan_docs(self):
+        orphans = [self.add_doc(7200) for _ in range(3)]
+        recent = self.add_doc(60)
+        kept = self.add_doc(7200, parents=[settings.DOC_ROOT_FOLDER_ID])
+        # 共享账号时根目录下可能有别人的文档，没有临时文档的标记，不会被删除
+        unmarked = self.add_doc(7200, marked=False)
+        self.assertEqual(cleanup.sweep_orphan_docs(self.operator, min_age=3600, dry_run=True),
+                         {'found': 3, 'deleted': 0, 'failed': 0})
+        self.assertEqual(cleanup.sweep_orphan_docs(self.operator, min_age=3600),
+                         {'found': 3, 'deleted': 3, 'failed': 0})
+        self.assertFalse(set(orphans) & set(self.server.state.files))
+        self.assertIn(recent, self.server.state.files)
+        self.assertIn(kept, self.server.state.files)
+        self.assertIn(unmarked, self.server.state.files)
+        self.assertEqual(cleanup.sweep_orphan_docs(self.operator, min_age=3600)['found'], 0)
+
+
+class ExportTest(TransactionTestCase):
+    """
+    文档导出和批量导出为zip
+    """
+
+    def setUp(self):
+        caches['default'].clear()
+        self.server = FakeGoogleServer().start()
+        self.addCleanup(self.server.stop)
+        for patcher in (mock.patch.object(settings, 'GOOGLE_API_ROOT_URL', self.server.root_url),
+                        mock.patch.object(settings, 'EXPORT_CHUNK_SIZE', 64),
+                        mock.patch('apps.google_doc.views.operator_pool',
+                                   GoogleDocOperatorPool(credentials=AnonymousCredentials()))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.text = ''.join(f'paragraph {i}\n' for i in range(30))
+        self.doc_id = self.add_doc('essay', self.text)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('teacher'))
+
+    def add_doc(self, name, text):
+        doc_id = self.server.state.add_file(name)['id']
+        paragraph = {'paragraph': {'elements': [{'textRun': {'content': text}}]}}
+        self.server.state.documents[doc_id] = {'content': [paragraph]}
+        return doc_id
+
+    def test_export_in_chunks(self):
+        operator = GoogleDocOperator(credentials=AnonymousCredentials(), folder_cache=FolderCache(alias='default'))
+        chunks = list(operator.export_doc(self.doc_id, 'txt'))
+        self.assertEqual(b''.join(chunks), f'essay\n{self.text}'.encode())
+        self.assertTrue(all(len(chunk) <= 64 for chunk in chunks))
+        self.assertEqual(self.server.state.calls['files.export'], len(chunks))
+
+    def test_export_view(self):
+        response = self.client.get(f'/api/v1/doc/{self.doc_id}/export/?format=pdf')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(response['Content-Disposition'], f'attachment; filename="{self.doc_id}.pdf"')
+        self.assertEqual(b''.join(response.streaming_content), f'%PDF-1.4\nessay\n{self.text}'.encode())
+
+    def test_export_errors(self):
+        response = self.client.get('/api/v1/doc/missing/export/?format=txt')
+        self.assertEqual(response.json(), {'code': 400, 'message': 'doc missing not found'})
+        response = self.client.get(f'/api/v1/doc/{self.doc_id}/export/?format=odt')
+        self.assertEqual(response.json()['code'], 400)
+
+    def test_bulk_export(self):
+        other = self.add_doc('notes', 'hello\n')
+        with override_settings(BULK_EXPORT_MAX_WORKERS=2):
+            response = self.client.post('/api/v1/doc/export/bulk/', {
+                'doc_ids': [self.doc_id, other, 'missing', other], 'format': 'txt'}, format='json')
+            content = b''.join(response.streaming_content)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertEqual(sorted(archive.namelist()), sorted([f'{self.doc_id}.txt', f'{other}.txt', 'errors.json']))
+            self.assertEqual(archive.read(f'{self.doc_id}.txt'), f'essay\n{self.text}'.encode())
+            self.assertEqual(archive.read(f'{other}.txt'), b'notes\nhello\n')
+            self.assertEqual(json.loads(archive.read('errors.json')),
+                             [{'doc_id': 'missing', 'code': 400, 'message': 'doc missing not found'}])
+
+    def test_bulk_export_invalid_request(self):
+        response = self.client.post('/api/v1/doc/export/bulk/', {'doc_ids': ['../x'], 'format': 'txt'}, format='json')
+        self.assertEqual(response.json()['code'], 400)
+        with override_settings(BULK_EXPORT_MAX_ITEMS=1):
+            response = self.client.post('/api/v1/doc/export/bulk/', {'doc_ids': ['a', 'b']}, format='json')
+        self.assertEqual(response.json()['code'], 400)
+
+    def test_imap_unordered_max_pending(self):
+        pool = GoogleDocOperatorPool(credentials=AnonymousCredentials())
+        submitted = []
+
+        def tasks():
+            for i in range(6):
+                submitted.append(i)
+                yield i
+
+        results = pool.imap_unordered(lambda operator, task: task, tasks(), 2, max_pending=2)
+        next(results)
+        self.assertLessEqual(len(submitted), 3)
+        self.assertEqual(len(list(results)), 5)
+
+
+class MetricsTest(TransactionTestCase):
+
+    def test_google_calls_are_recorded(self):
+        executor = GoogleApiExecutor(buckets={}, max_attempts=2, backoff_base=0.001, backoff_max=0.01)
+        request = mock.Mock(methodId='drive.files.copy')
+        request.execute.side_effect = [rate_limit_error(429), {'id': 'doc1'}]
+        before = (metrics.google_api_requests.get(method='drive.files.copy', status='429'),
+                  metrics.google_api_requests.get(method='drive.files.copy', status='ok'),
+                  metrics.google_api_retries.get(method='drive.files.copy'),
+                  metrics.google_api_duration.get(method='drive.files.copy')[0])
+        timings = reset_call_timings()
+        executor.execute(request)
+        after = (metrics.google_api_requests.get(method='drive.files.copy', status='429'),
+                 metrics.google_api_requests.get(method='drive.files.copy', status='ok'),
+                 metrics.google_api_retries.get(method='drive.files.copy'),
+                 metrics.google_api_duration.get(method='drive.files.copy')[0])
+        self.assertEqual([b - a for a, b in zip(before, after)], [1, 1, 1, 2])
+        self.assertEqual(timings.methods['drive.files.copy'][0], 2)
+        self.assertRegex(timings.server_timing(0.5), r'^google;dur=[\d.]+;desc="2 calls", google-backoff;dur=[\d.]+;'
+                                                     r'desc="1 retries", drive.files.copy;dur=[\d.]+;desc="2 calls", '
+                                                     r'total;dur=500.0$')
+
+    def test_histogram_rendering(self):
+        registry = metrics.MetricsRegistry()
+        histogram = registry.histogram('latency_seconds', 'Latency.', ('view',), buckets=(0.1, 1))
+        for value in (0.05, 0.5, 3):
+            histogram.observe(value, view='New"Doc')
+        registry.counter('calls_total', 'Calls.').inc()
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{view="New\\"Doc",le="0.1"} 1',
+            'latency_seconds_bucket{view="New\\"Doc",le="1.0"} 2',
+            'latency_seconds_bucket{view="New\\"Doc",le="+Inf"} 3',
+            'latency_seconds_sum{view="New\\"Doc"} 3.55',
+            'latency_seconds_count{view="New\\"Doc"} 3',
+            '# HELP calls_total Calls.',
+            '# TYPE calls_total counter',
+            'calls_total 1',
+        ])
+
+    def test_server_timing_and_metrics_endpoint(self):
+        server = FakeGoogleServer().start()
+        self.addCleanup(server.stop)
+        server.state.add_file('root', FOLDER_MIME_TYPE, file_id=settings.DOC_ROOT_FOLDER_ID)
+        for patcher in (mock.patch.object(settings, 'GOOGLE_API_ROOT_URL', server.root_url),
+                        mock.patch.object(settings, 'GOOGLE_RATE_LIMIT_ENABLED', False),
+                        mock.patch.object(settings, 'FOLDER_DB_LOCK_ENABLED', False)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        caches['default'].clear()
+        operator = GoogleDocOperator(credentials=AnonymousCredentials(), folder_cache=FolderCache(alias='default'))
+        patcher = mock.patch('apps.google_doc.views.operator_pool.acquire', return_value=operator)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('teacher'))
+
+        response = client.get('/api/v1/new_doc/', {'username': 'student1', 'folder': 'essay', 'title': 'essay'})
+        self.assertEqual(response.json()['code'], 200)
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'^google;dur=[\d.]+;desc="5 calls"')
+        self.assertIn('drive.files.list;dur=', timing)
+        self.assertIn('drive.files.create;dur=', timing)
+
+        text = client.get('/metrics').content.decode()
+        self.assertIn('google_api_requests_total{method="drive.files.create",status="ok"}', text)
+        self.assertRegex(text,
+                         r'http_request_duration_seconds_count\{view="NewDocView",method="GET",status="200"\} \d+')
+        self.assertEqual(APIClient().get('/metrics').status_code, 403)
+
+    def test_streaming_response_is_timed_when_closed(self):
+        def content():
+            for chunk in (b'a', b'b'):
+                time.sleep(0.05)
+                yield chunk
+
+        labels = {'view': 'unmatched', 'method': 'GET', 'status': 200}
+        middleware = metrics.MetricsMiddleware(lambda request: StreamingHttpResponse(content()))
+        count, total = metrics.http_request_duration.get(**labels)
+        response = middleware(RequestFactory().get('/export'))
+        # 返回响应时内容还没有生成，响应头中没有Server-Timing，也还没有记录耗时
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(metrics.http_request_duration.get(**labels), (count, total))
+        self.assertEqual(b''.join(response.streaming_content), b'ab')
+        response.close()
+        after_count, after_total = metrics.http_request_duration.get(**labels)
+        self.assertEqual(after_count, count + 1)
+        self.assertGreaterEqual(after_total - total, 0.1)
+
+        # 客户端断开等未迭代完的情况，在关闭时记录一次
+        response = middleware(RequestFactory().get('/export'))
+        response.close()
+        response.close()
+        self.assertEqual(metrics.http_request_duration.get(**labels)[0], count + 2)
+
+
+class LogQueueTest(TransactionTestCase):
+
+    def make_logger(self, log_queue, *targets):
+        logger = logging.getLogger(f'test.{uuid.uuid4().hex}')
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(DroppingQueueHandler(log_queue, list(targets)))
+        return logger
+
+    def test_records_are_written_by_background_thread(self):
+        log_queue = LogQueue(maxsize=100)
+        self.addCleanup(log_queue.stop)
+        target, errors = ListHandler(), ListHandler(logging.ERROR)
+        logger = self.make_logger(log_queue, target, errors)
+        params = {'title': 'a'}
+        logger.info('params %s', params)
+        params['title'] = 'b'
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.exception('failed')
+        log_queue.stop()
+        self.assertEqual([record.getMessage().splitlines()[0] for record in target.records],
+                         ["params {'title': 'a'}", 'failed'])
+        self.assertIn('ValueError: boom', target.records[1].getMessage())
+        self.assertEqual([record.levelname for record in errors.records], ['ERROR'])
+        self.assertEqual([target.records[0].threadName, target.records[0].filename],
+                         [threading.current_thread().name, 'tests.py'])
+
+    def test_drop_policies(self):
+        # 不启动写线程，队列满后按策略丢弃；ERROR先等待block_timeout
+        for policy, kept, dropped in (('drop_new', ['0', '1'], {'INFO': 2, 'ERROR': 1}),
+                                      ('drop_oldest', ['3', 'error'], {'INFO': 3})):
+            log_queue = LogQueue(maxsize=2, drop_policy=policy, block_timeout=0.01)
+            log_queue.ensure_started = lambda: None
+            logger = self.make_logger(log_queue, ListHandler())
+            for i in range(4):
+                logger.info(str(i))
+            logger.error('error')
+            self.assertEqual(log_queue.stats(), {'queued': 2, 'dropped': dropped})
+            self.assertEqual([log_queue.queue.get_nowait()[1].getMessage() for _ in range(2)], kept)
+            # 有空位后补写一条丢弃数的警告
+            logger.info('after')
+            self.assertEqual([log_queue.queue.get_nowait()[1].getMessage() for _ in range(2)],
+                             ['after', f'log queue full, dropped {dropped}'])
+
+    @mock.patch.object(settings, 'LOG_MESSAGE_MAX_LENGTH', 20)
+    def test_message_and_payload_are_capped(self):
+        self.assertEqual(str(payload('x' * 30, limit=10)), 'x' * 10 + '...(truncated, 30 chars)')
+        self.assertEqual(f'{payload({"a": 1})}', "{'a': 1}")
+        log_queue = LogQueue(maxsize=10)
+        log_queue.ensure_started = lambda: None
+        self.make_logger(log_queue, ListHandler()).warning('y' * 100)
+        self.assertEqual(log_queue.queue.get_nowait()[1].getMessage(), 'y' * 20 + '...(truncated, 100 chars)')
+
+    def test_json_formatter(self):
+        record = logging.makeLogRecord({'name': 'info', 'levelno': logging.INFO, 'levelname': 'INFO',
+                                        'msg': '创建 %s', 'args': ('doc',), 'lineno': 3, 'filename': 'views.py'})
+        data = json.loads(JsonFormatter().format(record))
+        self.assertEqual((data['message'], data['level'], data['logger'], data['line']), ('创建 doc', 'INFO', 'info', 3))
+
+
+class JobTest(TransactionTestCase):
+
+    def setUp(self):
+        for patcher in (mock.patch.object(settings, 'JOB_WORKER_MODE', 'command'),
+                        mock.patch.object(settings, 'JOB_MAX_ATTEMPTS', 2)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.operator = mock.Mock()
+        patcher = mock.patch('apps.google_doc.jobs.operator_pool.acquire', return_value=self.operator)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user('teacher')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_async_new_doc(self):
+        self.operator.create_doc.return_value = ('doc1', 'link1')
+        data = self.client.get('/api/v1/new_doc/', {'username': 'student1', 'title': 't', 'folder': 'essay',
+                                                    'async': '1'}).json()['data']
+        self.assertEqual(data['status'], Job.STATUS_PENDING)
+        self.operator.create_doc.assert_not_called()
+
+        run_job(claim_next_job('worker'))
+        self.operator.create_doc.assert_called_once_with('t', 'student1', 'essay')
+        data = self.client.get(f'/api/v1/jobs/{data["job_id"]}/').json()['data']
+        self.assertEqual(data['status'], Job.STATUS_SUCCEEDED)
+        self.assertEqual(data['result'], {'doc_id': 'doc1', 'web_link': 'link1'})
+
+    def test_failed_job_is_retried_then_failed(self):
+        self.operator.make_copy.side_effect = ValueError('boom')
+        job_id = self.client.get('/api/v1/copy_doc/', {'source_doc_id': 's', 'title': 't', 'async': 'true'}).json()[
+            'data']['job_id']
+        run_job(claim_next_job('worker'))
+        self.assertEqual(Job.objects.get(id=job_id).status, Job.STATUS_PENDING)
+        run_job(claim_next_job('worker'))
+        self.assertEqual(Job.objects.get(id=job_id).status, Job.STATUS_FAILED)
+        self.assertIsNone(claim_next_job('worker'))
+
+    def test_rerun_job_does_not_create_doc_again(self):
+        self.operator.create_doc.return_value = ('doc1', 'link1')
+        job_id = self.client.get('/api/v1/new_doc/', {'username': 'student1', 'title': 't', 'folder': 'essay',
+                                                      'async': '1'}).json()['data']['job_id']
+        # 文档已创建，但worker在标记完成前失败
+        with mock.patch('apps.google_doc.jobs.documents.record_documents', side_effect=ValueError('boom')):
+            run_job(claim_next_job('worker'))
+        self.assertEqual(Job.objects.get(id=job_id).status, Job.STATUS_PENDING)
+        self.assertEqual(Job.objects.get(id=job_id).doc_id, 'doc1')
+        run_job(claim_next_job('worker'))
+        self.operator.create_doc.assert_called_once_with('t', 'student1', 'essay')
+        job = Job.objects.get(id=job_id)
+        self.assertEqual(job.status, Job.STATUS_SUCCEEDED)
+        self.assertEqual(json.loads(job.result), {'doc_id': 'doc1', 'web_link': 'link1'})
+
+    def test_in_process_workers_start_with_server(self):
+        from apps.google_doc import apps, jobs
+
+        with mock.patch.object(sys, 'argv', ['manage.py', 'migrate']):
+            self.assertFalse(apps.is_server_process())
+        with mock.patch.object(sys, 'argv', ['manage.py', 'runserver', '--noreload']):
+            self.assertTrue(apps.is_server_process())
+        for argv in (['/usr/bin/gunicorn', 'maze_google_doc.wsgi'], ['/venv/lib/gunicorn/__main__.py'],
+                     ['uwsgi', '--ini', 'uwsgi.ini']):
+            with mock.patch.object(sys, 'argv', argv):
+                self.assertTrue(apps.is_server_process())
+        for argv in (['/usr/bin/pytest'], ['/usr/bin/celery', 'worker'], ['/venv/lib/django/__main__.py', 'shell'],
+                     ['-c']):
+            with mock.patch.object(sys, 'argv', argv):
+                self.assertFalse(apps.is_server_process())
+
+        with mock.patch.object(jobs, '_in_process_pool', None), \
+                mock.patch.object(jobs.JobWorkerPool, 'start', autospec=True, side_effect=lambda pool: pool) as start:
+            # 加载应用时只注册信号，在处理第一个请求时启动
+            jobs.start_workers_on_first_request()
+            self.addCleanup(request_started.disconnect, dispatch_uid='google_doc_job_workers')
+            start.assert_not_called()
+            request_started.send(sender=None)
+            request_started.send(sender=None)
+            start.assert_called_once()
+            self.assertIsNotNone(jobs._in_process_pool)
+            # fork出的子进程同样在第一个请求时启动
+            jobs._reset_in_process_pool()
+            request_started.send(sender=None)
+            self.assertEqual(start.call_count, 2)
+
+    def test_stale_jobs_are_requeued_once_per_lease(self):
+        from apps.google_doc import jobs
+
+        pool = jobs.JobWorkerPool(concurrency=1)
+        with mock.patch.object(jobs, 'requeue_stale_jobs') as requeue_stale_jobs:
+            results, errors = run_concurrently(8, lambda i: pool.maybe_requeue_stale_jobs())
+            pool.maybe_requeue_stale_jobs()
+            self.assertEqual(requeue_stale_jobs.call_count, 1)
+            with mock.patch.object(settings, 'JOB_LEASE_SECONDS', 0):
+                pool._next_requeue = 0
+                pool.maybe_requeue_stale_jobs()
+            self.assertEqual(requeue_stale_jobs.call_count, 2)
+
+    def test_stale_running_job_is_requeued(self):
+        job = Job.objects.create(kind=Job.KIND_NEW_DOC, params='{}', status=Job.STATUS_RUNNING, worker='dead',
+                                 lease_expires_at=timezone.now() - timezone.timedelta(seconds=1))
+        self.assertIsNone(claim_next_job('worker'))
+        self.assertEqual(requeue_stale_jobs(), 1)
+        self.assertEqual(claim_next_job('worker').id, job.id)
+
+    def test_other_users_job_is_hidden(self):
+        job = Job.objects.create(kind=Job.KIND_NEW_DOC, params='{}', owner=User.objects.create_user('other'))
+        self.assertEqual(self.client.get(f'/api/v1/jobs/{job.id}/').json()['code'], 400)
+
+
+class IdempotencyTest(TransactionTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(settings, 'JOB_WORKER_MODE', 'command')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.operator = mock.Mock()
+        self.operator.create_doc.return_value = ('doc1', 'link1')
+        patcher = mock.patch('apps.google_doc.views.operator_pool.acquire', return_value=self.operator)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user('teacher')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.params = {'username': 'student1', 'title': 't', 'folder': 'essay'}
+
+    def new_doc(self, key='key1', **params):
+        return self.client.get('/api/v1/new_doc/', dict(self.params, **params), HTTP_IDEMPOTENCY_KEY=key).json()
+
+    def test_retry_returns_recorded_doc(self):
+        self.assertEqual(self.new_doc()['data'], {'doc_id': 'doc1', 'web_link': 'link1'})
+        self.assertEqual(self.new_doc()['data'], {'doc_id': 'doc1', 'web_link': 'link1'})
+        self.operator.create_doc.assert_called_once_with('t', 'student1', 'essay')
+        document = Document.objects.get(doc_id='doc1')
+        self.assertEqual((document.owner, document.idempotency_key, document.folder), (self.user, 'key1', 'essay'))
+
+    @mock.patch.object(settings, 'DB_LOCK_TIMEOUT', 0.1)
+    def test_request_in_progress(self):
+        with db_lock(f'idempotency:{self.user.pk}:key1'):
+            response = self.client.get('/api/v1/new_doc/', self.params, HTTP_IDEMPOTENCY_KEY='key1')
+        self.assertEqual(response.json()['code'], 409)
+        self.assertEqual(response['Retry-After'], '5')
+        self.operator.create_doc.assert_not_called()
+        self.assertEqual(self.new_doc()['data'], {'doc_id': 'doc1', 'web_link': 'link1'})
+
+    def test_key_reused_with_different_params(self):
+        self.new_doc()
+        self.assertEqual(self.new_doc(title='other')['code'], 400)
+        self.assertEqual(self.operator.create_doc.call_count, 1)
+
+    def test_retry_with_params_longer_than_fields(self):
+        title = 't' * 300
+        self.assertEqual(self.new_doc(title=title)['data'], {'doc_id': 'doc1', 'web_link': 'link1'})
+        self.assertEqual(len(Document.objects.get(doc_id='doc1').title), 255)
+        self.assertEqual(self.new_doc(title=title)['data'], {'doc_id': 'doc1', 'web_link': 'link1'})
+        self.operator.create_doc.assert_called_once_with(title, 'student1', 'essay')
+
+    def test_requests_without_key_are_recorded(self):
+        self.operator.make_copy.return_value = ('copy1', 'link2')
+        self.client.get('/api/v1/copy_doc/', {'source_doc_id': 'template', 'title': 't'})
+        self.client.get('/api/v1/copy_doc/', {'source_doc_id': 'template', 'title': 't'})
+        self.assertEqual(self.operator.make_copy.call_count, 2)
+        self.assertEqual(Document.objects.get(source_doc_id='template').doc_id, 'copy1')
+
+    def test_async_retry_returns_same_job_then_doc(self):
+        job_id = self.new_doc(**{'async': '1'})['data']['job_id']
+        self.assertEqual(self.new_doc(**{'async': '1'})['data']['job_id'], job_id)
+        run_job(claim_next_job('worker'))
+        self.assertEqual(self.new_doc(**{'async': '1'})['data'], {'doc_id': 'doc1', 'web_link': 'link1'})
+        self.assertEqual(self.new_doc()['data'], {'doc_id': 'doc1', 'web_link': 'link1'})
+        self.operator.create_doc.assert_called_once_with('t', 'student1', 'essay')
+
+    def test_concurrent_duplicates_create_one_doc(self):
+        calls = []
+
+        def create():
+            calls.append(1)
+            time.sleep(0.05)
+            return f'doc{len(calls)}', 'link'
+
+        results, errors = run_concurrently(4, lambda i: documents.run_idempotent(
+            self.user, 'key1', Document.KIND_NEW_DOC, self.params, create))
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [('doc1', 'link')] * 4)
+        self.assertEqual(len(calls), 1)
+
+
+class WarmPoolTest(TransactionTestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.server = FakeGoogleServer().start()
+        self.addCleanup(self.server.stop)
+        for patcher in (mock.patch.object(settings, 'GOOGLE_API_ROOT_URL', self.server.root_url),
+                        mock.patch.object(settings, 'WARM_POOL_ENABLED', True),
+                        mock.patch.object(settings, 'WARM_POOL_LOW_WATER', 0),
+                        mock.patch.object(settings, 'FOLDER_DB_LOCK_ENABLED', False),
+                        mock.patch.object(warm_pool, '_next_refill', float('inf'))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.server.state.add_file('root', FOLDER_MIME_TYPE, file_id=settings.DOC_ROOT_FOLDER_ID)
+        self.operator = GoogleDocOperator(credentials=AnonymousCredentials(), folder_cache=FolderCache(alias='default'))
+
+    def test_claimed_doc_is_moved_with_one_call(self):
+        self.assertEqual(warm_pool.refill_warm_pool(self.operator, high_water=3), 3)
+        self.assertEqual(warm_pool.refill_warm_pool(self.operator, high_water=3), 0)
+        folder_id = self.operator.get_or_create_folder(['student1', 'essay'])
+        calls = dict(self.server.state.calls)
+
+        doc_id, web_link = warm_pool.create_doc(self.operator, 'title', 'student1', 'essay')
+        self.assertEqual(self.server.state.calls['files.update'], 1)
+        self.assertEqual(self.server.state.calls['files.create'], calls['files.create'])
+        self.assertEqual(self.server.state.files[doc_id]['name'], 'title')
+        self.assertEqual(self.server.state.files[doc_id]['parents'], [folder_id])
+        self.assertEqual(WarmDoc.objects.filter(status=WarmDoc.STATUS_READY).count(), 2)
+        self.assertFalse(WarmDoc.objects.filter(doc_id=doc_id).exists())
+
+    @mock.patch.object(settings, 'WARM_POOL_LOW_WATER', 2)
+    def test_refill_is_triggered_by_claim_result(self):
+        warm_pool.refill_warm_pool(self.operator, high_water=4)
+        self.operator.get_or_create_folder(['student1', 'essay'])
+        with mock.patch.object(warm_pool, 'refill_warm_pool_async') as refill:
+            for remaining in (3, 2, 1):
+                # 领取时的查询同时给出剩余数量，不另外count
+                with self.assertNumQueries(3):
+                    self.assertEqual(warm_pool.claim_warm_doc()[1], remaining)
+            warm_pool.create_doc(self.operator, 'title', 'student1', 'essay')
+            refill.assert_called_once_with(0)
+        with mock.patch.object(warm_pool, '_refill_thread', None), mock.patch('threading.Thread') as thread:
+            warm_pool.refill_warm_pool_async(2)
+            thread.assert_not_called()
+            warm_pool.refill_warm_pool_async(1)
+            thread.assert_called_once()
+        with mock.patch.object(warm_pool, '_refill_thread', None), mock.patch.object(warm_pool, '_next_refill', 0), \
+                mock.patch('threading.Thread') as thread:
+            # 暂存池充足时也按WARM_POOL_CLAIM_LEASE定时补充
+            warm_pool.refill_warm_pool_async(2)
+            thread.assert_called_once()
+            self.assertGreater(warm_pool._next_refill, time.monotonic())
+
+    def test_expired_claims_are_reclaimed(self):
+        warm_pool.refill_warm_pool(self.operator, high_water=3)
+        claimed = [warm_pool.claim_warm_doc()[0] for _ in range(3)]
+        # 进程崩溃前：一个仍在暂存目录，一个已移动到用户目录，一个已被删除
+        folder_id = self.operator.get_or_create_folder(['student1', 'essay'])
+        self.operator.move_doc(claimed[1].doc_id, 'moved', claimed[1].folder_id, folder_id)
+        del self.server.state.files[claimed[2].doc_id]
+        self.assertEqual(warm_pool.reclaim_expired_claims(self.operator), 0)
+
+        expired_at = timezone.now() - datetime.timedelta(seconds=settings.WARM_POOL_CLAIM_LEASE + 1)
+        WarmDoc.objects.update(claimed_at=expired_at)
+        self.assertEqual(warm_pool.refill_warm_pool(self.operator, high_water=3), 2)
+        self.assertEqual(WarmDoc.objects.get(doc_id=claimed[0].doc_id).status, WarmDoc.STATUS_READY)
+        self.assertFalse(WarmDoc.objects.filter(doc_id__in=[claimed[1].doc_id, claimed[2].doc_id]).exists())
+        self.assertEqual(WarmDoc.objects.filter(status=WarmDoc.STATUS_READY).count(), 3)
+
+    def test_empty_pool_falls_back(self):
+        doc_id, _ = warm_pool.create_doc(self.operator, 'title', 'student1', 'essay')
+        self.assertEqual(self.server.state.files[doc_id]['name'], 'title')
+        self.assertNotIn('files.update', self.server.state.calls)
+
+    def test_missing_warm_doc_falls_back(self):
+        folder_id = self.operator.get_or_create_folder(['student1', 'essay'])
+        WarmDoc.objects.create(doc_id='deleted', folder_id='staging')
+        lists = self.server.state.calls['files.list']
+        doc_id, _ = warm_pool.create_doc(self.operator, 'title', 'student1', 'essay')
+        self.assertEqual(self.server.state.files[doc_id]['name'], 'title')
+        self.assertEqual(WarmDoc.objects.count(), 0)
+        # 暂存文档不存在时不清除用户目录的缓存
+        self.assertEqual(self.server.state.calls['files.list'], lists)
+        self.assertEqual(self.operator.get_or_create_folder(['student1', 'essay']), folder_id)
+
+    def test_missing_target_folder_is_recreated(self):
+        warm_pool.refill_warm_pool(self.operator, high_water=1)
+        old_folder = self.operator.get_or_create_folder(['student1', 'essay'])
+        del self.server.state.files[old_folder]
+        doc_id, _ = warm_pool.create_doc(self.operator, 'title', 'student1', 'essay')
+        self.assertEqual(WarmDoc.objects.count(), 0)
+        new_folder = self.server.state.files[doc_id]['parents'][0]
+        self.assertNotEqual(new_folder, old_folder)
+        self.assertEqual(self.server.state.files[new_folder]['name'], 'essay')
+
+    def test_failed_move_releases_warm_doc(self):
+        warm_pool.refill_warm_pool(self.operator, high_water=1)
+        warm_doc_id = WarmDoc.objects.get().doc_id
+        with mock.patch.object(self.operator, 'move_doc', side_effect=rate_limit_error(500, 'backendError')):
+            doc_id, _ = warm_pool.create_doc(self.operator, 'title', 'student1', 'essay')
+        self.assertNotEqual(doc_id, warm_doc_id)
+        self.assertEqual(WarmDoc.objects.get().status, WarmDoc.STATUS_READY)
+        self.assertEqual(self.server.state.files[warm_doc_id]['parents'], [WarmDoc.objects.get().folder_id])
+
+    def test_move_that_succeeded_before_error_is_not_repeated(self):
+        warm_pool.refill_warm_pool(self.operator, high_water=1)
+        warm_doc_id = WarmDoc.objects.get().doc_id
+        self.operator.get_or_create_folder(['student1', 'essay'])
+        move_doc = self.operator.move_doc
+
+        def move_then_time_out(*args):
+            move_doc(*args)
+            raise TimeoutError('timed out')
+
+        creates = self.server.state.calls['files.create']
+        with mock.patch.object(self.operator, 'move_doc', side_effect=move_then_time_out):
+            doc_id, _ = warm_pool.create_doc(self.operator, 'title', 'student1', 'essay')
+        self.assertEqual(doc_id, warm_doc_id)
+        self.assertEqual(self.server.state.calls['files.create'], creates)
+        self.assertEqual(WarmDoc.objects.count(), 0)
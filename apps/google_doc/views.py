@@ -1,10 +1,74 @@
+import json
+import math
+import re
+import tempfile
+import zipfile
+
 from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from common.logger import logger
-from common.utils import CheckParamMixin, ValidationException, ResponseCode, GoogleDocOperator, GoogleAuthType
+from apps.google_doc import documents, warm_pool
+from apps.google_doc.jobs import submit_job
+from apps.google_doc.models import Document, Job
+from common import metrics
+from common.api_executor import is_rate_limit_error
+from common.doc_text import TEXT_FORMATS, render_blocks
+from common.logger import logger, payload
+from common.operator_pool import operator_pool
+from common.rate_limit import RateLimitedError
+from common.utils import EXPORT_FORMATS, CheckParamMixin, ValidationException, ResponseCode, is_not_found_error
+
+
+def job_submitted_response(job):
+    return {'code': ResponseCode.SUCCESS.value, 'message': 'ok', 'data': {'job_id': job.id, 'status': job.status}}
+
+
+def get_idempotency_key(request):
+    """
+    :return: 请求头Idempotency-Key，没有时返回None
+    """
+    idempotency_key = request.META.get('HTTP_IDEMPOTENCY_KEY', '').strip()
+    if len(idempotency_key) > 255:
+        raise ValidationException('Idempotency-Key should be at most 255 characters')
+    return idempotency_key or None
+
+
+def rate_limited_response(e):
+    """
+    google api限流时的响应，带Retry-After头，客户端应等待该时间后再重试，立即重试只会加重限流
+
+    :param e: RateLimitedError
+    """
+    logger.warning(f'rate limited: {e}')
+    retry_after = max(1, math.ceil(e.retry_after or 1))
+    return Response({'code': ResponseCode.RATE_LIMITED.value, 'message': settings.RATE_LIMITED_RESP_PROMPT,
+                     'data': {'retry_after': retry_after}}, headers={'Retry-After': str(retry_after)})
+
+
+def in_progress_response(e):
+    """
+    同一Idempotency-Key的请求仍在处理中时的响应，带Retry-After头，客户端重试时会得到第一个请求创建的文档
+
+    :param e: IdempotentRequestInProgress
+    """
+    logger.warning(str(e))
+    retry_after = settings.IDEMPOTENCY_RETRY_AFTER
+    return Response({'code': ResponseCode.IN_PROGRESS.value, 'message': settings.IN_PROGRESS_RESP_PROMPT,
+                     'data': {'retry_after': retry_after}}, headers={'Retry-After': str(retry_after)})
+
+
+def item_error(e):
+    """
+    批量接口中单项失败的结果
+
+    :param e: 该项的异常
+    """
+    if isinstance(e, RateLimitedError) or is_rate_limit_error(e):
+        return {'code': ResponseCode.RATE_LIMITED.value, 'message': settings.RATE_LIMITED_RESP_PROMPT}
+    return {'code': ResponseCode.UNKNOWN_ERROR.value, 'message': settings.UNKNOWN_ERROR_RESP_PROMPT}
 
 
 class NewDocView(APIView, CheckParamMixin):
@@ -24,20 +88,44 @@ class NewDocView(APIView, CheckParamMixin):
                     "web_link": "https://docs.google.com/document/d/12AjXbkTk-_u4EMavRzhVzdQ8RifApJ7GkruZN30GGX4/edit?usp=drivesdk"
                 }
             }
+
+        加上 async=1 参数时立即返回任务id，随后通过 /api/v1/jobs/<job_id>/ 查询结果:
+            {"code": 200, "message": "ok", "data": {"job_id": 12, "status": "pending"}}
+
+        带上请求头 Idempotency-Key: <客户端生成的唯一值> 时，同一用户以同一个key重试或重复的请求不会再创建文档，
+        直接返回第一次请求创建的文档(async=1时返回同一个任务或已创建的文档)
         """  # noqa
         try:
             in_data = request.query_params
-            logger.info(in_data)
+            logger.info(payload(in_data))
             for field in ('username', 'title', 'folder'):
                 self.validate_common_data(in_data, field)
 
-            operator = GoogleDocOperator(GoogleAuthType.SERVICE_ACCOUNT_KEY)
-            doc_id, web_link = operator.create_doc(in_data['title'], in_data['username'], in_data['folder'])
+            params = {field: in_data[field] for field in ('username', 'title', 'folder')}
+            idempotency_key = get_idempotency_key(request)
+            if self.validate_boolean_params(in_data.get('async'), 'async', default_value=False):
+                document = idempotency_key and documents.get_idempotent_document(
+                    request.user, idempotency_key, Document.KIND_NEW_DOC, params)
+                if not document:
+                    return Response(job_submitted_response(
+                        submit_job(Job.KIND_NEW_DOC, params, request.user, idempotency_key)))
+                doc_id, web_link = document.doc_id, document.web_link
+            else:
+                def create():
+                    with operator_pool.checkout() as operator:
+                        return warm_pool.create_doc(operator, params['title'], params['username'], params['folder'])
+
+                doc_id, web_link = documents.run_idempotent(request.user, idempotency_key, Document.KIND_NEW_DOC,
+                                                            params, create)
             result = {'code': ResponseCode.SUCCESS.value, 'message': 'ok',
                       'data': {'doc_id': doc_id, 'web_link': web_link}}
             return Response(result)
         except ValidationException as e:
             return Response({'code': ResponseCode.REGULAR_ERROR.value, 'message': str(e)})
+        except documents.IdempotentRequestInProgress as e:
+            return in_progress_response(e)
+        except RateLimitedError as e:
+            return rate_limited_response(e)
         except Exception as e:
             logger.exception(str(e))
             return Response({'code': ResponseCode.UNKNOWN_ERROR.value, 'message': settings.UNKNOWN_ERROR_RESP_PROMPT})
@@ -61,19 +149,527 @@ class CopyDocView(APIView, CheckParamMixin):
                     "web_link":"https://docs.google.com/document/d/1tVYBras4yJEEHdhx2mkH2SOJ8ATzzvpMEnMYfoAIS20/edit?usp=drivesdk"
                     }
                 }
+
+        加上 async=1 参数时立即返回任务id，随后通过 /api/v1/jobs/<job_id>/ 查询结果:
+            {"code": 200, "message": "ok", "data": {"job_id": 13, "status": "pending"}}
+
+        带上请求头 Idempotency-Key: <客户端生成的唯一值> 时，同一用户以同一个key重试或重复的请求不会再创建文档，
+        直接返回第一次请求创建的文档(async=1时返回同一个任务或已创建的文档)
         """  # noqa
         try:
             in_data = request.query_params
             for field in ('source_doc_id', 'title'):
                 self.validate_common_data(in_data, field)
 
-            operator = GoogleDocOperator(GoogleAuthType.SERVICE_ACCOUNT_KEY)
-            target_doc_id, web_link = operator.make_copy(in_data['source_doc_id'], in_data['title'])
+            params = {field: in_data[field] for field in ('source_doc_id', 'title')}
+            idempotency_key = get_idempotency_key(request)
+            if self.validate_boolean_params(in_data.get('async'), 'async', default_value=False):
+                document = idempotency_key and documents.get_idempotent_document(
+                    request.user, idempotency_key, Document.KIND_COPY_DOC, params)
+                if not document:
+                    return Response(job_submitted_response(
+                        submit_job(Job.KIND_COPY_DOC, params, request.user, idempotency_key)))
+                target_doc_id, web_link = document.doc_id, document.web_link
+            else:
+                def copy():
+                    with operator_pool.checkout() as operator:
+                        return operator.make_copy(params['source_doc_id'], params['title'])
+
+                target_doc_id, web_link = documents.run_idempotent(
+                    request.user, idempotency_key, Document.KIND_COPY_DOC, params, copy)
             result = {'code': ResponseCode.SUCCESS.value, 'message': 'ok',
                       'data': {'target_doc_id': target_doc_id, 'web_link': web_link}}
             return Response(result)
         except ValidationException as e:
             return Response({'code': ResponseCode.REGULAR_ERROR.value, 'message': str(e)})
+        except documents.IdempotentRequestInProgress as e:
+            return in_progress_response(e)
+        except RateLimitedError as e:
+            return rate_limited_response(e)
+        except Exception as e:
+            logger.exception(str(e))
+            return Response({'code': ResponseCode.UNKNOWN_ERROR.value, 'message': settings.UNKNOWN_ERROR_RESP_PROMPT})
+
+
+class BulkNewDocView(APIView, CheckParamMixin):
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request):
+        """
+        Run:
+            curl -H 'Authorization: Token xxx' -H "Content-Type: application/json" --request POST http://127.0.0.1:8000/api/v1/new_docs/ -d '{"docs": [{"username": "student1", "folder": "dukeabaacde", "title": "学生文书1"}, {"username": "student2", "folder": "dukeabaacde", "title": "学生文书2"}]}'
+
+        you will get a `Response` like, results与请求中docs顺序一致:
+            {
+                "code": 200,   // 其余代码代表失败
+                "message": "ok",
+                "data": {
+                    "results": [
+                        {
+                            "code": 200,
+                            "doc_id": "12AjXbkTk-_u4EMavRzhVzdQ8RifApJ7GkruZN30GGX4",
+                            "web_link": "https://docs.google.com/document/d/12AjXbkTk-_u4EMavRzhVzdQ8RifApJ7GkruZN30GGX4/edit?usp=drivesdk"
+                        },
+                        {
+                            "code": 400,   // 单个文档失败
+                            "message": "title is required"
+                        }
+                    ]
+                }
+            }
+        """  # noqa
+        try:
+            docs = self.check_list(request.data, 'docs')
+            if len(docs) > settings.BULK_NEW_DOC_MAX_ITEMS:
+                raise ValidationException(f'at most {settings.BULK_NEW_DOC_MAX_ITEMS} docs per request')
+            logger.info(f'bulk new_doc request for {len(docs)} docs')
+
+            results = [None] * len(docs)
+            valid_indexes = []
+            for i, doc in enumerate(docs):
+                try:
+                    if not isinstance(doc, dict):
+                        raise ValidationException('each doc should be an object')
+                    for field in ('username', 'title', 'folder'):
+                        self.validate_common_data(doc, field)
+                    valid_indexes.append(i)
+                except ValidationException as e:
+                    results[i] = {'code': ResponseCode.REGULAR_ERROR.value, 'message': str(e)}
+
+            with operator_pool.checkout() as operator:
+                created = operator.create_docs([docs[i] for i in valid_indexes])
+            records = []
+            for i, item in zip(valid_indexes, created):
+                if isinstance(item, Exception):
+                    results[i] = item_error(item)
+                else:
+                    results[i] = {'code': ResponseCode.SUCCESS.value, 'doc_id': item[0], 'web_link': item[1]}
+                    records.append(documents.build_document(
+                        Document.KIND_NEW_DOC, item[0], item[1], request.user,
+                        **{field: docs[i][field] for field in ('username', 'title', 'folder')}))
+            documents.record_documents(records)
+            result = {'code': ResponseCode.SUCCESS.value, 'message': 'ok', 'data': {'results': results}}
+            return Response(result)
+        except ValidationException as e:
+            return Response({'code': ResponseCode.REGULAR_ERROR.value, 'message': str(e)})
+        except RateLimitedError as e:
+            return rate_limited_response(e)
+        except Exception as e:
+            logger.exception(str(e))
+            return Response({'code': ResponseCode.UNKNOWN_ERROR.value, 'message': settings.UNKNOWN_ERROR_RESP_PROMPT})
+
+
+class BulkCopyDocView(APIView, CheckParamMixin):
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request):
+        """
+        把一个模板文档拷贝成多份，不指定username和folder时拷贝到模板所在目录，否则拷贝到对应学生的目录下
+
+        Run:
+            curl -N -H 'Authorization: Token xxx' -H "Content-Type: application/json" --request POST http://127.0.0.1:8000/api/v1/copy_doc/bulk/ -d '{"source_doc_id": "1YwBFXg_moYpgyOQ_74DnPxbDKnY7XWYj7vcnLNb8ks8", "copies": [{"title": "学生1文书"}, {"title": "学生2文书", "username": "student2", "folder": "dukeabaacde"}]}'
+
+        参数错误时返回普通的json结果；否则返回 application/x-ndjson 流，每完成一份拷贝输出一行，顺序为完成顺序，
+        index为该拷贝在copies中的下标:
+            {"index": 1, "code": 200, "target_doc_id": "1tVYBras4yJEEHdhx2mkH2SOJ8ATzzvpMEnMYfoAIS20", "web_link": "https://docs.google.com/document/d/1tVYBras4yJEEHdhx2mkH2SOJ8ATzzvpMEnMYfoAIS20/edit?usp=drivesdk"}
+            {"index": 0, "code": 500, "message": "an error occurred on the server"}
+        """  # noqa
+        try:
+            source_doc_id = self.validate_common_data(request.data, 'source_doc_id')
+            copies = self.check_list(request.data, 'copies')
+            if len(copies) > settings.BULK_COPY_DOC_MAX_ITEMS:
+                raise ValidationException(f'at most {settings.BULK_COPY_DOC_MAX_ITEMS} copies per request')
+            for copy in copies:
+                if not isinstance(copy, dict):
+                    raise ValidationException('each copy should be an object')
+                self.validate_common_data(copy, 'title')
+                if copy.get('username') or copy.get('folder'):
+                    for field in ('username', 'folder'):
+                        self.validate_common_data(copy, field)
+            logger.info(f'bulk copy_doc request for {len(copies)} copies of {source_doc_id}')
+
+            with operator_pool.checkout() as operator:
+                folder_ids = operator.resolve_copy_targets(source_doc_id, copies)
+        except ValidationException as e:
+            return Response({'code': ResponseCode.REGULAR_ERROR.value, 'message': str(e)})
+        except RateLimitedError as e:
+            return rate_limited_response(e)
         except Exception as e:
             logger.exception(str(e))
             return Response({'code': ResponseCode.UNKNOWN_ERROR.value, 'message': settings.UNKNOWN_ERROR_RESP_PROMPT})
+
+        response = StreamingHttpResponse(self._stream_copies(source_doc_id, copies, folder_ids, request.user),
+                                         content_type='application/x-ndjson')
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    @staticmethod
+    def _stream_copies(source_doc_id, copies, folder_ids, owner):
+        def line(index, result):
+            if isinstance(result, Exception):
+                item = {'index': index, **item_error(result)}
+            else:
+                item = {'index': index, 'code': ResponseCode.SUCCESS.value,
+                        'target_doc_id': result[0], 'web_link': result[1]}
+            return json.dumps(item, ensure_ascii=False) + '\n'
+
+        targets = []
+        for index, folder_id in enumerate(folder_ids):
+            if isinstance(folder_id, Exception):
+                yield line(index, folder_id)
+            else:
+                targets.append((index, copies[index]['title'], folder_id))
+
+        chunks = [targets[i:i + settings.BULK_COPY_DOC_BATCH_SIZE]
+                  for i in range(0, len(targets), settings.BULK_COPY_DOC_BATCH_SIZE)]
+        done = set()
+        try:
+            for results in operator_pool.imap_unordered(
+                    lambda operator, chunk: operator.copy_to_folders(source_doc_id, chunk),
+                    chunks, settings.BULK_COPY_DOC_MAX_WORKERS):
+                documents.record_documents([
+                    documents.build_document(Document.KIND_COPY_DOC, result[0], result[1], owner,
+                                             source_doc_id=source_doc_id, title=copies[index]['title'],
+                                             username=copies[index].get('username'),
+                                             folder=copies[index].get('folder'))
+                    for index, result in results.items() if not isinstance(result, Exception)])
+                for index, result in results.items():
+                    done.add(index)
+                    yield line(index, result)
+        except Exception as e:
+            logger.exception(f'bulk copy of {source_doc_id} failed: {e}')
+            for index, _, _ in targets:
+                if index not in done:
+                    yield line(index, e)
+
+
+def etag_matches(if_none_match, etag):
+    """
+    :param if_none_match: 请求头If-None-Match，可以是逗号分隔的多个ETag或*
+    :param etag: 当前的ETag(带引号)
+    :return: bool
+    """
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    # If-None-Match使用弱比较
+    return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+
+class DocView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, doc_id):
+        """
+        返回google doc api对该文档的get结果
+
+        Run:
+            curl -i -H 'Authorization: Token xxx' --request GET http://127.0.0.1:8000/api/v1/doc/1IUDZmR0P9Z0AdWTnZnL12kJrMHMVl7pA1bU6p2gkeCU/
+
+        you will get a `Response` like, 响应头ETag为文档的revisionId:
+            {
+                "code": 200,
+                "message": "ok",
+                "data": {"title": "文书测试", "body": {"content": ...}, "revisionId": "ANeT5PQ1_xnZ...", "documentId": "1IUDZmR0P9Z0AdWTnZnL12kJrMHMVl7pA1bU6p2gkeCU", ...}
+            }
+
+        带上请求头 If-None-Match: <上次响应的ETag> 且文档未修改时返回 304 Not Modified，没有响应体；
+        服务端每次只用一次drive files().get(fields=version,modifiedTime)判断文档是否修改，未修改时使用缓存的文档
+        """  # noqa
+        try:
+            with operator_pool.checkout() as operator:
+                entry = operator.get_cached_doc(doc_id)
+        except RateLimitedError as e:
+            return rate_limited_response(e)
+        except Exception as e:
+            if is_not_found_error(e):
+                return Response({'code': ResponseCode.REGULAR_ERROR.value, 'message': f'doc {doc_id} not found'})
+            logger.exception(str(e))
+            return Response({'code': ResponseCode.UNKNOWN_ERROR.value, 'message': settings.UNKNOWN_ERROR_RESP_PROMPT})
+
+        etag = f'"{entry.revision_id or entry.version}"'
+        if etag_matches(request.META.get('HTTP_IF_NONE_MATCH'), etag):
+            response = HttpResponse(status=304)
+        else:
+            # 缓存中已是序列化好的json，直接拼接响应体，不重新序列化整个文档
+            response = HttpResponse(
+                b'{"code":%d,"message":"ok","data":%s}' % (ResponseCode.SUCCESS.value, entry.body),
+                content_type='application/json')
+        response['ETag'] = etag
+        # 客户端可以缓存，但每次使用前都需要带If-None-Match重新验证
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+class DocTextView(APIView, CheckParamMixin):
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, doc_id):
+        """
+        按文档顺序输出正文中的标题、段落、列表项和表格单元格的文字，分块(chunked)流式返回
+
+        Run:
+            curl -N -H 'Authorization: Token xxx' --request GET http://127.0.0.1:8000/api/v1/doc/1IUDZmR0P9Z0AdWTnZnL12kJrMHMVl7pA1bU6p2gkeCU/text/?output=ndjson
+
+        output=text(默认) 返回 text/plain，每块一行；output=ndjson 返回 application/x-ndjson，每块一行json:
+            {"type": "heading", "text": "第一部分", "start_index": 1, "level": 1}
+            {"type": "paragraph", "text": "正文", "start_index": 12}
+            {"type": "list_item", "text": "要点", "start_index": 40, "level": 0}
+            {"type": "table_cell", "text": "单元格", "start_index": 80, "table": 79, "row": 0, "column": 1}
+
+        参数错误或获取文档失败时返回普通的json结果
+        """  # noqa
+        try:
+            # 不使用format参数名，DRF用它选择renderer
+            fmt = self.validate_common_data(request.query_params, 'output', required=False, default_value='text')
+            if fmt not in TEXT_FORMATS:
+                raise ValidationException(f'output should be one of {", ".join(TEXT_FORMATS)}')
+            with operator_pool.checkout() as operator:
+                blocks = operator.iter_doc_blocks(doc_id)
+        except ValidationException as e:
+            return Response({'code': ResponseCode.REGULAR_ERROR.value, 'message': str(e)})
+        except RateLimitedError as e:
+            return rate_limited_response(e)
+        except Exception as e:
+            if is_not_found_error(e):
+                return Response({'code': ResponseCode.REGULAR_ERROR.value, 'message': f'doc {doc_id} not found'})
+            logger.exception(str(e))
+            return Response({'code': ResponseCode.UNKNOWN_ERROR.value, 'message': settings.UNKNOWN_ERROR_RESP_PROMPT})
+
+        content_type = 'text/plain; charset=utf-8' if fmt == 'text' else 'application/x-ndjson'
+        response = StreamingHttpResponse(render_blocks(blocks, fmt), content_type=content_type)
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+def stream_export(doc_id, fmt):
+    """
+    导出文档的bytes块生成器，整个下载过程中持有一个operator，生成器关闭(如客户端断开)时归还
+    """
+    with operator_pool.checkout() as operator:
+        yield from operator.export_doc(doc_id, fmt)
+
+
+def export_error(doc_id, e):
+    """
+    导出单个文档失败时的结果
+    """
+    if is_not_found_error(e):
+        return {'code': ResponseCode.REGULAR_ERROR.value, 'message': f'doc {doc_id} not found'}
+    return item_error(e)
+
+
+class ExportFormatMixin(CheckParamMixin):
+    """
+    导出接口的format参数；DRF默认用format参数选择renderer，这里不做该选择，错误时仍返回json
+    """
+
+    def perform_content_negotiation(self, request, force=False):
+        return super().perform_content_negotiation(request, force=True)
+
+    def validate_export_format(self, in_data):
+        fmt = self.validate_common_data(in_data, 'format', required=False, default_value='pdf')
+        if fmt not in EXPORT_FORMATS:
+            raise ValidationException(f'format should be one of {", ".join(EXPORT_FORMATS)}')
+        return fmt
+
+
+class DocExportView(ExportFormatMixin, APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, doc_id):
+        """
+        导出文档为pdf、docx或txt文件，按EXPORT_CHUNK_SIZE从drive分块下载并分块(chunked)流式返回，不缓存整个文件
+
+        Run:
+            curl -OJ -H 'Authorization: Token xxx' --request GET 'http://127.0.0.1:8000/api/v1/doc/1IUDZmR0P9Z0AdWTnZnL12kJrMHMVl7pA1bU6p2gkeCU/export/?format=docx'
+
+        format默认为pdf；参数错误或第一块下载失败时返回普通的json结果，之后的下载失败时响应被截断
+        """  # noqa
+        try:
+            fmt = self.validate_export_format(request.query_params)
+            chunks = stream_export(doc_id, fmt)
+            # 先下载第一块，文档不存在等错误仍可以返回json结果
+            first = next(chunks, b'')
+        except ValidationException as e:
+            return Response({'code': ResponseCode.REGULAR_ERROR.value, 'message': str(e)})
+        except RateLimitedError as e:
+            return rate_limited_response(e)
+        except Exception as e:
+            if is_not_found_error(e):
+                return Response({'code': ResponseCode.REGULAR_ERROR.value, 'message': f'doc {doc_id} not found'})
+            logger.exception(str(e))
+            return Response({'code': ResponseCode.UNKNOWN_ERROR.value, 'message': settings.UNKNOWN_ERROR_RESP_PROMPT})
+
+        content_type = EXPORT_FORMATS[fmt] + ('; charset=utf-8' if fmt == 'txt' else '')
+        response = StreamingHttpResponse(self._stream(doc_id, first, chunks), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{doc_id}.{fmt}"'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    @staticmethod
+    def _stream(doc_id, first, chunks):
+        try:
+            yield first
+            yield from chunks
+        except Exception as e:
+            logger.exception(f'export of {doc_id} failed: {e}')
+        finally:
+            chunks.close()
+
+
+class _ZipOutput(object):
+    """
+    zipfile写入的不可seek的输出，写入的数据由生成器取走后返回给客户端
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+class BulkDocExportView(ExportFormatMixin, APIView):
+    permission_classes = (IsAuthenticated,)
+
+    DOC_ID_PATTERN = re.compile(r'^[\w-]+$')
+
+    def post(self, request):
+        """
+        把多个文档导出为zip文件流式返回，文件名为 <doc_id>.<format>，导出失败的文档记录在zip中的errors.json
+
+        Run:
+            curl -o docs.zip -H 'Authorization: Token xxx' -H "Content-Type: application/json" --request POST http://127.0.0.1:8000/api/v1/doc/export/bulk/ -d '{"doc_ids": ["1IUDZmR0P9Z0AdWTnZnL12kJrMHMVl7pA1bU6p2gkeCU", "12AjXbkTk-_u4EMavRzhVzdQ8RifApJ7GkruZN30GGX4"], "format": "pdf"}'
+
+        同时最多下载BULK_EXPORT_MAX_WORKERS个文档，按下载完成的顺序写入zip；参数错误时返回普通的json结果:
+            errors.json: [{"doc_id": "...", "code": 400, "message": "doc ... not found"}]
+        """  # noqa
+        try:
+            fmt = self.validate_export_format(request.data)
+            doc_ids = list(dict.fromkeys(self.check_list(request.data, 'doc_ids')))
+            if len(doc_ids) > settings.BULK_EXPORT_MAX_ITEMS:
+                raise ValidationException(f'at most {settings.BULK_EXPORT_MAX_ITEMS} docs per request')
+            for doc_id in doc_ids:
+                if not isinstance(doc_id, str) or not self.DOC_ID_PATTERN.match(doc_id):
+                    raise ValidationException(f'invalid doc id {doc_id}')
+            logger.info(f'bulk export of {len(doc_ids)} docs as {fmt}')
+        except ValidationException as e:
+            return Response({'code': ResponseCode.REGULAR_ERROR.value, 'message': str(e)})
+        except Exception as e:
+            logger.exception(str(e))
+            return Response({'code': ResponseCode.UNKNOWN_ERROR.value, 'message': settings.UNKNOWN_ERROR_RESP_PROMPT})
+
+        response = StreamingHttpResponse(self._stream_zip(doc_ids, fmt), content_type='application/zip')
+        response['Content-Disposition'] = f'attachment; filename="docs-{fmt}.zip"'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    @staticmethod
+    def _download(operator, task):
+        """
+        :return: (doc_id, 读取位置在开头的临时文件或异常)
+        """
+        doc_id, fmt = task
+        spool = tempfile.SpooledTemporaryFile(max_size=settings.BULK_EXPORT_SPOOL_MAX_BYTES)
+        try:
+            for chunk in operator.export_doc(doc_id, fmt):
+                spool.write(chunk)
+        except Exception as e:
+            spool.close()
+            if not is_not_found_error(e):
+                logger.exception(f'export of {doc_id} failed: {e}')
+            return doc_id, e
+        spool.seek(0)
+        return doc_id, spool
+
+    @classmethod
+    def _stream_zip(cls, doc_ids, fmt):
+        output = _ZipOutput()
+        errors = []
+        done = set()
+        # pdf和docx本身已压缩
+        compression = zipfile.ZIP_DEFLATED if fmt == 'txt' else zipfile.ZIP_STORED
+        with zipfile.ZipFile(output, 'w', compression=compression) as archive:
+            try:
+                # 最多积压2倍并发数的已下载文档，客户端接收较慢时不会把所有文档都下载下来
+                for doc_id, result in operator_pool.imap_unordered(
+                        cls._download, [(doc_id, fmt) for doc_id in doc_ids], settings.BULK_EXPORT_MAX_WORKERS,
+                        max_pending=2 * settings.BULK_EXPORT_MAX_WORKERS):
+                    done.add(doc_id)
+                    if isinstance(result, Exception):
+                        errors.append({'doc_id': doc_id, **export_error(doc_id, result)})
+                        continue
+                    with result, archive.open(f'{doc_id}.{fmt}', 'w') as entry:
+                        for chunk in iter(lambda: result.read(settings.EXPORT_CHUNK_SIZE), b''):
+                            entry.write(chunk)
+                            data = output.take()
+                            if data:
+                                yield data
+            except Exception as e:
+                logger.exception(f'bulk export failed: {e}')
+                errors.extend({'doc_id': doc_id, **export_error(doc_id, e)} for doc_id in doc_ids if doc_id not in done)
+            if errors:
+                archive.writestr('errors.json', json.dumps(errors, ensure_ascii=False, indent=2))
+        yield output.take()
+
+
+class JobView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, job_id):
+        """
+        Run:
+            curl -H 'Authorization: Token xxx' --request GET http://127.0.0.1:8000/api/v1/jobs/12/
+
+        you will get a `Response` like, status为 pending/running/succeeded/failed，result与同步接口的data一致:
+            {
+                "code": 200,
+                "message": "ok",
+                "data": {
+                    "job_id": 12,
+                    "kind": "new_doc",
+                    "status": "succeeded",
+                    "result": {
+                        "doc_id": "12AjXbkTk-_u4EMavRzhVzdQ8RifApJ7GkruZN30GGX4",
+                        "web_link": "https://docs.google.com/document/d/12AjXbkTk-_u4EMavRzhVzdQ8RifApJ7GkruZN30GGX4/edit?usp=drivesdk"
+                    }
+                }
+            }
+        """  # noqa
+        try:
+            job = Job.objects.filter(id=job_id, owner=request.user).first()
+            if job is None:
+                raise ValidationException(f'job {job_id} not found')
+            data = {'job_id': job.id, 'kind': job.kind, 'status': job.status,
+                    'result': json.loads(job.result) if job.result else None}
+            if job.status == Job.STATUS_FAILED:
+                data['message'] = settings.UNKNOWN_ERROR_RESP_PROMPT
+            return Response({'code': ResponseCode.SUCCESS.value, 'message': 'ok', 'data': data})
+        except ValidationException as e:
+            return Response({'code': ResponseCode.REGULAR_ERROR.value, 'message': str(e)})
+        except Exception as e:
+            logger.exception(str(e))
+            return Response({'code': ResponseCode.UNKNOWN_ERROR.value, 'message': settings.UNKNOWN_ERROR_RESP_PROMPT})
+
+
+class MetricsView(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        """
+        Run:
+            curl -H 'Authorization: Token xxx' http://127.0.0.1:8000/metrics
+
+        返回本进程的prometheus text格式指标：google api各方法的请求数(按状态)、网络耗时直方图、重试次数和令牌桶等待时间，
+        以及各view的请求耗时直方图；prometheus的scrape配置中用 authorization: {type: Token, credentials: xxx} 认证
+        """
+        return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,209 @@
+import threading
+import time
+from datetime import timedelta
+
+from django.db import connection
+from django.utils import timezone
+
+from apps.google_doc.models import WarmDoc
+from common.locks import LockTimeout, db_lock
+from common.logger import logger
+from common.operator_pool import operator_pool
+from common.utils import is_not_found_error
+from maze_google_doc import settings
+
+
+def claim_warm_doc():
+    """
+    领取一个暂存的空白文档，通过带状态条件的update保证同一文档只会被一个请求领取
+
+    :return: (WarmDoc，暂存池为空时为None; 领取后暂存池剩余的文档数，最多统计到WARM_POOL_LOW_WATER)
+    """
+    # 多取出一些候选，同时用于判断是否低于low water，不需要单独count
+    candidate_ids = list(WarmDoc.objects.filter(status=WarmDoc.STATUS_READY).order_by('id').values_list(
+        'id', flat=True)[:max(10, settings.WARM_POOL_LOW_WATER + 1)])
+    for i, warm_doc_id in enumerate(candidate_ids):
+        if WarmDoc.objects.filter(id=warm_doc_id, status=WarmDoc.STATUS_READY).update(
+                status=WarmDoc.STATUS_CLAIMED, claimed_at=timezone.now()):
+            return WarmDoc.objects.get(id=warm_doc_id), len(candidate_ids) - i - 1
+    return None, 0
+
+
+def release_warm_doc(warm_doc):
+    """
+    把领取后未移动的文档放回暂存池
+    """
+    WarmDoc.objects.filter(id=warm_doc.id).update(status=WarmDoc.STATUS_READY, claimed_at=None)
+
+
+def move_warm_doc(operator, warm_doc, title, folder_list):
+    """
+    把领取的暂存文档改名并移动到folder_list对应的目录；移动失败时查询文档的位置以区分：
+    暂存文档已不存在、目标目录已不存在(清除缓存后重试一次)、移动实际已成功(如响应超时)、文档仍在暂存目录
+
+    :param warm_doc: 已领取的WarmDoc
+    :param folder_list: 目标目录名称列表
+    :return: (生成文件file id, 生成文件link)，暂存文档已不存在时返回None；
+        失败时抛出异常，文档仍在暂存目录时放回暂存池，无法确定位置时交给删除队列
+    """
+    for attempt in range(2):
+        try:
+            folder_id = operator.get_or_create_folder(folder_list)
+            if not folder_id:
+                raise ValueError(f'failed to create folder {folder_list}')
+        except Exception:
+            release_warm_doc(warm_doc)
+            raise
+        try:
+            result = operator.move_doc(warm_doc.doc_id, title, warm_doc.folder_id, folder_id)
+        except Exception as e:
+            error = e
+        else:
+            warm_doc.delete()
+            return result
+
+        try:
+            file = operator._execute(operator.drive_service.files().get(
+                fileId=warm_doc.doc_id, fields='parents,webViewLink'))
+        except Exception as e:
+            warm_doc.delete()
+            if is_not_found_error(e):
+                logger.warning(f'warm doc {warm_doc.doc_id} is gone')
+                return None
+            # 不确定是否已移动到用户目录，不能再被领取
+            logger.warning(f'failed to locate warm doc {warm_doc.doc_id}, leaving it to the delete queue: {e}')
+            operator.delete_queue.put(warm_doc.doc_id)
+            raise error
+        parents = file.get('parents') or []
+        if folder_id in parents:
+            logger.info(f'warm doc {warm_doc.doc_id} was moved despite {error}')
+            warm_doc.delete()
+            return warm_doc.doc_id, file.get('webViewLink')
+        if warm_doc.folder_id not in parents:
+            logger.warning(f'warm doc {warm_doc.doc_id} was moved out of the warm pool')
+            warm_doc.delete()
+            return None
+        if attempt == 0 and is_not_found_error(error):
+            logger.warning(f'folder {folder_id} for {folder_list} not found, invalidating cache')
+            operator.folder_cache.invalidate_path(folder_list, settings.DOC_ROOT_FOLDER_ID)
+            continue
+        release_warm_doc(warm_doc)
+        raise error
+
+
+def create_doc(operator, title, username, direct_folder):
+    """
+    new_doc的入口：开启WARM_POOL_ENABLED时优先领取暂存的空白文档，一次files().update改名并移动到用户目录；
+    暂存池为空或移动失败时退回operator.create_doc
+
+    :return: 生成文件file id，生成文件link
+    """
+    if not settings.WARM_POOL_ENABLED:
+        return operator.create_doc(title, username, direct_folder)
+
+    warm_doc, remaining = claim_warm_doc()
+    refill_warm_pool_async(remaining)
+    if warm_doc is None:
+        logger.info('warm pool is empty, creating doc directly')
+        return operator.create_doc(title, username, direct_folder)
+
+    try:
+        result = move_warm_doc(operator, warm_doc, title, [username, direct_folder])
+    except Exception as e:
+        logger.exception(f'failed to move warm doc {warm_doc.doc_id}, creating doc directly: {e}')
+        return operator.create_doc(title, username, direct_folder)
+    if result is None:
+        return operator.create_doc(title, username, direct_folder)
+    logger.info(f'create_doc: moved warm doc {warm_doc.doc_id} to {[username, direct_folder]} as {title}')
+    return result
+
+
+def reclaim_expired_claims(operator, lease=None):
+    """
+    处理领取后超过lease秒仍未移动或放回的文档(如领取的进程崩溃)：仍在暂存目录的放回暂存池，
+    已不存在或已被移出暂存目录的删除记录
+
+    :param operator: GoogleDocOperator
+    :param lease: 领取的有效期(秒)，默认settings.WARM_POOL_CLAIM_LEASE
+    :return: 放回暂存池的文档数量
+    """
+    lease = settings.WARM_POOL_CLAIM_LEASE if lease is None else lease
+    expired = WarmDoc.objects.filter(status=WarmDoc.STATUS_CLAIMED,
+                                     claimed_at__lt=timezone.now() - timedelta(seconds=lease))
+    released = 0
+    for warm_doc in expired.order_by('id')[:100]:
+        try:
+            file = operator._execute(operator.drive_service.files().get(fileId=warm_doc.doc_id, fields='parents'))
+        except Exception as e:
+            if not is_not_found_error(e):
+                logger.warning(f'failed to locate expired warm doc {warm_doc.doc_id}: {e}')
+                continue
+            file = {}
+        # 只处理检查期间没有被放回或重新领取的
+        claim = WarmDoc.objects.filter(id=warm_doc.id, status=WarmDoc.STATUS_CLAIMED, claimed_at=warm_doc.claimed_at)
+        if warm_doc.folder_id in (file.get('parents') or []):
+            released += claim.update(status=WarmDoc.STATUS_READY, claimed_at=None)
+        else:
+            logger.warning(f'expired warm doc {warm_doc.doc_id} is no longer in the warm pool')
+            claim.delete()
+    if released:
+        logger.info(f'released {released} expired warm doc claims')
+    return released
+
+
+def refill_warm_pool(operator, high_water=None):
+    """
+    回收过期的领取后把暂存池补充到high_water个文档；持有数据库锁，同一时刻只有一个进程在补充
+
+    :param operator: GoogleDocOperator
+    :param high_water: 目标数量，默认settings.WARM_POOL_HIGH_WATER
+    :return: 新创建的文档数量，其他进程正在补充时返回0
+    """
+    high_water = settings.WARM_POOL_HIGH_WATER if high_water is None else high_water
+    try:
+        with db_lock('warm_pool:refill', timeout=0):
+            reclaim_expired_claims(operator)
+            missing = high_water - WarmDoc.objects.filter(status=WarmDoc.STATUS_READY).count()
+            if missing <= 0:
+                return 0
+            folder_id = operator.get_or_create_folder([settings.WARM_POOL_FOLDER_NAME])
+            doc_ids = operator.create_blank_docs(folder_id, missing)
+            WarmDoc.objects.bulk_create([WarmDoc(doc_id=doc_id, folder_id=folder_id) for doc_id in doc_ids])
+            logger.info(f'warm pool refilled with {len(doc_ids)} docs')
+            return len(doc_ids)
+    except LockTimeout:
+        return 0
+
+
+_refill_thread = None
+_refill_thread_lock = threading.Lock()
+# 下一次不论暂存池数量都触发补充(回收过期的领取)的时间
+_next_refill = 0
+
+
+def refill_warm_pool_async(remaining):
+    """
+    暂存池低于WARM_POOL_LOW_WATER，或距本进程上次补充超过WARM_POOL_CLAIM_LEASE秒时在后台线程中补充，
+    本进程同一时刻最多一个补充线程
+
+    :param remaining: claim_warm_doc返回的暂存池剩余文档数
+    """
+    global _refill_thread, _next_refill
+    if remaining >= settings.WARM_POOL_LOW_WATER and time.monotonic() < _next_refill:
+        return
+    with _refill_thread_lock:
+        if _refill_thread is not None and _refill_thread.is_alive():
+            return
+        _next_refill = time.monotonic() + settings.WARM_POOL_CLAIM_LEASE
+
+        def run():
+            try:
+                with operator_pool.checkout() as operator:
+                    refill_warm_pool(operator)
+            except Exception as e:
+                logger.exception(f'failed to refill warm pool: {e}')
+            finally:
+                connection.close()
+
+        _refill_thread = threading.Thread(target=run, name='warm-pool-refill', daemon=True)
+        _refill_thread.start()
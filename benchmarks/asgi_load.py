@@ -0,0 +1,189 @@
+"""
+对比WSGI(同步view，固定线程数)与ASGI(django ASGI handler + asyncio view)在大量并发客户端下new_doc的吞吐，使用本地替身服务(benchmarks/fake_google.py)
+
+Run:
+    python -m benchmarks.asgi_load --clients 500 --requests 2000 --wsgi-threads 16 --latency 0.1
+
+在进程内直接调用WSGI/ASGI application，不经过gunicorn/uvicorn等服务器，替身服务运行在子进程中：
+WSGI用--wsgi-threads个线程处理所有客户端的请求(相当于gunicorn一个worker的--threads)，ASGI在一个事件循环中处理；
+延迟从客户端发出请求开始计算，包括在WSGI线程池中排队的时间。数据库使用临时创建的测试数据库
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'maze_google_doc.settings')
+
+import django
+
+django.setup()
+
+import mock
+from django.contrib.auth.models import User
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from google.auth.credentials import AnonymousCredentials
+from rest_framework.authtoken.models import Token
+
+from apps.google_doc import views
+from apps.google_doc.async_views import AsyncViewsASGIHandler
+from common import async_operator
+from common.async_http import AsyncHttpClient
+from common.folder_cache import FolderCache
+from common.operator_pool import GoogleDocOperatorPool
+from maze_google_doc import settings
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0
+
+
+def summarize(latencies, errors, elapsed):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+    }
+
+
+def query_string(i, students):
+    return f'username=student{i % students}&folder=essay&title=load{i}'
+
+
+def run_wsgi(application, token, total, clients, threads, students):
+    """
+    clients个客户端各自串行发送请求，由threads个线程处理
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def handle(i, sent_at):
+        environ = {
+            'REQUEST_METHOD': 'GET', 'PATH_INFO': '/api/v1/new_doc/', 'QUERY_STRING': query_string(i, students),
+            'SERVER_NAME': '127.0.0.1', 'SERVER_PORT': '80', 'HTTP_AUTHORIZATION': f'Token {token}',
+            'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr, 'wsgi.url_scheme': 'http',
+        }
+        status = []
+        body = b''.join(application(environ, lambda s, headers, exc_info=None: status.append(s)))
+        ok = status[0].startswith('200') and json.loads(body)['code'] == 200
+        with lock:
+            latencies.append(time.monotonic() - sent_at)
+            errors[0] += not ok
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        def client():
+            for i in counter:
+                pool.submit(handle, i, time.monotonic()).result()
+
+        start = time.monotonic()
+        client_threads = [threading.Thread(target=client) for _ in range(clients)]
+        for thread in client_threads:
+            thread.start()
+        for thread in client_threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+    return summarize(latencies, errors[0], elapsed)
+
+
+def run_asgi(application, token, total, clients, students):
+    latencies = []
+    errors = [0]
+    counter = iter(range(total))
+    headers = [(b'authorization', f'Token {token}'.encode())]
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def client():
+        for i in counter:
+            messages = []
+
+            async def send(message):
+                messages.append(message)
+
+            sent_at = time.monotonic()
+            scope = {'type': 'http', 'method': 'GET', 'path': '/api/v1/new_doc/',
+                     'query_string': query_string(i, students).encode(), 'headers': headers}
+            await application(scope, receive, send)
+            latencies.append(time.monotonic() - sent_at)
+            errors[0] += not (messages[0]['status'] == 200 and json.loads(messages[1]['body'])['code'] == 200)
+
+    async def main():
+        start = time.monotonic()
+        await asyncio.gather(*(client() for _ in range(clients)))
+        return time.monotonic() - start
+
+    elapsed = asyncio.run(main())
+    return summarize(latencies, errors[0], elapsed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=2000, help='每种方式的总请求数')
+    parser.add_argument('--wsgi-threads', type=int, default=16)
+    parser.add_argument('--students', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.1, help='替身服务每个http请求的模拟延迟(秒)')
+    args = parser.parse_args(argv)
+
+    if connection.vendor == 'sqlite':
+        # 内存中的sqlite测试数据库在多线程并发写入时会报table is locked，使用临时文件
+        test_db = tempfile.NamedTemporaryFile(suffix='.sqlite3', delete=False)
+        connection.settings_dict['TEST'] = dict(connection.settings_dict.get('TEST') or {}, NAME=test_db.name)
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    # 替身服务在单独的进程中运行，不与被测的application争用GIL
+    server = subprocess.Popen([sys.executable, '-m', 'benchmarks.fake_google', '--port', '0',
+                               '--latency', str(args.latency), '--root-folder-id', settings.DOC_ROOT_FOLDER_ID],
+                              stdout=subprocess.PIPE, text=True)
+    root_url = server.stdout.readline().split()[-1]
+    result = {}
+    try:
+        token = Token.objects.create(user=User.objects.create_user('load')).key
+        with mock.patch.object(settings, 'GOOGLE_API_ROOT_URL', root_url), \
+                mock.patch.object(settings, 'GOOGLE_RATE_LIMIT_ENABLED', False), \
+                mock.patch.object(settings, 'DRIVE_CHANGES_ENABLED', False):
+            folder_cache = FolderCache(alias='default')
+            pool = GoogleDocOperatorPool(credentials=AnonymousCredentials(), max_idle=args.wsgi_threads)
+            with pool.checkout() as operator:
+                operator.folder_cache = folder_cache
+                # 只比较创建文档的请求，目录预先创建好
+                for i in range(args.students):
+                    operator.get_or_create_folder([f'student{i}', 'essay'])
+            with mock.patch.object(views, 'operator_pool', pool), \
+                    mock.patch('common.utils.default_folder_cache', folder_cache):
+                result['wsgi'] = dict(run_wsgi(get_wsgi_application(), token, args.requests, args.clients,
+                                               args.wsgi_threads, args.students), threads=args.wsgi_threads)
+
+            # ASGI下所有请求共用一个AsyncGoogleDocOperator，只有目录不在缓存中时才从池中取出同步的operator
+            async_pool = GoogleDocOperatorPool(credentials=AnonymousCredentials(), max_idle=args.wsgi_threads)
+            with mock.patch('common.operator_pool.operator_pool', async_pool), \
+                    mock.patch('common.utils.default_folder_cache', folder_cache), \
+                    mock.patch.object(async_operator, 'default_folder_cache', folder_cache), \
+                    mock.patch.object(async_operator, '_async_http', AsyncHttpClient()), \
+                    mock.patch.object(async_operator, '_async_operator', None):
+                result['asgi'] = run_asgi(AsyncViewsASGIHandler(), token, args.requests, args.clients, args.students)
+    finally:
+        server.terminate()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+    result['clients'] = args.clients
+    result['google_latency'] = args.latency
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+对比逐个调用create_doc与create_docs批量创建文档的吞吐，使用本地替身服务(benchmarks/fake_google.py)
+
+Run:
+    python -m benchmarks.bulk_create --docs 500 --students 50 --latency 0.05
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'maze_google_doc.settings')
+
+import django
+
+django.setup()
+
+import mock
+from google.auth.credentials import AnonymousCredentials
+
+from benchmarks.fake_google import FOLDER_MIME_TYPE, FakeGoogleServer
+from common.folder_cache import FolderCache
+from common.utils import GoogleDocOperator
+from maze_google_doc import settings
+
+
+def make_items(docs, students, prefix):
+    return [{'username': f'{prefix}-student{i % students}', 'folder': 'essay', 'title': f'doc {i}'}
+            for i in range(docs)]
+
+
+def new_operator():
+    return GoogleDocOperator(credentials=AnonymousCredentials(), folder_cache=FolderCache(alias='default'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=500)
+    parser.add_argument('--students', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.05, help='替身服务每个http请求的模拟延迟(秒)')
+    args = parser.parse_args(argv)
+
+    result = {}
+    with FakeGoogleServer(latency=args.latency) as server, \
+            mock.patch.object(settings, 'GOOGLE_API_ROOT_URL', server.root_url), \
+            mock.patch.object(settings, 'FOLDER_DB_LOCK_ENABLED', False), \
+            mock.patch.object(settings, 'GOOGLE_RATE_LIMIT_ENABLED', False):
+        server.state.add_file('root', FOLDER_MIME_TYPE, file_id=settings.DOC_ROOT_FOLDER_ID)
+
+        operator = new_operator()
+        items = make_items(args.docs, args.students, 'sequential')
+        start = time.perf_counter()
+        for item in items:
+            operator.create_doc(item['title'], item['username'], item['folder'])
+        elapsed = time.perf_counter() - start
+        result['sequential_create_doc'] = {'docs': args.docs, 'seconds': round(elapsed, 3),
+                                           'docs_per_second': round(args.docs / elapsed, 1)}
+
+        operator = new_operator()
+        items = make_items(args.docs, args.students, 'bulk')
+        http_requests = sum(server.state.calls.values())
+        start = time.perf_counter()
+        results = operator.create_docs(items)
+        elapsed = time.perf_counter() - start
+        result['bulk_create_docs'] = {
+            'docs': args.docs, 'seconds': round(elapsed, 3), 'docs_per_second': round(args.docs / elapsed, 1),
+            'errors': sum(isinstance(item, Exception) for item in results),
+            'batch_requests': server.state.calls.get('batch', 0),
+            'drive_calls': sum(server.state.calls.values()) - http_requests,
+        }
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+在合成的大文档json上测试正文文字提取(common.doc_text)的吞吐和内存
+
+Run:
+    python -m benchmarks.doc_text --size-mb 10
+
+比较流式提取(render_blocks分块输出)与先收集全部文字块再拼接两种方式的耗时和提取过程中的内存峰值(tracemalloc)
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from common.doc_text import iter_doc_blocks, render_blocks
+
+WORDS = ('文书', '申请', 'essay', 'personal', 'statement', '学生', 'college', 'growth', '经历', 'leadership')
+
+
+def _text_run(text, start_index):
+    return {'startIndex': start_index, 'endIndex': start_index + len(text),
+            'textRun': {'content': text, 'textStyle': {'weightedFontFamily': {'fontFamily': 'Arial', 'weight': 400},
+                                                       'fontSize': {'magnitude': 11, 'unit': 'PT'}}}}
+
+
+def _paragraph(text, start_index, style='NORMAL_TEXT', bullet=False):
+    element = {
+        'startIndex': start_index,
+        'endIndex': start_index + len(text) + 1,
+        'paragraph': {
+            'elements': [_text_run(text + '\n', start_index)],
+            'paragraphStyle': {'namedStyleType': style, 'direction': 'LEFT_TO_RIGHT', 'lineSpacing': 115},
+        },
+    }
+    if bullet:
+        element['paragraph']['bullet'] = {'listId': 'kix.list1', 'nestingLevel': 0}
+    return element
+
+
+def _sentence(rnd, words):
+    return ' '.join(rnd.choice(WORDS) for _ in range(words))
+
+
+def make_document(size_bytes, seed=0):
+    """
+    生成结构与documents().get结果相同、序列化后约size_bytes字节的文档：标题、段落、列表和表格交替出现
+
+    :param size_bytes: 目标json大小
+    :param seed: 随机种子
+    :return: 文档dict
+    """
+    rnd = random.Random(seed)
+    content = [{'endIndex': 1, 'sectionBreak': {'sectionStyle': {'columnSeparatorStyle': 'NONE'}}}]
+    index = 1
+    size = 0
+    section = 0
+    while size < size_bytes:
+        section += 1
+        elements = [_paragraph(f'第{section}部分 {_sentence(rnd, 3)}', index, 'HEADING_1')]
+        for _ in range(5):
+            elements.append(_paragraph(_sentence(rnd, 60), elements[-1]['endIndex']))
+        for _ in range(3):
+            elements.append(_paragraph(_sentence(rnd, 10), elements[-1]['endIndex'], bullet=True))
+        table_index = elements[-1]['endIndex']
+        rows = []
+        for _ in range(3):
+            cells = []
+            for _ in range(3):
+                cell_index = table_index + 1
+                cells.append({'startIndex': cell_index, 'content': [_paragraph(_sentence(rnd, 5), cell_index)]})
+            rows.append({'tableCells': cells})
+        elements.append({'startIndex': table_index, 'endIndex': table_index + 100,
+                         'table': {'rows': 3, 'columns': 3, 'tableRows': rows}})
+        index = table_index + 100
+        content.extend(elements)
+        size += len(json.dumps(elements, ensure_ascii=False).encode('utf-8'))
+    return {'documentId': 'benchmark', 'title': 'benchmark', 'revisionId': 'rev', 'body': {'content': content}}
+
+
+def measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    output_bytes = fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, output_bytes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=float, default=10)
+    args = parser.parse_args(argv)
+
+    body = json.dumps(make_document(int(args.size_mb * 1024 * 1024)), ensure_ascii=False).encode('utf-8')
+    start = time.perf_counter()
+    document = json.loads(body)
+    parse_seconds = time.perf_counter() - start
+
+    def streaming(fmt):
+        def run():
+            # 模拟StreamingHttpResponse逐块发送，只统计字节数
+            return sum(len(chunk.encode('utf-8')) for chunk in render_blocks(iter_doc_blocks(document), fmt))
+        return run
+
+    def collect_then_join():
+        blocks = list(iter_doc_blocks(document))
+        return len(''.join(block['text'] + '\n' for block in blocks).encode('utf-8'))
+
+    result = {'document_json_bytes': len(body), 'blocks': sum(1 for _ in iter_doc_blocks(document)),
+              'json_parse_seconds': round(parse_seconds, 3)}
+    for name, fn in (('stream_text', streaming('text')), ('stream_ndjson', streaming('ndjson')),
+                     ('collect_then_join_text', collect_then_join)):
+        elapsed, peak, output_bytes = measure(fn)
+        result[name] = {
+            'seconds': round(elapsed, 3),
+            'input_mb_per_second': round(len(body) / elapsed / 1024 / 1024, 1),
+            'output_bytes': output_bytes,
+            'peak_extra_memory_kb': round(peak / 1024, 1),
+        }
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
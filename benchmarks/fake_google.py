@@ -0,0 +1,578 @@
+"""
+本地的google drive/docs api替身服务，用于性能测试，不访问google
+
+Run:
+    python -m benchmarks.fake_google --port 8765 --latency 0.05 --jitter 0.02 --error-rate 0.01 --error-status 429,503
+
+然后在settings_local.py中设置 GOOGLE_API_ROOT_URL = 'http://127.0.0.1:8765/'
+
+实现的接口：drive v3 files.list/create/copy/get/update/delete/export(支持Range)、changes.getStartPageToken/list，
+docs v1 documents.create/get 以及 batch 请求；可以给每个http请求加随机延迟，按比例或按指定次数返回错误
+"""
+import argparse
+import email.parser
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+DOCUMENT_MIME_TYPE = 'application/vnd.google-apps.document'
+
+_CLAUSE_PATTERNS = (
+    (re.compile(r"^(?P<field>mimeType|name)\s*(?P<op>!?=)\s*'(?P<value>.*)'$"), 'compare'),
+    (re.compile(r"^'(?P<value>[^']*)' in parents$"), 'in_parents'),
+    (re.compile(r"^trashed\s*=\s*(?P<value>true|false)$"), 'trashed'),
+    # 替身服务中所有文件都属于调用方(服务账号)
+    (re.compile(r"^'me' in owners$"), 'owners'),
+    (re.compile(r"^createdTime\s*(?P<op><=|>=|<|>)\s*'(?P<value>[^']*)'$"), 'created_time'),
+    (re.compile(r"^appProperties has \{\s*key='(?P<key>[^']*)' and value='(?P<value>[^']*)'\s*\}$"),
+     'app_properties'),
+)
+
+_TIME_COMPARE = {'<': lambda a, b: a < b, '<=': lambda a, b: a <= b, '>': lambda a, b: a > b,
+                 '>=': lambda a, b: a >= b}
+
+
+class FakeDriveState(object):
+    """
+    替身服务的内存数据，线程安全
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.calls = {}
+        # changes feed，page token为下一条修改在列表中的位置(从1开始)
+        self.changes = []
+        # documents.get返回的文档正文 {file_id: body}，没有时返回一个空文档
+        self.documents = {}
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def record_change(self, file_id, meta=None):
+        """
+        记录一条修改，调用方需持有lock
+
+        :param file_id: 被修改的文件
+        :param meta: 修改后的文件，为空表示文件已被永久删除
+        """
+        change = {'kind': 'drive#change', 'changeType': 'file', 'fileId': file_id, 'removed': meta is None,
+                  'time': datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')}
+        if meta is not None:
+            change['file'] = dict(meta)
+        self.changes.append(change)
+
+    def add_file(self, name, mime_type=DOCUMENT_MIME_TYPE, parents=None, file_id=None, app_properties=None):
+        file_id = file_id or uuid.uuid4().hex
+        with self.lock:
+            self.files[file_id] = {
+                'id': file_id,
+                'name': name,
+                'mimeType': mime_type,
+                'parents': list(parents or []),
+                'trashed': False,
+                'version': '1',
+                'createdTime': datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z'),
+                'webViewLink': f'https://docs.google.com/document/d/{file_id}/edit?usp=drivesdk',
+            }
+            if app_properties:
+                self.files[file_id]['appProperties'] = dict(app_properties)
+            self.record_change(file_id, self.files[file_id])
+            return dict(self.files[file_id])
+
+    def match(self, meta, q):
+        # appProperties has { key='..' and value='..' } 中的and不作为分隔
+        return all(self.match_clause(meta, part.strip())
+                   for part in re.split(r'\s+and\s+(?![^{]*\})', q or '') if part.strip())
+
+    def match_clause(self, meta, clause):
+        if clause.startswith('(') and clause.endswith(')'):
+            # 只支持括号内由or连接的简单条件
+            return any(self.match_clause(meta, part.strip()) for part in re.split(r'\s+or\s+', clause[1:-1]))
+        for pattern, kind in _CLAUSE_PATTERNS:
+            m = pattern.match(clause)
+            if not m:
+                continue
+            if kind == 'compare':
+                equal = meta.get(m.group('field')) == m.group('value').replace("\\'", "'")
+                return equal == (m.group('op') == '=')
+            elif kind == 'in_parents':
+                return m.group('value') in meta['parents']
+            elif kind == 'trashed':
+                return meta['trashed'] == (m.group('value') == 'true')
+            elif kind == 'owners':
+                return True
+            elif kind == 'app_properties':
+                return (meta.get('appProperties') or {}).get(m.group('key')) == m.group('value')
+            elif kind == 'created_time':
+                return _TIME_COMPARE[m.group('op')](datetime.fromisoformat(meta['createdTime']),
+                                                    datetime.fromisoformat(m.group('value')))
+        raise ValueError(f'unsupported query clause: {clause}')
+
+
+def merge_app_properties(current, changes):
+    """
+    :return: 按请求修改后的appProperties，值为None的属性被删除
+    """
+    merged = dict(current or {})
+    for key, value in (changes or {}).items():
+        if value is None:
+            merged.pop(key, None)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _error(status, reason, message):
+    return status, {'error': {'code': status, 'message': message, 'errors': [
+        {'domain': 'usageLimits' if status in (403, 429) else 'global', 'reason': reason, 'message': message}]}}
+
+
+# 注入的错误状态码对应的google错误原因
+FAULT_REASONS = {
+    403: 'userRateLimitExceeded',
+    429: 'rateLimitExceeded',
+    500: 'backendError',
+    502: 'backendError',
+    503: 'backendError',
+}
+
+
+class FaultInjector(object):
+    """
+    给api调用(batch中的每个子请求单独计算)注入错误：按error_rate的概率随机返回error_statuses中的一个，
+    或通过fail(name, status, times)让指定调用的接下来几次失败
+    """
+
+    def __init__(self, error_rate=0.0, error_statuses=(503,), seed=None):
+        """
+        :param error_rate: 随机错误的比例，0~1
+        :param error_statuses: 随机错误的http状态码
+        :param seed: 随机数种子，便于复现
+        """
+        self.error_rate = error_rate
+        self.error_statuses = tuple(error_statuses)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.scheduled = {}
+
+    def fail(self, name, status=503, times=1):
+        """
+        :param name: 调用名称，如files.create、documents.get
+        """
+        with self.lock:
+            self.scheduled.setdefault(name, []).extend([status] * times)
+
+    def pick(self, name):
+        """
+        :return: 本次调用要返回的错误状态码，不注入时返回None
+        """
+        with self.lock:
+            scheduled = self.scheduled.get(name)
+            if scheduled:
+                return scheduled.pop(0)
+            if self.error_rate and self.random.random() < self.error_rate:
+                return self.random.choice(self.error_statuses)
+        return None
+
+
+# files.export支持的格式 -> 导出内容的前缀
+EXPORT_MIME_TYPES = {
+    'application/pdf': b'%PDF-1.4\n',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': b'PK\x03\x04',
+    'text/plain': b'',
+}
+
+
+class Media(object):
+    """
+    非json的响应内容(如files.export)，单个请求时按请求头Range返回其中一段
+    """
+
+    def __init__(self, data, content_type):
+        self.data = data
+        self.content_type = content_type
+
+
+def document_text(body):
+    return ''.join(element.get('textRun', {}).get('content', '')
+                   for block in body.get('content', []) for element in block.get('paragraph', {}).get('elements', []))
+
+
+def _not_found(file_id):
+    return 404, {'error': {'code': 404, 'message': f'File not found: {file_id}.', 'errors': [
+        {'domain': 'global', 'reason': 'notFound', 'message': f'File not found: {file_id}.'}]}}
+
+
+class FakeDriveApi(object):
+    """
+    按 (method, path) 分发请求，单个请求和batch中的子请求共用
+    """
+
+    def __init__(self, state, faults=None):
+        """
+        :param state: FakeDriveState
+        :param faults: FaultInjector，为空时不注入错误
+        """
+        self.state = state
+        self.faults = faults if faults is not None else FaultInjector()
+
+    def route(self, method, path, query, body):
+        """
+        :return: (调用名称, 处理函数)，不支持的请求返回(None, 返回错误的函数)
+        """
+        parts = [part for part in path.split('/') if part]
+        if parts[:2] == ['v1', 'documents']:
+            if len(parts) == 2 and method == 'POST':
+                return 'documents.create', lambda: self.create_document(body)
+            if len(parts) == 3 and method == 'GET':
+                return 'documents.get', lambda: self.get_document(parts[2])
+        if parts[:3] == ['drive', 'v3', 'changes'] and method == 'GET':
+            if parts[3:] == ['startPageToken']:
+                return 'changes.getStartPageToken', self.get_start_page_token
+            if not parts[3:]:
+                return 'changes.list', lambda: self.list_changes(query)
+        if parts[:3] == ['drive', 'v3', 'files']:
+            rest = parts[3:]
+            if not rest and method == 'GET':
+                return 'files.list', lambda: self.list_files(query)
+            if not rest and method == 'POST':
+                return 'files.create', lambda: self.create_file(body)
+            if len(rest) == 1 and method == 'GET':
+                return 'files.get', lambda: self.get_file(rest[0])
+            if len(rest) == 1 and method == 'DELETE':
+                return 'files.delete', lambda: self.delete_file(rest[0])
+            if len(rest) == 1 and method == 'PATCH':
+                return 'files.update', lambda: self.update_file(rest[0], query, body)
+            if len(rest) == 2 and rest[1] == 'copy' and method == 'POST':
+                return 'files.copy', lambda: self.copy_file(rest[0], body)
+            if len(rest) == 2 and rest[1] == 'export' and method == 'GET':
+                return 'files.export', lambda: self.export_file(rest[0], query)
+            return None, lambda: (405, {'error': {'code': 405, 'message': f'{method} {path} not supported'}})
+        return None, lambda: (404, {'error': {'code': 404, 'message': f'unknown path {path}'}})
+
+    def dispatch(self, method, path, query, body):
+        """
+        :return: (http status, 响应json)
+        """
+        name, handler = self.route(method, path, query, body)
+        status = self.faults.pick(name) if name else None
+        if status is not None:
+            self.state.count(f'{name}:{status}')
+            return _error(status, FAULT_REASONS.get(status, 'injected'), f'injected error for {name}')
+        return handler()
+
+    def list_files(self, query):
+        self.state.count('files.list')
+        q = query.get('q', [''])[0]
+        page_size = int(query.get('pageSize', ['100'])[0])
+        offset = int(query.get('pageToken', ['0'])[0] or 0)
+        with self.state.lock:
+            files = [dict(meta) for meta in self.state.files.values() if self.state.match(meta, q)]
+        result = {'files': files[offset:offset + page_size]}
+        if offset + page_size < len(files):
+            result['nextPageToken'] = str(offset + page_size)
+        return 200, result
+
+    def create_file(self, body):
+        self.state.count('files.create')
+        for parent in body.get('parents', []):
+            if parent not in self.state.files and parent != 'root':
+                return _not_found(parent)
+        return 200, self.state.add_file(body.get('name', 'Untitled'), body.get('mimeType', DOCUMENT_MIME_TYPE),
+                                        body.get('parents', ['root']), app_properties=body.get('appProperties'))
+
+    def get_file(self, file_id):
+        self.state.count('files.get')
+        with self.state.lock:
+            meta = self.state.files.get(file_id)
+        return (200, dict(meta)) if meta else _not_found(file_id)
+
+    def delete_file(self, file_id):
+        self.state.count('files.delete')
+        with self.state.lock:
+            meta = self.state.files.pop(file_id, None)
+            self.state.documents.pop(file_id, None)
+            if meta:
+                self.state.record_change(file_id)
+        return (204, None) if meta else _not_found(file_id)
+
+    def update_file(self, file_id, query, body):
+        self.state.count('files.update')
+        add_parents = [p for p in query.get('addParents', [''])[0].split(',') if p]
+        remove_parents = [p for p in query.get('removeParents', [''])[0].split(',') if p]
+        for parent in add_parents:
+            if parent not in self.state.files and parent != 'root':
+                return _not_found(parent)
+        with self.state.lock:
+            meta = self.state.files.get(file_id)
+            if not meta:
+                return _not_found(file_id)
+            meta.update({key: value for key, value in body.items() if key in ('name', 'trashed')})
+            if 'appProperties' in body:
+                meta['appProperties'] = merge_app_properties(meta.get('appProperties'), body['appProperties'])
+            meta['parents'] = [p for p in meta['parents'] if p not in remove_parents] + add_parents
+            meta['version'] = str(int(meta['version']) + 1)
+            self.state.record_change(file_id, meta)
+            return 200, dict(meta)
+
+    def get_start_page_token(self):
+        self.state.count('changes.getStartPageToken')
+        with self.state.lock:
+            return 200, {'kind': 'drive#startPageToken', 'startPageToken': str(len(self.state.changes) + 1)}
+
+    def list_changes(self, query):
+        self.state.count('changes.list')
+        page_token = query.get('pageToken', [''])[0]
+        if not page_token.isdigit() or int(page_token) < 1:
+            return 400, {'error': {'code': 400, 'message': f'Invalid pageToken {page_token}', 'errors': [
+                {'domain': 'global', 'reason': 'invalid', 'message': 'Invalid Value'}]}}
+        page_size = int(query.get('pageSize', ['100'])[0])
+        include_removed = query.get('includeRemoved', ['true'])[0] == 'true'
+        start = int(page_token) - 1
+        with self.state.lock:
+            changes = self.state.changes[start:start + page_size]
+            end = start + len(changes)
+            total = len(self.state.changes)
+        result = {'kind': 'drive#changeList',
+                  'changes': [change for change in changes if include_removed or not change['removed']]}
+        if end < total:
+            result['nextPageToken'] = str(end + 1)
+        else:
+            result['newStartPageToken'] = str(total + 1)
+        return 200, result
+
+    def copy_file(self, file_id, body):
+        self.state.count('files.copy')
+        with self.state.lock:
+            source = self.state.files.get(file_id)
+        if not source:
+            return _not_found(file_id)
+        parents = body.get('parents') or source['parents']
+        for parent in parents:
+            if parent not in self.state.files and parent != 'root':
+                return _not_found(parent)
+        # 拷贝带有源文件的appProperties，请求中值为null的属性被删除
+        meta = self.state.add_file(body.get('name', source['name']), source['mimeType'], parents,
+                                   app_properties=merge_app_properties(source.get('appProperties'),
+                                                                       body.get('appProperties')))
+        with self.state.lock:
+            if file_id in self.state.documents:
+                self.state.documents[meta['id']] = self.state.documents[file_id]
+        return 200, meta
+
+    def export_file(self, file_id, query):
+        self.state.count('files.export')
+        mime_type = query.get('mimeType', [''])[0]
+        if mime_type not in EXPORT_MIME_TYPES:
+            return _error(400, 'badRequest', f'Export to {mime_type} is not supported')
+        with self.state.lock:
+            meta = self.state.files.get(file_id)
+        if not meta:
+            return _not_found(file_id)
+        if meta['mimeType'] != DOCUMENT_MIME_TYPE:
+            return _error(403, 'fileNotExportable', 'Export only supports Docs Editors files.')
+        text = f'{meta["name"]}\n{document_text(self._document(meta)["body"])}'.encode()
+        return 200, Media(EXPORT_MIME_TYPES[mime_type] + text, mime_type)
+
+    def create_document(self, body):
+        self.state.count('documents.create')
+        meta = self.state.add_file(body.get('title', 'Untitled document'), DOCUMENT_MIME_TYPE, ['root'])
+        return 200, self._document(meta)
+
+    def get_document(self, document_id):
+        self.state.count('documents.get')
+        with self.state.lock:
+            meta = self.state.files.get(document_id)
+            meta = dict(meta) if meta and meta['mimeType'] == DOCUMENT_MIME_TYPE else None
+        return (200, self._document(meta)) if meta else _not_found(document_id)
+
+    def _document(self, meta):
+        with self.state.lock:
+            body = self.state.documents.get(meta['id'])
+        if body is None:
+            body = {'content': [{'endIndex': 1, 'sectionBreak': {'sectionStyle': {}}},
+                                {'startIndex': 1, 'endIndex': 2, 'paragraph': {
+                                    'elements': [{'startIndex': 1, 'endIndex': 2, 'textRun': {'content': '\n'}}],
+                                    'paragraphStyle': {'namedStyleType': 'NORMAL_TEXT'}}}]}
+        return {'documentId': meta['id'], 'title': meta['name'], 'body': body,
+                'revisionId': f'{meta["id"]}-{meta["version"]}', 'suggestionsViewMode': 'SUGGESTIONS_INLINE'}
+
+
+class FakeGoogleHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeGoogle/1.0'
+    # 响应头和响应体分开写出，关闭nagle避免keep-alive连接上的延迟确认
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # 每个新的TCP连接(https时即一次TLS握手)计数一次
+        self.server.state.count('connections')
+        super().setup()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status, payload, content_type='application/json; charset=UTF-8'):
+        data = b'' if payload is None else (payload if isinstance(payload, bytes) else json.dumps(payload).encode())
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        time.sleep(self.server.latency + (random.uniform(0, self.server.jitter) if self.server.jitter else 0))
+        url = urlsplit(self.path)
+        body = self._read_body()
+        if url.path.startswith('/batch/'):
+            self.server.state.count('batch')
+            boundary, payload = self._handle_batch(body)
+            self._send(200, payload, f'multipart/mixed; boundary={boundary}')
+            return
+        status, payload = self.server.api.dispatch(self.command, url.path, parse_qs(url.query),
+                                                   json.loads(body) if body else {})
+        if isinstance(payload, Media):
+            self._send_media(payload)
+            return
+        self._send(status, payload)
+
+    def _send_media(self, media):
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+        if not match:
+            self._send(200, media.data, media.content_type)
+            return
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else len(media.data) - 1, len(media.data) - 1)
+        if start >= len(media.data):
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(media.data)}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = media.data[start:end + 1]
+        self.send_response(206)
+        self.send_header('Content-Type', media.content_type)
+        self.send_header('Content-Range', f'bytes {start}-{end}/{len(media.data)}')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle_batch(self, body):
+        message = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+        boundary = f'batch_{uuid.uuid4().hex}'
+        chunks = []
+        for part in message.get_payload():
+            content_id = part['Content-ID'].strip()[1:-1]
+            raw = part.get_payload(decode=False).replace('\r\n', '\n')
+            request_line, _, rest = raw.partition('\n')
+            _, _, sub_body = rest.partition('\n\n')
+            method, target, _ = request_line.split(' ', 2)
+            url = urlsplit(target)
+            status, payload = self.server.api.dispatch(method, url.path, parse_qs(url.query),
+                                                       json.loads(sub_body) if sub_body.strip() else {})
+            data = '' if payload is None else json.dumps(payload)
+            chunks.append(
+                f'--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n'
+                f'HTTP/1.1 {status} {"OK" if status < 400 else "ERROR"}\r\n'
+                f'Content-Type: application/json; charset=UTF-8\r\nContent-Length: {len(data.encode())}\r\n\r\n'
+                f'{data}\r\n')
+        chunks.append(f'--{boundary}--\r\n')
+        return boundary, ''.join(chunks).encode()
+
+    do_GET = do_POST = do_DELETE = do_PATCH = _handle
+
+
+class FakeHTTPServer(ThreadingHTTPServer):
+    # 默认的listen backlog为5，大量并发连接时会因SYN重传多等待1秒以上
+    request_queue_size = 1024
+
+
+class FakeGoogleServer(object):
+    """
+    在后台线程中运行的替身服务
+
+        with FakeGoogleServer(latency=0.05) as server:
+            settings.GOOGLE_API_ROOT_URL = server.root_url
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, ssl_context=None, jitter=0.0, faults=None):
+        """
+        :param host: 监听地址
+        :param port: 监听端口，0为随机端口
+        :param latency: 每个http请求的模拟延迟(秒)
+        :param ssl_context: 服务端ssl.SSLContext，传入时提供https服务
+        :param jitter: 在latency之上再随机增加0~jitter秒的延迟
+        :param faults: FaultInjector，为空时不注入错误
+        """
+        self.state = FakeDriveState()
+        self.faults = faults if faults is not None else FaultInjector()
+        self.httpd = FakeHTTPServer((host, port), FakeGoogleHandler)
+        self.scheme = 'http'
+        if ssl_context is not None:
+            # 握手推迟到处理请求的线程中进行，不阻塞accept
+            self.httpd.socket = ssl_context.wrap_socket(self.httpd.socket, server_side=True,
+                                                        do_handshake_on_connect=False)
+            self.scheme = 'https'
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency
+        self.httpd.jitter = jitter
+        self.httpd.state = self.state
+        self.httpd.api = FakeDriveApi(self.state, self.faults)
+        self._thread = None
+
+    @property
+    def root_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'{self.scheme}://{host}:{port}/'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='fake-google', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='每个http请求的模拟延迟(秒)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='在latency之上随机增加的最大延迟(秒)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='api调用随机返回错误的比例，0~1')
+    parser.add_argument('--error-status', default='503', help='随机错误的http状态码，逗号分隔，如429,503')
+    parser.add_argument('--seed', type=int, help='随机数种子')
+    parser.add_argument('--root-folder-id', help='预先创建的根目录id，对应settings.DOC_ROOT_FOLDER_ID')
+    args = parser.parse_args(argv)
+    faults = FaultInjector(args.error_rate, [int(status) for status in args.error_status.split(',')], args.seed)
+    server = FakeGoogleServer(args.host, args.port, args.latency, jitter=args.jitter, faults=faults)
+    if args.root_folder_id:
+        server.state.add_file('root', FOLDER_MIME_TYPE, file_id=args.root_folder_id)
+    print(f'fake google api listening on {server.root_url}', flush=True)
+    server.httpd.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+"""
+端到端负载测试：按不同并发数请求 /api/v1/new_doc/ 和 /api/v1/copy_doc/，输出吞吐和p50/p95/p99延迟(json)
+
+Run:
+    python -m benchmarks.load --concurrency 1,8,32 --requests 200 --latency 0.05
+    python -m benchmarks.load --latency 0.05 --jitter 0.05 --error-rate 0.02 --error-status 429,503
+    python -m benchmarks.load --url http://127.0.0.1:8000 --token xxx --concurrency 8 --requests 100
+
+默认在临时测试数据库上启动本地替身服务(benchmarks/fake_google.py)和django的多线程WSGI服务，各自一个子进程，
+客户端线程通过http请求；--url指定已经运行的服务(真实google或替身服务)时不启动这些进程，需要--token。
+测试前先为每个学生请求一次new_doc创建好目录，只统计之后的请求；--output把本次结果作为一行追加到文件，便于跟踪历史
+"""
+import argparse
+import datetime
+import http.client
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlencode, urlsplit
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'maze_google_doc.settings')
+
+import django
+
+django.setup()
+
+import mock
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from google.auth.credentials import AnonymousCredentials
+from rest_framework.authtoken.models import Token
+
+from maze_google_doc import settings
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0
+
+
+class Client(object):
+    """
+    一个客户端线程使用的keep-alive http连接
+    """
+
+    def __init__(self, base_url, token, timeout=120):
+        parts = urlsplit(base_url)
+        connection_cls = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection_cls(parts.hostname, parts.port, timeout=timeout)
+        self.prefix = parts.path.rstrip('/')
+        self.headers = {'Authorization': f'Token {token}'}
+
+    def get(self, path, params):
+        """
+        :return: (http status, 响应json，不是json时为None)
+        """
+        try:
+            self.connection.request('GET', f'{self.prefix}{path}?{urlencode(params)}', headers=self.headers)
+            response = self.connection.getresponse()
+            body = response.read()
+        except (http.client.HTTPException, OSError):
+            # 服务端关闭了连接，下次请求时重新连接
+            self.connection.close()
+            raise
+        try:
+            return response.status, json.loads(body)
+        except ValueError:
+            return response.status, None
+
+    def close(self):
+        self.connection.close()
+
+
+def new_doc_params(i, students):
+    return {'username': f'student{i % students}', 'folder': 'essay', 'title': f'load{i}'}
+
+
+def run_scenario(base_url, token, path, make_params, concurrency, total):
+    """
+    concurrency个客户端线程各自串行发送请求，共total个
+
+    :param make_params: make_params(i) 第i个请求的参数
+    :return: 吞吐、延迟分位数和错误统计
+    """
+    latencies = []
+    errors = Counter()
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def client():
+        session = Client(base_url, token)
+        try:
+            while True:
+                with lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                start = time.monotonic()
+                try:
+                    status, result = session.get(path, make_params(i))
+                    code = result.get('code') if isinstance(result, dict) else None
+                    error = None if status == 200 and code == 200 else f'{status}/{code}'
+                except Exception as e:
+                    error = type(e).__name__
+                elapsed = time.monotonic() - start
+                with lock:
+                    latencies.append(elapsed)
+                    if error:
+                        errors[error] += 1
+        finally:
+            session.close()
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    return {
+        'endpoint': path,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': sum(errors.values()),
+        'error_codes': dict(errors),
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'max_ms': round(max(latencies) * 1000, 1) if latencies else 0,
+    }
+
+
+def run_benchmark(base_url, token, args):
+    # 为每个学生创建好目录，并得到copy_doc的源文档
+    session = Client(base_url, token)
+    try:
+        source_doc_id = args.source_doc_id
+        for i in range(args.students):
+            status, result = session.get('/api/v1/new_doc/', new_doc_params(i, args.students))
+            if status != 200 or result.get('code') != 200:
+                raise RuntimeError(f'warm up failed: {status} {result}')
+            source_doc_id = source_doc_id or result['data']['doc_id']
+    finally:
+        session.close()
+
+    scenarios = []
+    for concurrency in args.concurrency:
+        if 'new_doc' in args.endpoints:
+            scenarios.append(run_scenario(base_url, token, '/api/v1/new_doc/',
+                                          lambda i: new_doc_params(i, args.students), concurrency, args.requests))
+        if 'copy_doc' in args.endpoints:
+            scenarios.append(run_scenario(base_url, token, '/api/v1/copy_doc/',
+                                          lambda i: {'source_doc_id': source_doc_id, 'title': f'copy{i}'},
+                                          concurrency, args.requests))
+    return scenarios
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)), text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def serve(args):
+    """
+    子进程：在父进程创建的测试数据库上运行django的多线程WSGI服务，google api指向替身服务
+    """
+    import socketserver
+
+    from django.core.servers.basehttp import WSGIRequestHandler, WSGIServer
+    from django.core.wsgi import get_wsgi_application
+
+    from apps.google_doc import views
+    from common.operator_pool import GoogleDocOperatorPool
+
+    connection.settings_dict['NAME'] = args.db
+
+    class Server(socketserver.ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+        request_queue_size = 1024
+
+    class Handler(WSGIRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    with mock.patch.object(settings, 'GOOGLE_API_ROOT_URL', args.google_url), \
+            mock.patch.object(settings, 'GOOGLE_RATE_LIMIT_ENABLED', args.rate_limit), \
+            mock.patch.object(settings, 'DRIVE_CHANGES_ENABLED', False), \
+            mock.patch.object(views, 'operator_pool', GoogleDocOperatorPool(credentials=AnonymousCredentials())):
+        httpd = Server(('127.0.0.1', 0), Handler)
+        httpd.set_app(get_wsgi_application())
+        print(f'listening on http://127.0.0.1:{httpd.server_address[1]}', flush=True)
+        httpd.serve_forever()
+
+
+def start_process(command):
+    """
+    启动子进程，等待其输出第一行(监听地址)
+
+    :return: (Popen, 监听的url)
+    """
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line:
+        process.wait()
+        raise RuntimeError(f'{command} exited with {process.returncode}')
+    # 之后的输出(如服务进程的日志)直接丢弃，避免管道写满后子进程阻塞
+    threading.Thread(target=process.stdout.read, daemon=True).start()
+    return process, line.split()[-1]
+
+
+def run_local(args):
+    if connection.vendor == 'sqlite':
+        # 服务进程与本进程共用测试数据库，不能用内存中的sqlite
+        test_db = tempfile.NamedTemporaryFile(suffix='.sqlite3', delete=False)
+        connection.settings_dict['TEST'] = dict(connection.settings_dict.get('TEST') or {}, NAME=test_db.name)
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    processes = []
+    try:
+        call_command('createcachetable', verbosity=0)
+        token = Token.objects.create(user=User.objects.create_user('load')).key
+        connection.close()
+        google, google_url = start_process([
+            sys.executable, '-m', 'benchmarks.fake_google', '--port', '0', '--latency', str(args.latency),
+            '--jitter', str(args.jitter), '--error-rate', str(args.error_rate), '--error-status', args.error_status,
+            '--root-folder-id', settings.DOC_ROOT_FOLDER_ID] + (['--seed', str(args.seed)] if args.seed else []))
+        processes.append(google)
+        server, base_url = start_process(
+            [sys.executable, '-m', 'benchmarks.load', '--serve', '--db', connection.settings_dict['NAME'],
+             '--google-url', google_url] + (['--rate-limit'] if args.rate_limit else []))
+        processes.append(server)
+        return run_benchmark(base_url, token, args)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', default='1,8,32', help='逗号分隔的并发客户端数')
+    parser.add_argument('--requests', type=int, default=200, help='每个接口每个并发数的请求数')
+    parser.add_argument('--endpoints', default='new_doc,copy_doc')
+    parser.add_argument('--students', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.05, help='替身服务每个http请求的模拟延迟(秒)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='替身服务在latency之上随机增加的最大延迟(秒)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='替身服务随机返回错误的比例')
+    parser.add_argument('--error-status', default='503', help='替身服务随机错误的状态码，逗号分隔')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--rate-limit', action='store_true', help='开启google api令牌桶限流')
+    parser.add_argument('--url', help='已经运行的服务地址，如http://127.0.0.1:8000')
+    parser.add_argument('--token', help='--url时使用的api token')
+    parser.add_argument('--source-doc-id', help='copy_doc的源文档，默认使用预热时创建的文档')
+    parser.add_argument('--output', help='把结果作为一行json追加到该文件')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    parser.add_argument('--google-url', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.serve:
+        return serve(args)
+    args.concurrency = [int(value) for value in args.concurrency.split(',')]
+    args.endpoints = args.endpoints.split(',')
+
+    if args.url:
+        if not args.token:
+            parser.error('--url requires --token')
+        scenarios = run_benchmark(args.url, args.token, args)
+        target = {'url': args.url}
+    else:
+        scenarios = run_local(args)
+        target = {'google_latency': args.latency, 'google_jitter': args.jitter, 'error_rate': args.error_rate,
+                  'error_status': args.error_status, 'rate_limit': args.rate_limit}
+    result = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'target': target,
+        'students': args.students,
+        'scenarios': scenarios,
+    }
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
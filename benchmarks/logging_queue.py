@@ -0,0 +1,126 @@
+"""
+对比同步RotatingFileHandler与队列日志(DroppingQueueHandler)下，请求线程每次写日志的耗时
+
+Run:
+    python -m benchmarks.logging_queue --threads 16 --records 2000 --size 1000
+
+日志写到临时目录，--max-bytes默认5MB以便测试中发生rotation；队列日志的耗时只包括放入队列，写文件在后台线程中完成
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from logging.handlers import RotatingFileHandler
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'maze_google_doc.settings')
+
+import django
+
+django.setup()
+
+from common.log_queue import DroppingQueueHandler, LogQueue
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0
+
+
+def make_handlers(directory, max_bytes):
+    formatter = logging.Formatter(
+        '%(asctime)-12s [%(filename)-12s:%(lineno)3d][%(threadName)-12s][%(name)-8s]%(levelname)s %(message)s')
+    handlers = []
+    for name in ('debug.log', 'error.log'):
+        handler = RotatingFileHandler(os.path.join(directory, name), maxBytes=max_bytes, backupCount=5)
+        handler.setFormatter(formatter)
+        handlers.append(handler)
+    handlers[1].setLevel(logging.ERROR)
+    return handlers
+
+
+class Fanout(logging.Handler):
+    """
+    改造前的方式：请求线程依次调用logger配置的每个handler
+    """
+
+    def __init__(self, handlers):
+        super().__init__()
+        self.handlers = handlers
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+def run(handler, threads, records, message):
+    logger = logging.getLogger(f'benchmark.{uuid.uuid4().hex}')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    latencies = []
+    lock = threading.Lock()
+
+    def worker():
+        local = []
+        for i in range(records):
+            start = time.perf_counter()
+            logger.info('request %d params %s', i, message)
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        'records': len(latencies),
+        'seconds': round(elapsed, 3),
+        'p50_us': round(percentile(latencies, 0.5) * 1e6, 1),
+        'p99_us': round(percentile(latencies, 0.99) * 1e6, 1),
+        'max_ms': round(max(latencies) * 1000, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--records', type=int, default=2000, help='每个线程写的日志条数')
+    parser.add_argument('--size', type=int, default=1000, help='每条日志的长度')
+    parser.add_argument('--max-bytes', type=int, default=5 * 1024 * 1024)
+    parser.add_argument('--queue-size', type=int, default=10000)
+    args = parser.parse_args(argv)
+
+    message = 'x' * args.size
+    directory = tempfile.mkdtemp()
+    result = {}
+    try:
+        handlers = make_handlers(directory, args.max_bytes)
+        result['sync'] = run(Fanout(handlers), args.threads, args.records, message)
+
+        log_queue = LogQueue(maxsize=args.queue_size)
+        result['queued'] = run(DroppingQueueHandler(log_queue, make_handlers(directory, args.max_bytes)),
+                               args.threads, args.records, message)
+        start = time.perf_counter()
+        log_queue.stop()
+        result['queued']['drain_seconds'] = round(time.perf_counter() - start, 3)
+        result['queued']['dropped'] = log_queue.stats()['dropped']
+    finally:
+        shutil.rmtree(directory)
+    result['threads'] = args.threads
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+对比每个请求新建GoogleDocOperator与从operator池checkout的单请求开销
+
+Run:
+    python -m benchmarks.operator_pool --requests 200 --token-latency 0.15
+
+不访问google：token交换被替换为sleep(--token-latency)并计数，service account key为临时生成的测试密钥；
+共享token缓存使用settings中的GOOGLE_TOKEN_CACHE_ALIAS，需要先执行migrate和createcachetable
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'maze_google_doc.settings')
+
+import django
+
+django.setup()
+
+import mock
+import rsa
+from google.oauth2 import service_account
+from django.core.cache import caches
+from googleapiclient.discovery import build
+
+from common.operator_pool import GoogleDocOperatorPool
+from common.utils import GoogleAuthType, load_credentials
+from maze_google_doc import settings
+
+
+def write_fake_service_account_file():
+    _, private_key = rsa.newkeys(1024)
+    info = {
+        'type': 'service_account',
+        'project_id': 'benchmark',
+        'private_key_id': 'benchmark',
+        'private_key': private_key.save_pkcs1().decode(),
+        'client_email': 'benchmark@benchmark.iam.gserviceaccount.com',
+        'client_id': '1',
+        'token_uri': 'https://oauth2.googleapis.com/token',
+    }
+    fd, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(info, f)
+    return path
+
+
+def legacy_request():
+    """改造前每个请求的准备工作：读key文件，新建凭证，build两个service，第一次调用前交换token"""
+    creds = load_credentials(GoogleAuthType.SERVICE_ACCOUNT_KEY)
+    build('docs', 'v1', credentials=creds, static_discovery=True)
+    build('drive', 'v3', credentials=creds, static_discovery=True)
+    creds.refresh(None)
+
+
+def shared_token_request():
+    """每个请求新建凭证，但access token从共享缓存读取"""
+    creds = load_credentials(GoogleAuthType.SERVICE_ACCOUNT_KEY)
+    build('docs', 'v1', credentials=creds, static_discovery=True)
+    build('drive', 'v3', credentials=creds, static_discovery=True)
+    if not creds.valid:
+        creds.refresh(None)
+
+
+def pooled_request(pool):
+    with pool.checkout():
+        pass
+
+
+def run(fn, count):
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        'requests': count,
+        'mean_ms': round(sum(latencies) / count * 1000, 3),
+        'p50_ms': round(latencies[count // 2] * 1000, 3),
+        'p99_ms': round(latencies[min(count - 1, int(count * 0.99))] * 1000, 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--token-latency', type=float, default=0.0, help='模拟一次token交换的网络耗时(秒)')
+    args = parser.parse_args(argv)
+
+    refresh_count = {'value': 0}
+
+    def fake_refresh(creds, request):
+        refresh_count['value'] += 1
+        time.sleep(args.token_latency)
+        creds.token = 'benchmark-token'
+        creds.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+    key_file = write_fake_service_account_file()
+    try:
+        with mock.patch.object(settings, 'GOOGLE_SERVICE_ACCOUNT_CREDENTIALS_FILE', key_file), \
+                mock.patch.object(service_account.Credentials, 'refresh', fake_refresh):
+            result = {}
+            refresh_count['value'] = 0
+            with mock.patch.object(settings, 'GOOGLE_TOKEN_CACHE_ENABLED', False):
+                result['per_request_build'] = run(legacy_request, args.requests)
+            result['per_request_build']['token_exchanges'] = refresh_count['value']
+
+            refresh_count['value'] = 0
+            caches[settings.GOOGLE_TOKEN_CACHE_ALIAS].clear()
+            result['per_request_shared_token'] = run(shared_token_request, args.requests)
+            result['per_request_shared_token']['token_exchanges'] = refresh_count['value']
+
+            refresh_count['value'] = 0
+            pool = GoogleDocOperatorPool()
+            caches[settings.GOOGLE_TOKEN_CACHE_ALIAS].clear()
+            result['operator_pool'] = run(lambda: pooled_request(pool), args.requests)
+            result['operator_pool']['token_exchanges'] = refresh_count['value']
+    finally:
+        os.remove(key_file)
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
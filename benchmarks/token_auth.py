@@ -0,0 +1,93 @@
+"""
+对比DRF TokenAuthentication与CachedTokenAuthentication(进程内缓存/只用共享层)每个请求的认证开销
+
+Run:
+    python -m benchmarks.token_auth --requests 5000 --users 100
+
+在进程内直接调用authenticate，不经过http；数据库使用临时创建的测试数据库，
+共享层使用--shared-alias对应的django cache(默认为google_doc，即数据库缓存)
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'maze_google_doc.settings')
+
+import django
+
+django.setup()
+
+import mock
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from common.authentication import CachedTokenAuthentication, TokenCache
+
+
+def run(authentication, requests):
+    """
+    :param requests: 预先构造好的请求列表，依次认证
+    :return: 每个请求的平均耗时和查询数
+    """
+    queries = [0]
+
+    def count(execute, sql, params, many, context):
+        queries[0] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count):
+        start = time.perf_counter()
+        for request in requests:
+            authentication.authenticate(request)
+        elapsed = time.perf_counter() - start
+    return {
+        'us_per_request': round(elapsed / len(requests) * 1e6, 1),
+        'queries_per_request': round(queries[0] / len(requests), 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=100, help='不同token的数量，请求依次使用')
+    parser.add_argument('--shared-alias', default='google_doc')
+    args = parser.parse_args(argv)
+
+    if connection.vendor == 'sqlite':
+        # 与线上一样使用文件数据库，而不是内存中的sqlite
+        test_db = tempfile.NamedTemporaryFile(suffix='.sqlite3', delete=False)
+        connection.settings_dict['TEST'] = dict(connection.settings_dict.get('TEST') or {}, NAME=test_db.name)
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    result = {}
+    try:
+        call_command('createcachetable', verbosity=0)
+        keys = [Token.objects.create(user=User.objects.create_user(f'user{i}')).key for i in range(args.users)]
+        factory = RequestFactory()
+        requests = [factory.get('/api/v1/new_doc/', HTTP_AUTHORIZATION=f'Token {keys[i % len(keys)]}')
+                    for i in range(args.requests)]
+
+        result['token'] = run(TokenAuthentication(), requests)
+        for name, cache in (('cached_local', TokenCache(alias='')),
+                            ('cached_shared', TokenCache(maxsize=0, alias=args.shared_alias))):
+            with mock.patch.object(CachedTokenAuthentication, 'cache', cache):
+                # 先认证一遍所有token，只统计命中缓存时的开销
+                run(CachedTokenAuthentication(), requests[:len(keys)])
+                result[name] = run(CachedTokenAuthentication(), requests)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+    result['requests'] = args.requests
+    result['users'] = args.users
+    result['db_vendor'] = connection.vendor
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+统计不同http transport下每1000个google api请求建立的TCP/TLS连接数，使用本地https替身服务(benchmarks/fake_google.py)
+
+Run:
+    python -m benchmarks.transport --requests 1000 --concurrency 8
+
+需要openssl命令生成临时的自签名证书
+"""
+import argparse
+import json
+import os
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'maze_google_doc.settings')
+
+import django
+
+django.setup()
+
+import mock
+from google.auth.credentials import AnonymousCredentials
+
+from benchmarks.fake_google import FakeGoogleServer
+from common.operator_pool import GoogleDocOperatorPool
+from common.transport import reset_shared_adapter
+from common.utils import GoogleDocOperator
+from maze_google_doc import settings
+
+
+def make_certificate(directory):
+    cert_file = os.path.join(directory, 'cert.pem')
+    key_file = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-keyout', key_file, '-out', cert_file, '-subj', '/CN=127.0.0.1',
+                    '-addext', 'subjectAltName=IP:127.0.0.1'], check=True, capture_output=True)
+    return cert_file, key_file
+
+
+def get_file(operator, file_id):
+    operator.drive_service.files().get(fileId=file_id, fields='id').execute()
+
+
+def run_scenario(server, file_id, requests, concurrency, per_request):
+    pool = GoogleDocOperatorPool(credentials=AnonymousCredentials())
+
+    def one_request(_):
+        if per_request:
+            get_file(GoogleDocOperator(credentials=AnonymousCredentials()), file_id)
+        else:
+            with pool.checkout() as operator:
+                get_file(operator, file_id)
+
+    connections = server.state.calls.get('connections', 0)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one_request, range(requests)))
+    elapsed = time.perf_counter() - start
+    opened = server.state.calls.get('connections', 0) - connections
+    return {
+        'requests': requests,
+        'connections': opened,
+        'connections_per_1000_requests': round(opened * 1000 / requests, 1),
+        'requests_per_second': round(requests / elapsed, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args(argv)
+
+    scenarios = (
+        ('per_request_operator_httplib2', 'httplib2', True),
+        ('per_request_operator_requests', 'requests', True),
+        ('operator_pool_httplib2', 'httplib2', False),
+        ('operator_pool_requests', 'requests', False),
+    )
+    result = {}
+    with tempfile.TemporaryDirectory() as directory:
+        cert_file, key_file = make_certificate(directory)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_file, key_file)
+        with FakeGoogleServer(ssl_context=context) as server, \
+                mock.patch.object(settings, 'GOOGLE_API_ROOT_URL', server.root_url), \
+                mock.patch.object(settings, 'GOOGLE_HTTP_CA_CERTS', cert_file):
+            file_id = server.state.add_file('benchmark')['id']
+            for name, transport, per_request in scenarios:
+                reset_shared_adapter()
+                with mock.patch.object(settings, 'GOOGLE_HTTP_TRANSPORT', transport):
+                    result[name] = run_scenario(server, file_id, args.requests, args.concurrency, per_request)
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+import contextvars
+import json
+import random
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+from common import metrics
+from common.logger import logger
+from common.rate_limit import RateLimitedError, TokenBucket
+from maze_google_doc import settings
+
+# 可重试的http状态码，403只有限流原因的才重试
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+# 5xx时google可能已经执行了请求，只重试重复执行没有副作用的方法；files.create、files.copy等重试可能生成重复的文件
+IDEMPOTENT_METHODS = ('get', 'list', 'delete', 'export', 'update', 'getStartPageToken')
+
+
+class CallTimings(object):
+    """
+    当前请求google api调用的耗时统计：在令牌桶中等待的时间、网络请求(含google处理)的时间和退避等待的时间，
+    以及按api方法(如drive.files.list)分别统计的调用次数和网络时间
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.limiter_wait = 0.0
+        self.network = 0.0
+        self.backoff = 0.0
+        # {method_id: [调用次数, 网络时间]}
+        self.methods = {}
+        # operator池的线程与请求线程共用同一个CallTimings
+        self._lock = threading.Lock()
+
+    def add_call(self, method_id, wait, network):
+        with self._lock:
+            self.calls += 1
+            self.limiter_wait += wait
+            self.network += network
+            method = self.methods.setdefault(method_id, [0, 0.0])
+            method[0] += 1
+            method[1] += network
+
+    def add_retry(self, delay):
+        with self._lock:
+            self.retries += 1
+            self.backoff += delay
+
+    def as_dict(self):
+        return {'calls': self.calls, 'retries': self.retries, 'limiter_wait': round(self.limiter_wait, 4),
+                'network': round(self.network, 4), 'backoff': round(self.backoff, 4)}
+
+    def server_timing(self, total=None):
+        """
+        :param total: 整个请求的耗时(秒)
+        :return: Server-Timing响应头，如 google;dur=120.5;desc="3 calls", drive.files.list;dur=40.1;desc="2 calls"
+        """
+        metrics = [f'google;dur={self.network * 1000:.1f};desc="{self.calls} calls"']
+        if self.limiter_wait:
+            metrics.append(f'google-limiter;dur={self.limiter_wait * 1000:.1f}')
+        if self.backoff:
+            metrics.append(f'google-backoff;dur={self.backoff * 1000:.1f};desc="{self.retries} retries"')
+        with self._lock:
+            methods = sorted(self.methods.items())
+        metrics.extend(f'{method_id};dur={network * 1000:.1f};desc="{calls} calls"'
+                       for method_id, (calls, network) in methods)
+        if total is not None:
+            metrics.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(metrics)
+
+
+# 用contextvar而不是threading.local：asyncio的view中每个请求是一个task，各自有自己的CallTimings
+_timings = contextvars.ContextVar('google_call_timings', default=None)
+
+
+def get_call_timings():
+    """
+    :return: 当前请求(线程或asyncio task)从上次reset_call_timings起累计的CallTimings
+    """
+    timings = _timings.get()
+    if timings is None:
+        timings = CallTimings()
+        _timings.set(timings)
+    return timings
+
+
+def reset_call_timings():
+    """
+    开始统计新的一段调用(如一个web请求)，返回新的CallTimings
+    """
+    timings = CallTimings()
+    _timings.set(timings)
+    return timings
+
+
+def record_call(method_id, wait, network, err=None):
+    """
+    记录一次google api http请求到当前请求的CallTimings和进程内指标
+
+    :param err: 请求抛出的异常，成功时为None
+    """
+    get_call_timings().add_call(method_id, wait, network)
+    if not settings.METRICS_ENABLED:
+        return
+    if err is None:
+        status = 'ok'
+    elif isinstance(err, HttpError):
+        status = str(getattr(err.resp, 'status', 'error'))
+    else:
+        status = 'error'
+    metrics.google_api_requests.inc(method=method_id, status=status)
+    metrics.google_api_duration.observe(network, method=method_id)
+    if wait:
+        metrics.google_api_limiter_wait.inc(wait, method=method_id)
+
+
+def record_retry(method_id, delay):
+    get_call_timings().add_retry(delay)
+    if settings.METRICS_ENABLED:
+        metrics.google_api_retries.inc(method=method_id)
+
+
+def get_error_reason(err):
+    """
+    :param err: HttpError
+    :return: google api错误响应中的第一个reason，如userRateLimitExceeded，没有时返回None
+    """
+    try:
+        content = err.content.decode('utf-8') if isinstance(err.content, bytes) else err.content
+        error = json.loads(content)['error']
+        errors = error.get('errors') or error.get('details') or []
+        return errors[0].get('reason') if errors else None
+    except Exception:
+        return None
+
+
+def is_rate_limit_error(err):
+    if not isinstance(err, HttpError):
+        return False
+    status = getattr(err.resp, 'status', None)
+    return status == 429 or (status == 403 and get_error_reason(err) in RATE_LIMIT_REASONS)
+
+
+def is_idempotent(method_id):
+    """
+    :param method_id: 如drive.files.get
+    """
+    return method_id.rsplit('.', 1)[-1] in IDEMPOTENT_METHODS
+
+
+def is_retryable_error(err, method_id):
+    """
+    判断google api异常是否值得重试：429、403 rateLimitExceeded/userRateLimitExceeded(请求未被执行)，
+    以及幂等方法的5xx
+
+    :param err: Exception
+    :param method_id: 请求的方法，如drive.files.create
+    :return: bool
+    """
+    if not isinstance(err, HttpError):
+        return False
+    if is_rate_limit_error(err):
+        return True
+    return getattr(err.resp, 'status', None) in RETRYABLE_STATUSES and is_idempotent(method_id)
+
+
+def get_retry_after(err):
+    """
+    :return: 响应头Retry-After给出的秒数，没有时返回None
+    """
+    try:
+        return float(err.resp.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class GoogleApiExecutor(object):
+    """
+    GoogleDocOperator所有google api请求的统一出口：
+
+    * 请求前从对应api(drive/docs)的共享令牌桶取令牌，batch请求按子请求数取
+    * 429、403限流和幂等方法(get、list、delete等)的5xx错误按指数退避加随机抖动(full jitter)重试，
+      响应带Retry-After时至少等待该时间；create、copy的5xx不重试，google可能已经创建了文件
+    * 重试后仍被限流时抛出RateLimitedError，由view转换成带Retry-After的限流响应
+    * 每次调用的令牌桶等待、网络和退避时间累计到当前请求的CallTimings，并记录到common.metrics的进程内指标
+    """
+
+    def __init__(self, buckets=None, max_attempts=None, backoff_base=None, backoff_max=None):
+        """
+        :param buckets: {api名称: TokenBucket}，默认按settings创建drive和docs两个令牌桶
+        :param max_attempts: 最大重试次数
+        :param backoff_base: 退避时间的基数(秒)
+        :param backoff_max: 退避时间的上限(秒)
+        """
+        if buckets is None:
+            buckets = {
+                'drive': TokenBucket('drive', settings.GOOGLE_DRIVE_RATE, settings.GOOGLE_DRIVE_BURST),
+                'docs': TokenBucket('docs', settings.GOOGLE_DOCS_RATE, settings.GOOGLE_DOCS_BURST),
+            }
+        self.buckets = buckets
+        self.max_attempts = settings.GOOGLE_RETRY_MAX_ATTEMPTS if max_attempts is None else max_attempts
+        self.backoff_base = settings.GOOGLE_RETRY_BACKOFF_BASE if backoff_base is None else backoff_base
+        self.backoff_max = settings.GOOGLE_RETRY_BACKOFF_MAX if backoff_max is None else backoff_max
+
+    @staticmethod
+    def method_id(request):
+        # googleapiclient的HttpRequest带有methodId，如drive.files.list
+        method_id = getattr(request, 'methodId', None)
+        return method_id if isinstance(method_id, str) else 'unknown'
+
+    def _acquire(self, method_id, tokens=1):
+        """
+        :return: 在令牌桶中等待的时间(秒)
+        """
+        bucket = self.buckets.get(method_id.split('.')[0])
+        if bucket is None or not settings.GOOGLE_RATE_LIMIT_ENABLED:
+            return 0.0
+        wait = bucket.acquire(tokens, max_wait=settings.GOOGLE_RATE_LIMIT_MAX_WAIT)
+        if wait > 1:
+            logger.warning(f'{method_id} waited {wait:.2f}s in rate limiter {bucket.name}')
+        return wait
+
+    def backoff(self, attempt, err=None):
+        """
+        :param attempt: 第几次重试，从0开始
+        :param err: 触发重试的异常
+        :return: 重试前的等待时间(秒)
+        """
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        retry_after = get_retry_after(err) if err is not None else None
+        return max(delay, min(retry_after, self.backoff_max)) if retry_after else delay
+
+    def _sleep_backoff(self, attempt, err, method_id, what=None):
+        delay = self.backoff(attempt, err)
+        logger.warning(f'{what or method_id} failed with {getattr(err.resp, "status", None)} '
+                       f'{get_error_reason(err)}, retry {attempt + 1}/{self.max_attempts} in {delay:.2f}s')
+        record_retry(method_id, delay)
+        time.sleep(delay)
+
+    def execute(self, request):
+        """
+        执行一个googleapiclient HttpRequest
+
+        :param request: 如 drive_service.files().get(...)
+        :return: 响应内容
+        """
+        method_id = self.method_id(request)
+        for attempt in range(self.max_attempts + 1):
+            wait = self._acquire(method_id)
+            start = time.monotonic()
+            error = None
+            try:
+                return request.execute()
+            except Exception as err:
+                error = err
+                if not is_retryable_error(err, method_id):
+                    raise
+                if attempt >= self.max_attempts:
+                    if is_rate_limit_error(err):
+                        raise RateLimitedError(f'{method_id} is rate limited by google: {err}',
+                                               retry_after=get_retry_after(err) or self.backoff_max) from err
+                    raise
+            finally:
+                network = time.monotonic() - start
+                record_call(method_id, wait, network, error)
+                logger.debug(f'{method_id}: limiter {wait * 1000:.1f}ms, network {network * 1000:.1f}ms')
+            self._sleep_backoff(attempt, error, method_id)
+
+    def execute_batch(self, service, requests, batch_size=None):
+        """
+        把多个请求按batch_size分批，通过google batch http请求发送；
+        子请求返回可重试的错误时，退避后把这些子请求放到新的batch中重试
+
+        :param service: 发起请求的service，如drive_service
+        :param requests: [(key, HttpRequest)]，key在本次调用中唯一
+        :param batch_size: 每个batch的最大请求数，默认settings.GOOGLE_BATCH_SIZE
+        :return: {key: 响应内容或异常}，令牌桶等待过久的batch中的请求为RateLimitedError
+        """
+        batch_size = settings.GOOGLE_BATCH_SIZE if batch_size is None else batch_size
+        results = {}
+        for start in range(0, len(requests), batch_size):
+            pending = requests[start:start + batch_size]
+            for attempt in range(self.max_attempts + 1):
+                chunk_results = {}
+                keys = {str(i): key for i, (key, _) in enumerate(pending)}
+
+                def callback(request_id, response, exception):
+                    chunk_results[keys[request_id]] = exception if exception is not None else response
+
+                batch = service.new_batch_http_request(callback=callback)
+                for i, (_, request) in enumerate(pending):
+                    batch.add(request, request_id=str(i))
+                # 指标中batch请求记为 batch:子请求的方法，如batch:drive.files.copy
+                method_id = 'batch:' + self.method_id(pending[0][1])
+                try:
+                    wait = self._acquire(self.method_id(pending[0][1]), len(pending))
+                except RateLimitedError as e:
+                    # 只有本batch未发送，之前batch的结果(如已创建的文档)仍然返回
+                    logger.warning(f'batch request of {len(pending)} calls is rate limited: {e}')
+                    results.update((key, e) for key, _ in pending)
+                    break
+                begin = time.monotonic()
+                error = None
+                try:
+                    batch.execute()
+                except Exception as e:
+                    # 整个batch失败时，其中尚无结果的请求都记为该异常
+                    logger.exception(f'batch request of {len(pending)} calls failed: {e}')
+                    error = e
+                    for key, _ in pending:
+                        chunk_results.setdefault(key, e)
+                finally:
+                    record_call(method_id, wait, time.monotonic() - begin, error)
+                results.update(chunk_results)
+
+                retry = [(key, request) for key, request in pending
+                         if is_retryable_error(chunk_results.get(key), self.method_id(request))]
+                if not retry or attempt >= self.max_attempts:
+                    break
+                self._sleep_backoff(attempt, chunk_results[retry[0][0]], method_id,
+                                    f'{len(retry)} of batch requests')
+                # 子请求对象重新加入新的batch时会重新序列化，可以直接复用
+                pending = retry
+        return results
+
+
+_default_executor = None
+_default_executor_lock = threading.Lock()
+
+
+def get_default_executor():
+    """
+    进程内所有operator共用的GoogleApiExecutor，第一次使用时按settings创建
+    """
+    global _default_executor
+    with _default_executor_lock:
+        if _default_executor is None:
+            _default_executor = GoogleApiExecutor()
+        return _default_executor
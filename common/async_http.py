@@ -0,0 +1,81 @@
+import asyncio
+import ssl
+from collections import namedtuple
+
+import httpx
+
+from maze_google_doc import settings
+
+# headers的key为小写
+AsyncResponse = namedtuple('AsyncResponse', ['status', 'reason', 'headers', 'content'])
+
+
+class AsyncHttpClient(object):
+    """
+    httpx.AsyncClient的封装，供AsyncGoogleDocOperator访问google api
+
+    按host保留keep-alive连接，同时最多max_connections个连接，超出的请求等待空闲连接；
+    httpx的连接池属于创建它的事件循环，换了事件循环(如测试中多次asyncio.run)时重新创建，事件循环结束时关闭
+    """
+
+    def __init__(self, max_connections=None, max_idle=None, timeout=None, ca_certs=None):
+        """
+        :param max_connections: 最大并发连接数
+        :param max_idle: 保留的最大空闲连接数
+        :param timeout: 连接、发送和读取的超时时间(秒)
+        :param ca_certs: 校验服务端证书的CA文件，为空时使用默认CA
+        """
+        self.max_connections = settings.GOOGLE_ASYNC_HTTP_MAX_CONNECTIONS if max_connections is None \
+            else max_connections
+        self.max_idle = settings.GOOGLE_ASYNC_HTTP_MAX_IDLE if max_idle is None else max_idle
+        self.timeout = settings.GOOGLE_HTTP_TIMEOUT if timeout is None else timeout
+        ca_certs = settings.GOOGLE_HTTP_CA_CERTS if ca_certs is None else ca_certs
+        self.ssl_context = ssl.create_default_context(cafile=ca_certs or None)
+        self._loop = None
+        self._client = None
+        self._closer = None
+
+    async def _get_client(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            if self._closer is not None and not self._loop.is_closed():
+                # 原事件循环仍在运行(如在其他线程中)，在原循环中关闭client，释放其连接
+                asyncio.run_coroutine_threadsafe(self._closer.aclose(), self._loop)
+            self._loop = loop
+            self._client = httpx.AsyncClient(
+                verify=self.ssl_context,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_idle),
+                # 等待空闲连接不计入超时
+                timeout=httpx.Timeout(self.timeout, pool=None))
+            # asyncio.run(uvicorn等)结束前会关闭事件循环中所有未结束的async generator，借此在循环结束时关闭client
+            self._closer = self._close_with_loop(self._client)
+            await self._closer.__anext__()
+        return self._client
+
+    @staticmethod
+    async def _close_with_loop(client):
+        try:
+            yield
+        finally:
+            await client.aclose()
+
+    async def request(self, method, url, body=None, headers=None):
+        """
+        :param method: http method
+        :param url: 完整的url
+        :param body: str或bytes
+        :param headers: 请求头
+        :return: AsyncResponse，响应体已解压
+        """
+        client = await self._get_client()
+        response = await client.request(method, url, content=body, headers=headers)
+        headers = {key.lower(): value for key, value in response.headers.items()}
+        if headers.pop('content-encoding', None):
+            headers['content-length'] = str(len(response.content))
+        return AsyncResponse(response.status_code, response.reason_phrase, headers, response.content)
+
+    async def aclose(self):
+        if self._closer is not None and self._loop is asyncio.get_running_loop():
+            await self._closer.aclose()
+        self._loop = self._client = self._closer = None
@@ -0,0 +1,244 @@
+import asyncio
+import time
+
+import httplib2
+from asgiref.sync import sync_to_async
+from google.auth.transport.requests import Request
+from googleapiclient.errors import HttpError
+
+from common.api_executor import get_default_executor, get_retry_after, is_rate_limit_error, is_retryable_error, \
+    record_call, record_retry
+from common.async_http import AsyncHttpClient
+from common.folder_cache import folder_cache as default_folder_cache, parent_cache as default_parent_cache
+from common.logger import logger, payload
+from common.rate_limit import RateLimitedError
+from common.transport import build_http
+from common.utils import DOCUMENT_MIME_TYPE, DocCreateMode, build_service, is_not_found_error
+from maze_google_doc import settings
+
+
+class AsyncGoogleDocOperator(object):
+    """
+    GoogleDocOperator的asyncio版本，create_doc、make_copy等方法与GoogleDocOperator相同但为协程
+
+    请求由googleapiclient的service构建(只生成url和body，不做io)，通过AsyncHttpClient发送，
+    等待google响应时不占用线程，一个进程可以同时挂起上千个google api调用；
+    令牌桶、退避重试、目录缓存与GoogleDocOperator共用，查找或创建不在缓存中的目录(需要数据库锁)时在线程池中从operator池
+    取出同步的operator调用；不保存请求相关的状态，同一进程内所有请求共用一个实例，见get_async_operator
+    """
+
+    def __init__(self, credentials, http=None, folder_cache=None):
+        """
+        :param credentials: operator池共享的凭证
+        :param http: AsyncHttpClient，默认使用进程共享的client
+        :param folder_cache: 目录id缓存，默认使用进程共享的common.folder_cache.folder_cache
+        """
+        self.credentials = credentials
+        self.http = http if http is not None else get_async_http()
+        self.folder_cache = folder_cache if folder_cache is not None else default_folder_cache
+        self.parent_cache = default_parent_cache
+        self.executor = get_default_executor()
+        # service只用于构建请求，不通过它的http发送；service.files()每次调用都会重新生成所有方法(含文档字符串)，只生成一次
+        self.drive_files = build_service('drive', 'v3', build_http(credentials)).files()
+
+    async def _run_sync(self, method, *args):
+        """
+        在线程池中从operator池取出一个同步的GoogleDocOperator，调用其method方法
+        """
+        from common.operator_pool import operator_pool
+
+        def run():
+            with operator_pool.checkout() as operator:
+                return getattr(operator, method)(*args)
+        return await sync_to_async(run, thread_sensitive=False)()
+
+    async def _authorize(self, headers, force_refresh=False):
+        if force_refresh or not self.credentials.valid:
+            # token交换是同步的网络请求，放到线程中执行；SharedTokenCredentials内部有锁，并发刷新只交换一次
+            await sync_to_async(self.credentials.refresh, thread_sensitive=False)(Request())
+        self.credentials.apply(headers)
+
+    async def _acquire(self, method_id):
+        executor = self.executor
+        bucket = executor.buckets.get(method_id.split('.')[0])
+        if bucket is None or not settings.GOOGLE_RATE_LIMIT_ENABLED:
+            return 0.0
+        # 预取的令牌在进程内扣除，只有需要访问共享令牌桶时才会查询数据库
+        wait = await sync_to_async(bucket.reserve, thread_sensitive=False)(
+            1, max_wait=settings.GOOGLE_RATE_LIMIT_MAX_WAIT)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    async def _send(self, request):
+        """
+        发送一次请求，401时刷新token后重发一次
+
+        :return: 响应内容，错误响应由googleapiclient的postproc抛出HttpError
+        """
+        headers = dict(request.headers)
+        await self._authorize(headers)
+        response = await self.http.request(request.method, request.uri, request.body, headers)
+        if response.status == 401:
+            await self._authorize(headers, force_refresh=True)
+            response = await self.http.request(request.method, request.uri, request.body, headers)
+        resp = httplib2.Response(dict(response.headers, status=str(response.status)))
+        resp.reason = response.reason
+        return request.postproc(resp, response.content)
+
+    async def execute(self, request):
+        """
+        与GoogleApiExecutor.execute相同的限流和重试逻辑
+
+        :param request: googleapiclient HttpRequest
+        :return: 响应内容
+        """
+        executor = self.executor
+        method_id = executor.method_id(request)
+        for attempt in range(executor.max_attempts + 1):
+            wait = await self._acquire(method_id)
+            start = time.monotonic()
+            error = None
+            try:
+                return await self._send(request)
+            except Exception as err:
+                error = err
+                if not is_retryable_error(err, method_id):
+                    raise
+                if attempt >= executor.max_attempts:
+                    if is_rate_limit_error(err):
+                        raise RateLimitedError(f'{method_id} is rate limited by google: {err}',
+                                               retry_after=get_retry_after(err) or executor.backoff_max) from err
+                    raise
+                delay = executor.backoff(attempt, err)
+                logger.warning(f'{method_id} failed with {err.resp.status}, '
+                               f'retry {attempt + 1}/{executor.max_attempts} in {delay:.2f}s')
+            finally:
+                network = time.monotonic() - start
+                record_call(method_id, wait, network, error)
+                logger.debug(f'{method_id}: limiter {wait * 1000:.1f}ms, network {network * 1000:.1f}ms')
+            record_retry(method_id, delay)
+            await asyncio.sleep(delay)
+
+    async def get_or_create_folder(self, folder_list):
+        """
+        :param folder_list: 目录名称列表，从左至右目录层次由高到底
+        :return: 最底层目录的folder id
+        """
+        # 共享层缓存可能是数据库，同样放到线程中查询
+        folder_id = await sync_to_async(self.folder_cache.resolve_path, thread_sensitive=False)(
+            folder_list, settings.DOC_ROOT_FOLDER_ID)
+        if folder_id:
+            return folder_id
+        return await self._run_sync('get_or_create_folder', folder_list)
+
+    async def _call_in_folder(self, folder_list, fn):
+        """
+        与GoogleDocOperator._call_in_folder相同：目录已被删除(404)时清除缓存，重新查找或创建目录后再试一次
+
+        :param fn: 协程函数 fn(folder_id)
+        """
+        folder_id = await self.get_or_create_folder(folder_list)
+        if not folder_id:
+            raise ValueError(f'failed to create folder {folder_list}')
+        try:
+            return await fn(folder_id)
+        except HttpError as err:
+            if not is_not_found_error(err):
+                raise
+            logger.warning(f'folder {folder_id} for {folder_list} not found, invalidating cache')
+            await sync_to_async(self.folder_cache.invalidate_path, thread_sensitive=False)(
+                folder_list, settings.DOC_ROOT_FOLDER_ID)
+            folder_id = await self.get_or_create_folder(folder_list)
+            if not folder_id:
+                raise ValueError(f'failed to create folder {folder_list}')
+            return await fn(folder_id)
+
+    async def create_doc(self, title, username, direct_folder):
+        """
+        见GoogleDocOperator.create_doc；DOC_CREATE_MODE为旧的copy方式时在线程池中调用同步的operator
+
+        :return: 生成文件file id，生成文件link
+        """
+        if DocCreateMode(settings.DOC_CREATE_MODE) == DocCreateMode.DOCS_COPY:
+            return await self._run_sync('create_doc', title, username, direct_folder)
+        folder_list = [username, direct_folder]
+
+        async def create_in_folder(folder_id):
+            body = {'name': title, 'mimeType': DOCUMENT_MIME_TYPE, 'parents': [folder_id]}
+            return await self.execute(self.drive_files.create(body=body, fields='id,webViewLink'))
+
+        file = await self._call_in_folder(folder_list, create_in_folder)
+        logger.info(f'create_doc: created {title} under {folder_list}, response is {payload(file)}')
+        return file.get('id'), file.get('webViewLink')
+
+    async def get_parent_folders(self, file_id, use_cache=True):
+        """
+        见GoogleDocOperator.get_parent_folders
+        """
+        parent_cache = self.parent_cache
+        if use_cache:
+            parents = parent_cache.get(file_id)
+            if parents:
+                return parents
+        file = await self.execute(self.drive_files.get(fileId=file_id, fields='parents'))
+        parents = file.get('parents')
+        if parents:
+            parent_cache.set(file_id, parents)
+        return parents
+
+    async def _copy_to_parent(self, source_file_id, new_tile):
+        parents = await self.get_parent_folders(source_file_id)
+        if not parents:
+            raise ValueError(f'failed to create folder to make copy for doc: {new_tile}')
+        body = {'name': new_tile, 'parents': [parents[0]]}
+        return await self.execute(self.drive_files.copy(
+            fileId=source_file_id, body=body, fields='id,webViewLink,parents'))
+
+    async def make_copy(self, source_file_id, new_tile):
+        """
+        见GoogleDocOperator.make_copy
+
+        :return: 生成文件file id，生成文件link
+        """
+        cached = self.parent_cache.get(source_file_id) is not None
+        try:
+            drive_response = await self._copy_to_parent(source_file_id, new_tile)
+        except HttpError as err:
+            if not (cached and is_not_found_error(err)):
+                raise
+            logger.warning(f'make_copy: cached parents of {source_file_id} are stale, retrying')
+            self.parent_cache.delete(source_file_id)
+            drive_response = await self._copy_to_parent(source_file_id, new_tile)
+        return drive_response.get('id'), drive_response.get('webViewLink')
+
+
+_async_http = None
+
+
+def get_async_http():
+    """
+    进程内共享的AsyncHttpClient
+    """
+    global _async_http
+    if _async_http is None:
+        _async_http = AsyncHttpClient()
+    return _async_http
+
+
+_async_operator = None
+
+
+async def get_async_operator():
+    """
+    进程内共享的AsyncGoogleDocOperator，由operator池的凭证构建，凭证变化(如fork后池重置)时重新构建
+
+    与operator池的acquire一样，先检查fork并同步其他进程通知的缓存失效
+    """
+    from common.operator_pool import operator_pool
+
+    global _async_operator
+    credentials = await sync_to_async(operator_pool.prepare, thread_sensitive=False)()
+    if _async_operator is None or _async_operator.credentials is not credentials:
+        _async_operator = AsyncGoogleDocOperator(credentials)
+    return _async_operator
@@ -0,0 +1,132 @@
+import hashlib
+import threading
+
+from cachetools import TTLCache
+from django.core.cache import caches
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+from maze_google_doc import settings
+
+
+class TokenCache(object):
+    """
+    token key -> (user, token) 的缓存：进程内LRU+TTL，可选一层共享的django cache(AUTH_TOKEN_CACHE_ALIAS)
+
+    token被删除、用户被修改(如停用)时由signal删除本进程和共享层中的缓存；其他进程的进程内缓存最多在ttl秒后失效
+    """
+
+    KEY_PREFIX = 'google_doc:auth_token:'
+
+    def __init__(self, maxsize=None, ttl=None, alias=None, shared_timeout=None):
+        """
+        :param maxsize: 进程内缓存的最大条目数，为0时不使用进程内缓存
+        :param ttl: 进程内缓存时间(秒)
+        :param alias: 共享层使用的django cache别名，为空时不使用共享层
+        :param shared_timeout: 共享层缓存时间(秒)
+        """
+        maxsize = settings.AUTH_TOKEN_CACHE_MAXSIZE if maxsize is None else maxsize
+        ttl = settings.AUTH_TOKEN_CACHE_TTL if ttl is None else ttl
+        self.alias = settings.AUTH_TOKEN_CACHE_ALIAS if alias is None else alias
+        self.shared_timeout = settings.AUTH_TOKEN_CACHE_SHARED_TIMEOUT if shared_timeout is None else shared_timeout
+        self._local = TTLCache(maxsize=maxsize, ttl=ttl) if maxsize and ttl else None
+        self._lock = threading.Lock()
+
+    def make_key(self, key):
+        # 共享层(如数据库缓存)中不保存明文token
+        return self.KEY_PREFIX + hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get_local(self, key):
+        """
+        :return: 进程内缓存的(user, token)，未命中返回None
+        """
+        if self._local is None:
+            return None
+        with self._lock:
+            return self._local.get(key)
+
+    def get(self, key):
+        """
+        :return: 缓存的(user, token)，未命中返回None
+        """
+        entry = self.get_local(key)
+        if entry is None and self.alias:
+            entry = caches[self.alias].get(self.make_key(key))
+            if entry is not None and self._local is not None:
+                with self._lock:
+                    self._local[key] = entry
+        return entry
+
+    def set(self, key, entry):
+        if self._local is not None:
+            with self._lock:
+                self._local[key] = entry
+        if self.alias:
+            caches[self.alias].set(self.make_key(key), entry, self.shared_timeout)
+
+    def delete(self, key):
+        if self._local is not None:
+            with self._lock:
+                self._local.pop(key, None)
+        if self.alias:
+            caches[self.alias].delete(self.make_key(key))
+
+    def clear_local(self):
+        if self._local is not None:
+            with self._lock:
+                self._local.clear()
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    与DRF TokenAuthentication相同的认证方式，token对应的用户缓存在token_cache中，命中时不查询数据库
+    """
+
+    cache = token_cache
+
+    def authenticate_credentials(self, key):
+        if not settings.AUTH_TOKEN_CACHE_ENABLED:
+            return super().authenticate_credentials(key)
+        entry = self.cache.get(key)
+        if entry is None:
+            # 无效的token不缓存，DoesNotExist时抛出AuthenticationFailed
+            entry = super().authenticate_credentials(key)
+            self.cache.set(key, entry)
+        elif not entry[0].is_active:
+            raise exceptions.AuthenticationFailed('User inactive or deleted.')
+        return entry
+
+
+def token_deleted(sender, instance, **kwargs):
+    token_cache.delete(instance.key)
+
+
+# 影响认证结果的用户字段，只更新其他字段(如登录时的last_login)时不需要删除token缓存
+AUTH_USER_FIELDS = frozenset(['is_active', 'password'])
+
+
+def user_saved(sender, instance, created=False, update_fields=None, **kwargs):
+    """
+    用户被修改(如is_active=False)后，删除该用户所有token的缓存，之后的请求重新从数据库读取用户
+    """
+    from rest_framework.authtoken.models import Token
+
+    if created or (update_fields is not None and not AUTH_USER_FIELDS.intersection(update_fields)):
+        return
+    for key in Token.objects.filter(user_id=instance.pk).values_list('key', flat=True):
+        token_cache.delete(key)
+
+
+def connect_signals():
+    """
+    在AppConfig.ready中调用；QuerySet.update不会发送signal，批量停用用户后需等待缓存过期
+    """
+    from django.contrib.auth import get_user_model
+    from django.db.models.signals import post_delete, post_save
+    from rest_framework.authtoken.models import Token
+
+    post_delete.connect(token_deleted, sender=Token, dispatch_uid='google_doc.token_cache.token_deleted')
+    post_save.connect(user_saved, sender=get_user_model(), dispatch_uid='google_doc.token_cache.user_saved')
@@ -0,0 +1,179 @@
+import hashlib
+import threading
+from datetime import datetime, timedelta, timezone
+
+from django.core.cache import caches
+from django.db import connection
+from google.auth import credentials as google_credentials
+from google.auth.transport.requests import Request
+
+from common.locks import LockTimeout, db_lock
+from common.logger import logger
+from maze_google_doc import settings
+
+
+class SharedTokenCredentials(google_credentials.Credentials):
+    """
+    service account凭证的包装：access token和过期时间保存在共享的django cache(GOOGLE_TOKEN_CACHE_ALIAS)中，
+    所有worker进程共用同一个token，新建的凭证直接读取缓存，不需要每个进程(或每个请求)做一次JWT签名和token交换
+
+    token由TokenRefresher在过期前主动刷新；缓存中没有可用token时，请求路径上持有数据库锁刷新，
+    保证同一时刻只有一个进程在和oauth2.googleapis.com交换token
+    """
+
+    KEY_PREFIX = 'google_doc:token:'
+
+    def __init__(self, source, alias=None):
+        """
+        :param source: 真正交换token的凭证，如service_account.Credentials
+        :param alias: 保存token的django cache别名
+        """
+        super().__init__()
+        self.source = source
+        self.alias = settings.GOOGLE_TOKEN_CACHE_ALIAS if alias is None else alias
+        scopes = ' '.join(sorted(getattr(source, 'scopes', None) or []))
+        account = getattr(source, 'service_account_email', '')
+        self.cache_key = self.KEY_PREFIX + hashlib.sha1(f'{account}/{scopes}'.encode('utf-8')).hexdigest()
+        self._lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    @property
+    def quota_project_id(self):
+        return getattr(self.source, 'quota_project_id', None)
+
+    def get_cached_token(self):
+        """
+        :return: (token, expiry)，缓存中没有时返回(None, None)
+        """
+        entry = self.shared.get(self.cache_key)
+        if not entry:
+            return None, None
+        expiry = entry['expiry']
+        return entry['token'], datetime.utcfromtimestamp(expiry) if expiry is not None else None
+
+    def _store(self, token, expiry):
+        self.token, self.expiry = token, expiry
+        timeout = (expiry - datetime.utcnow()).total_seconds() if expiry else None
+        if timeout is None or timeout > 0:
+            # google.auth的expiry为不带时区的utc时间
+            timestamp = expiry.replace(tzinfo=timezone.utc).timestamp() if expiry else None
+            self.shared.set(self.cache_key, {'token': token, 'expiry': timestamp}, timeout)
+
+    def _adopt_cached(self, rejected_token=None):
+        """
+        使用缓存中仍然有效且不是rejected_token的token
+
+        :return: 是否已取得可用token
+        """
+        token, expiry = self.get_cached_token()
+        if not token or token == rejected_token:
+            return False
+        self.token, self.expiry = token, expiry
+        return self.valid
+
+    def _refresh_source(self, request):
+        self.source.refresh(request)
+        self._store(self.source.token, self.source.expiry)
+        logger.info(f'refreshed google access token {self.cache_key}, expires at {self.expiry}')
+
+    def refresh(self, request):
+        """
+        token过期或被google拒绝(401)时由google.auth调用：优先使用其他进程已刷新好的token，否则加锁刷新
+
+        :param request: google.auth.transport.Request
+        """
+        with self._lock:
+            # 当前token仍在有效期内却被要求刷新，说明已被google拒绝，不能再使用缓存中的同一个token
+            rejected_token = self.token if self.valid else None
+            if self._adopt_cached(rejected_token):
+                return
+            try:
+                with db_lock(f'google_token:{self.cache_key}', timeout=settings.GOOGLE_TOKEN_REFRESH_LOCK_TIMEOUT):
+                    if not self._adopt_cached(rejected_token):
+                        self._refresh_source(request)
+            except LockTimeout:
+                logger.warning(f'timed out waiting for token refresh lock of {self.cache_key}, refreshing directly')
+                self._refresh_source(request)
+
+    def refresh_if_expiring(self, request, margin):
+        """
+        缓存中的token在margin秒内过期时刷新，供TokenRefresher调用；其他进程正在刷新时直接返回
+
+        :param request: google.auth.transport.Request
+        :param margin: 提前刷新的时间(秒)
+        :return: 是否由本进程刷新了token
+        """
+        deadline = datetime.utcnow() + timedelta(seconds=margin)
+        token, expiry = self.get_cached_token()
+        if token and (expiry is None or expiry > deadline):
+            return False
+        # 与refresh相同的加锁顺序：先进程内的锁，再数据库锁
+        with self._lock:
+            try:
+                with db_lock(f'google_token:{self.cache_key}', timeout=0):
+                    token, expiry = self.get_cached_token()
+                    if token and (expiry is None or expiry > deadline):
+                        return False
+                    self._refresh_source(request)
+                    return True
+            except LockTimeout:
+                return False
+
+
+class TokenRefresher(object):
+    """
+    后台线程，每interval秒检查一次共享token，在过期前margin秒内主动刷新；
+    每个worker进程都运行一个，通过数据库锁保证只有一个进程真正刷新，请求路径上不需要等待token交换
+    """
+
+    def __init__(self, credentials, interval=None, margin=None):
+        """
+        :param credentials: SharedTokenCredentials
+        :param interval: 检查间隔(秒)
+        :param margin: 提前刷新的时间(秒)
+        """
+        self.credentials = credentials
+        self.interval = settings.GOOGLE_TOKEN_REFRESH_INTERVAL if interval is None else interval
+        self.margin = settings.GOOGLE_TOKEN_REFRESH_MARGIN if margin is None else margin
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        try:
+            return self.credentials.refresh_if_expiring(Request(), self.margin)
+        except Exception as e:
+            # 刷新失败时token仍可能在有效期内，下次检查或请求路径上会再刷新
+            logger.exception(f'failed to refresh google access token: {e}')
+            return False
+        finally:
+            connection.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.run_once()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='google-token-refresher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def wrap_shared_token(credentials):
+    """
+    按settings.GOOGLE_TOKEN_CACHE_ENABLED决定是否用SharedTokenCredentials包装凭证
+
+    :param credentials: google auth credentials
+    :return: 包装后的凭证
+    """
+    if not settings.GOOGLE_TOKEN_CACHE_ENABLED or isinstance(credentials, SharedTokenCredentials):
+        return credentials
+    return SharedTokenCredentials(credentials)
@@ -0,0 +1,129 @@
+import atexit
+import collections
+import os
+import threading
+
+from common.logger import logger
+from common.metrics import delete_queue_length, deleted_files
+from maze_google_doc import settings
+
+
+class DeleteQueue(object):
+    """
+    进程内待删除的google drive文件队列(如create_doc旧方式在默认位置创建的临时文档)，
+    请求线程只放入队列，后台线程每FLUSH_INTERVAL秒或积累满一个batch时通过batch http请求删除；
+    队列满、删除失败或进程退出时未删除的文件由 python manage.py sweep_orphan_docs 清理
+    """
+
+    def __init__(self, maxsize=None, flush_interval=None, batch_size=None):
+        """
+        :param maxsize: 队列长度，满时新的文件不再放入
+        :param flush_interval: 后台线程的删除间隔(秒)
+        :param batch_size: 积累到该数量时立即删除，默认GOOGLE_BATCH_SIZE
+        """
+        self.maxsize = settings.DELETE_QUEUE_MAXSIZE if maxsize is None else maxsize
+        self.flush_interval = settings.DELETE_QUEUE_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.batch_size = settings.GOOGLE_BATCH_SIZE if batch_size is None else batch_size
+        self._reset()
+        delete_queue_length.set(0)
+        # gunicorn --preload fork出的worker中没有父进程的删除线程，锁也可能正被父进程持有，重新创建
+        os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.stop)
+
+    def _reset(self):
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake_up = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, file_id):
+        """
+        :return: 放入队列时返回True，队列已满时返回False
+        """
+        with self._lock:
+            if len(self._pending) >= self.maxsize:
+                deleted_files.inc(source='queue', status='dropped')
+                logger.warning(f'delete queue full, {file_id} is left to the orphan sweeper')
+                return False
+            self._pending.append(file_id)
+            length = len(self._pending)
+            delete_queue_length.set(length)
+        self.ensure_started()
+        if length >= self.batch_size:
+            self._wake_up.set()
+        return True
+
+    def ensure_started(self):
+        """
+        第一次放入文件时启动删除线程
+        """
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._loop, name='delete-queue', daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        from django.db import connection
+
+        while not self._stop.is_set():
+            self._wake_up.wait(self.flush_interval)
+            self._wake_up.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(f'failed to flush delete queue: {e}')
+            finally:
+                # 令牌桶等使用数据库
+                connection.close()
+
+    def flush(self, operator=None):
+        """
+        删除队列中的全部文件，每GOOGLE_BATCH_SIZE个一个batch请求
+
+        :param operator: 发送请求的GoogleDocOperator，默认从operator池中取
+        :return: 删除成功的文件数
+        """
+        with self._flush_lock:
+            with self._lock:
+                file_ids = list(self._pending)
+                self._pending.clear()
+                delete_queue_length.set(0)
+            if not file_ids:
+                return 0
+            if operator is None:
+                from common.operator_pool import operator_pool
+
+                with operator_pool.checkout() as operator:
+                    failed = operator.delete_files(file_ids)
+            else:
+                failed = operator.delete_files(file_ids)
+        for file_id, err in failed.items():
+            logger.warning(f'failed to delete {file_id}, it is left to the orphan sweeper: {err}')
+        deleted_files.inc(len(file_ids) - len(failed), source='queue', status='deleted')
+        deleted_files.inc(len(failed), source='queue', status='failed')
+        return len(file_ids) - len(failed)
+
+    def stop(self, timeout=None):
+        """
+        停止删除线程，并删除队列中剩余的文件
+        """
+        self._stop.set()
+        self._wake_up.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout)
+        try:
+            self.flush()
+        except Exception as e:
+            logger.exception(f'failed to flush delete queue: {e}')
+
+
+delete_queue = DeleteQueue()
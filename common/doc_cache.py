@@ -0,0 +1,84 @@
+import json
+import threading
+from collections import OrderedDict, namedtuple
+
+from maze_google_doc import settings
+
+# version: drive文件的version，用于判断缓存是否仍然有效; revision_id: docs api返回的revisionId，作为ETag;
+# body: documents().get结果序列化后的json bytes
+DocEntry = namedtuple('DocEntry', ['version', 'revision_id', 'body'])
+
+
+class DocumentCache(object):
+    """
+    doc id -> 文档json 的进程内LRU缓存，按json字节数限制总大小
+
+    每个文档只缓存最新的一个revision；是否过期由调用方用drive的version(一次很小的files().get)判断，
+    version未变时直接返回缓存的json，不需要重新下载整个文档
+    """
+
+    def __init__(self, max_bytes=None, max_doc_bytes=None):
+        """
+        :param max_bytes: 缓存的json总字节数上限
+        :param max_doc_bytes: 单个文档的字节数上限，超过的文档不缓存
+        """
+        self.max_bytes = settings.DOC_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.max_doc_bytes = settings.DOC_CACHE_MAX_DOC_BYTES if max_doc_bytes is None else max_doc_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        """
+        :return: 当前缓存的json总字节数
+        """
+        return self._bytes
+
+    def get(self, doc_id, version):
+        """
+        :param doc_id: doc id
+        :param version: drive上文件当前的version
+        :return: DocEntry，未命中或缓存的version已过期时返回None
+        """
+        with self._lock:
+            entry = self._entries.get(doc_id)
+            if entry is None or entry.version != version:
+                return None
+            self._entries.move_to_end(doc_id)
+            return entry
+
+    def set(self, doc_id, version, document):
+        """
+        :param doc_id: doc id
+        :param version: 获取文档前查到的drive version
+        :param document: documents().get的结果
+        :return: 新的DocEntry
+        """
+        body = json.dumps(document, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        entry = DocEntry(version, document.get('revisionId'), body)
+        with self._lock:
+            self._pop(doc_id)
+            if len(body) <= min(self.max_doc_bytes, self.max_bytes):
+                self._entries[doc_id] = entry
+                self._bytes += len(body)
+                while self._bytes > self.max_bytes:
+                    self._pop(next(iter(self._entries)))
+        return entry
+
+    def delete(self, doc_id):
+        with self._lock:
+            self._pop(doc_id)
+
+    def _pop(self, doc_id):
+        entry = self._entries.pop(doc_id, None)
+        if entry is not None:
+            self._bytes -= len(entry.body)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+doc_cache = DocumentCache()
@@ -0,0 +1,109 @@
+import json
+
+# paragraphStyle.namedStyleType -> 标题级别
+HEADING_LEVELS = {
+    'TITLE': 0,
+    'SUBTITLE': 0,
+    'HEADING_1': 1,
+    'HEADING_2': 2,
+    'HEADING_3': 3,
+    'HEADING_4': 4,
+    'HEADING_5': 5,
+    'HEADING_6': 6,
+}
+
+TEXT_FORMATS = ('text', 'ndjson')
+
+
+def _element_text(element):
+    """
+    :param element: paragraph.elements中的一项
+    :return: 该项的文字
+    """
+    if 'textRun' in element:
+        return element['textRun'].get('content', '')
+    if 'person' in element:
+        return element['person'].get('personProperties', {}).get('name', '')
+    if 'richLink' in element:
+        return element['richLink'].get('richLinkProperties', {}).get('title', '')
+    return ''
+
+
+def _paragraph_block(element):
+    paragraph = element['paragraph']
+    text = ''.join(_element_text(item) for item in paragraph.get('elements') or []).rstrip('\n')
+    if not text.strip():
+        return None
+    block = {'type': 'paragraph', 'text': text, 'start_index': element.get('startIndex', 0)}
+    style = (paragraph.get('paragraphStyle') or {}).get('namedStyleType')
+    if style in HEADING_LEVELS:
+        block.update(type='heading', level=HEADING_LEVELS[style])
+    elif 'bullet' in paragraph:
+        block.update(type='list_item', level=paragraph['bullet'].get('nestingLevel', 0))
+    return block
+
+
+def _iter_table(element):
+    table_index = element.get('startIndex', 0)
+    for row_index, row in enumerate(element['table'].get('tableRows') or []):
+        for column_index, cell in enumerate(row.get('tableCells') or []):
+            # 单元格内的段落(包括嵌套表格)合并成一个单元格的文字
+            text = '\n'.join(block['text'] for block in iter_content_blocks(cell.get('content') or []))
+            yield {'type': 'table_cell', 'text': text, 'start_index': cell.get('startIndex', table_index),
+                   'table': table_index, 'row': row_index, 'column': column_index}
+
+
+def iter_content_blocks(content):
+    """
+    逐个遍历structural elements，生成文字块
+
+    :param content: 如document['body']['content']
+    :return: 文字块的生成器，见iter_doc_blocks
+    """
+    for element in content:
+        if 'paragraph' in element:
+            block = _paragraph_block(element)
+            if block is not None:
+                yield block
+        elif 'table' in element:
+            yield from _iter_table(element)
+        elif 'tableOfContents' in element:
+            yield from iter_content_blocks(element['tableOfContents'].get('content') or [])
+
+
+def iter_doc_blocks(document):
+    """
+    按文档顺序逐个生成google doc正文中的文字块，不在内存中拼接整篇文字
+
+    :param document: GoogleDocOperator.get_doc的结果
+    :return: 文字块的生成器，每块形如
+        {'type': 'heading', 'text': '第一部分', 'start_index': 1, 'level': 1}
+        {'type': 'paragraph', 'text': '...', 'start_index': 12}
+        {'type': 'list_item', 'text': '...', 'start_index': 40, 'level': 0}
+        {'type': 'table_cell', 'text': '...', 'start_index': 80, 'table': 79, 'row': 0, 'column': 1}
+    """
+    yield from iter_content_blocks((document.get('body') or {}).get('content') or [])
+
+
+def render_blocks(blocks, fmt='text', chunk_size=64 * 1024):
+    """
+    把文字块渲染成纯文字或ndjson，攒够chunk_size个字符输出一次，供StreamingHttpResponse分块发送
+
+    :param blocks: iter_doc_blocks的结果
+    :param fmt: 'text' 每块一行(块内换行保留); 'ndjson' 每块一行json
+    :param chunk_size: 每次输出的最少字符数
+    :return: str的生成器
+    """
+    if fmt not in TEXT_FORMATS:
+        raise ValueError(f'unknown text format {fmt}')
+    buffer = []
+    size = 0
+    for block in blocks:
+        line = (block['text'] if fmt == 'text' else json.dumps(block, ensure_ascii=False)) + '\n'
+        buffer.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield ''.join(buffer)
@@ -0,0 +1,215 @@
+import hashlib
+import threading
+
+from cachetools import TTLCache
+from django.core.cache import caches
+
+from maze_google_doc import settings
+
+
+class FolderCache(object):
+    """
+    (parent folder id, folder name) -> folder id 的缓存
+
+    共享层使用django cache（FOLDER_CACHE_ALIAS，配置为共享后端时所有gunicorn worker共用），
+    前面可选一层进程内的LRU+TTL缓存，减少对共享层的访问。
+    """
+
+    KEY_PREFIX = 'google_doc:folder:'
+    # folder id -> (parent folder id, folder name) 的反向索引，用于按folder id失效(如Drive changes中的改名、删除)
+    REVERSE_KEY_PREFIX = 'google_doc:folder_id:'
+
+    def __init__(self, alias=None, timeout=None, local_maxsize=None, local_ttl=None):
+        """
+        :param alias: 共享层使用的django cache别名
+        :param timeout: 共享层缓存时间(秒)
+        :param local_maxsize: 进程内缓存的最大条目数，为0时不使用进程内缓存
+        :param local_ttl: 进程内缓存时间(秒)
+        """
+        self.alias = settings.FOLDER_CACHE_ALIAS if alias is None else alias
+        self.timeout = settings.FOLDER_CACHE_TIMEOUT if timeout is None else timeout
+        local_maxsize = settings.FOLDER_CACHE_LOCAL_MAXSIZE if local_maxsize is None else local_maxsize
+        local_ttl = settings.FOLDER_CACHE_LOCAL_TTL if local_ttl is None else local_ttl
+        self._local = TTLCache(maxsize=local_maxsize, ttl=local_ttl) if local_maxsize and local_ttl else None
+        self._local_lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def make_key(self, parent_id, folder_name):
+        # folder名称可能包含空格或非ascii字符，memcached等后端的key有限制，统一做摘要
+        digest = hashlib.sha1(f'{parent_id}/{folder_name}'.encode('utf-8')).hexdigest()
+        return f'{self.KEY_PREFIX}{digest}'
+
+    def get(self, parent_id, folder_name):
+        """
+        :return: 缓存的folder id，未命中返回None
+        """
+        key = self.make_key(parent_id, folder_name)
+        if self._local is not None:
+            with self._local_lock:
+                folder_id = self._local.get(key)
+            if folder_id:
+                return folder_id
+        folder_id = self.shared.get(key)
+        if folder_id and self._local is not None:
+            with self._local_lock:
+                self._local[key] = folder_id
+        return folder_id
+
+    def set(self, parent_id, folder_name, folder_id):
+        key = self.make_key(parent_id, folder_name)
+        self.shared.set_many({key: folder_id, self.REVERSE_KEY_PREFIX + folder_id: (parent_id, folder_name)},
+                             self.timeout)
+        if self._local is not None:
+            with self._local_lock:
+                self._local[key] = folder_id
+
+    def set_many(self, entries):
+        """
+        批量写入缓存，共享层只访问一次，用于预热
+
+        :param entries: (parent folder id, folder name, folder id)的列表
+        """
+        data = {}
+        for parent_id, folder_name, folder_id in entries:
+            data[self.make_key(parent_id, folder_name)] = folder_id
+            data[self.REVERSE_KEY_PREFIX + folder_id] = (parent_id, folder_name)
+        if not data:
+            return
+        self.shared.set_many(data, self.timeout)
+        if self._local is not None:
+            with self._local_lock:
+                for parent_id, folder_name, folder_id in entries:
+                    self._local[self.make_key(parent_id, folder_name)] = folder_id
+
+    def find_folder(self, folder_id):
+        """
+        :param folder_id: folder id
+        :return: 缓存中该目录的(parent folder id, folder name)，不在缓存中时返回None
+        """
+        entry = self.shared.get(self.REVERSE_KEY_PREFIX + folder_id)
+        return tuple(entry) if entry else None
+
+    def evict_folder(self, folder_id):
+        """
+        删除以folder_id为值的缓存，用于目录在google drive上被改名、移动或删除的情况
+
+        :param folder_id: folder id
+        :return: 被删除的缓存key，没有时返回None
+        """
+        entry = self.find_folder(folder_id)
+        self.shared.delete(self.REVERSE_KEY_PREFIX + folder_id)
+        if entry is None:
+            return None
+        key = self.make_key(*entry)
+        # 同名目录的缓存可能已指向其他目录，只删除仍指向folder_id的
+        if self.shared.get(key) == folder_id:
+            self.shared.delete(key)
+        self.delete_local(key)
+        return key
+
+    def delete_local(self, key):
+        """
+        只删除本进程内的缓存，用于同步其他进程的失效通知
+
+        :param key: make_key生成的key
+        """
+        if self._local is not None:
+            with self._local_lock:
+                self._local.pop(key, None)
+
+    def delete(self, parent_id, folder_name):
+        key = self.make_key(parent_id, folder_name)
+        self.shared.delete(key)
+        self.delete_local(key)
+
+    def resolve_path(self, folder_list, parent_folder_id):
+        """
+        完全依靠缓存解析目录路径
+
+        :param folder_list: 目录名称列表，从左至右目录层次由高到底
+        :param parent_folder_id: 起始父目录
+        :return: 最底层目录的folder id，任一层未命中返回None
+        """
+        current_folder_id = parent_folder_id
+        for folder_name in folder_list:
+            current_folder_id = self.get(current_folder_id, folder_name)
+            if not current_folder_id:
+                return None
+        return current_folder_id
+
+    def invalidate_path(self, folder_list, parent_folder_id):
+        """
+        删除路径上各层目录的缓存，用于缓存的folder id已在google drive上不存在(404)的情况
+
+        :param folder_list: 目录名称列表，从左至右目录层次由高到底
+        :param parent_folder_id: 起始父目录
+        """
+        current_folder_id = parent_folder_id
+        for folder_name in folder_list:
+            next_folder_id = self.get(current_folder_id, folder_name)
+            self.delete(current_folder_id, folder_name)
+            if not next_folder_id:
+                return
+            current_folder_id = next_folder_id
+
+    def clear_local(self):
+        if self._local is not None:
+            with self._local_lock:
+                self._local.clear()
+
+
+class ParentFolderCache(object):
+    """
+    file id -> 父目录id列表 的进程内缓存(LRU+TTL)，用于make_copy等频繁查询同一模板文档父目录的场景
+
+    DRIVE_CHANGES_ENABLED时在共享层记录被缓存的file id，changes轮询进程只为这些文件发出失效通知
+    """
+
+    CACHED_KEY_PREFIX = 'google_doc:parent_cached:'
+
+    def __init__(self, maxsize=None, ttl=None, alias=None):
+        """
+        :param maxsize: 最大条目数
+        :param ttl: 缓存时间(秒)
+        :param alias: 记录被缓存的file id的django cache别名
+        """
+        maxsize = settings.PARENT_CACHE_MAXSIZE if maxsize is None else maxsize
+        self.ttl = settings.PARENT_CACHE_TTL if ttl is None else ttl
+        self.alias = settings.FOLDER_CACHE_ALIAS if alias is None else alias
+        self._cache = TTLCache(maxsize=maxsize, ttl=self.ttl)
+        self._lock = threading.Lock()
+
+    def get(self, file_id):
+        with self._lock:
+            return self._cache.get(file_id)
+
+    def set(self, file_id, parents):
+        with self._lock:
+            self._cache[file_id] = list(parents)
+        if settings.DRIVE_CHANGES_ENABLED:
+            caches[self.alias].set(self.CACHED_KEY_PREFIX + file_id, True, self.ttl)
+
+    def delete(self, file_id):
+        with self._lock:
+            self._cache.pop(file_id, None)
+
+    def filter_cached(self, file_ids):
+        """
+        :param file_ids: file id列表
+        :return: 其中ttl秒内被任一进程缓存过的file id集合
+        """
+        keys = {self.CACHED_KEY_PREFIX + file_id: file_id for file_id in file_ids}
+        if not keys:
+            return set()
+        return {keys[key] for key in caches[self.alias].get_many(list(keys))}
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+folder_cache = FolderCache()
+parent_cache = ParentFolderCache()
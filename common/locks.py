@@ -0,0 +1,95 @@
+import hashlib
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.db import IntegrityError, OperationalError, transaction
+from django.utils import timezone
+
+from common.logger import logger
+from maze_google_doc import settings
+
+
+class LockTimeout(Exception):
+    """ 在指定时间内未能取得锁 """
+
+
+def _lock_owner():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}:{uuid.uuid4().hex[:8]}'
+
+
+def _renew_lease(lock_key, owner, lease, stop):
+    """
+    持有锁期间每lease/3秒延长一次有效期，直到stop被设置
+    """
+    from django.db import connection
+
+    from apps.google_doc.models import DbLock
+
+    try:
+        while not stop.wait(lease / 3):
+            try:
+                DbLock.objects.filter(lock_key=lock_key, owner=owner).update(
+                    expires_at=timezone.now() + timedelta(seconds=lease))
+            except OperationalError as e:
+                logger.warning(f'failed to renew db lock {lock_key}: {e}')
+    finally:
+        connection.close()
+
+
+@contextmanager
+def db_lock(name, timeout=None, lease=None, poll_interval=0.05, renew=False):
+    """
+    基于数据库唯一约束的跨进程锁：插入成功即取得锁，退出时删除该行；
+    持有者崩溃时锁在lease秒后过期，可被其他进程清理后重新获取
+
+    :param name: 锁名称
+    :param timeout: 等待锁的最长时间(秒)，超时抛出LockTimeout
+    :param lease: 锁的有效期(秒)
+    :param poll_interval: 等待时的轮询间隔(秒)
+    :param renew: 持有期间在后台线程中定期延长有效期，用于持有时间可能超过lease的操作(如调用google api)
+    """
+    from apps.google_doc.models import DbLock
+
+    timeout = settings.DB_LOCK_TIMEOUT if timeout is None else timeout
+    lease = settings.DB_LOCK_LEASE if lease is None else lease
+    lock_key = hashlib.sha1(name.encode('utf-8')).hexdigest()
+    owner = _lock_owner()
+    deadline = time.monotonic() + timeout
+    while True:
+        now = timezone.now()
+        try:
+            # 清理持有者已崩溃的过期锁
+            DbLock.objects.filter(lock_key=lock_key, expires_at__lt=now).delete()
+            with transaction.atomic():
+                DbLock.objects.create(lock_key=lock_key, name=name[:255], owner=owner,
+                                      expires_at=now + timedelta(seconds=lease))
+            break
+        except (IntegrityError, OperationalError) as e:
+            # IntegrityError: 锁被其他进程持有；OperationalError: sqlite等数据库写锁繁忙
+            if time.monotonic() >= deadline:
+                raise LockTimeout(f'failed to acquire db lock {name} in {timeout}s: {e}')
+            time.sleep(poll_interval)
+    stop = threading.Event()
+    if renew:
+        threading.Thread(target=_renew_lease, args=(lock_key, owner, lease, stop), name='db-lock-renew',
+                         daemon=True).start()
+    try:
+        yield
+    finally:
+        stop.set()
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                DbLock.objects.filter(lock_key=lock_key, owner=owner).delete()
+                break
+            except OperationalError as e:
+                # 数据库写锁繁忙时重试，尽量不让其他进程等到锁过期
+                if time.monotonic() >= deadline:
+                    logger.exception(f'failed to release db lock {name}, it will expire in {lease}s: {e}')
+                    break
+                time.sleep(poll_interval)
@@ -0,0 +1,231 @@
+import atexit
+import collections
+import datetime
+import json
+import logging
+import logging.config
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+from common.logger import truncate
+from maze_google_doc import settings
+
+DROP_NEW = 'drop_new'
+DROP_OLDEST = 'drop_oldest'
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    每条日志输出为一行json，便于日志系统解析
+    """
+
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(
+                timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'file': record.filename,
+            'line': record.lineno,
+            'thread': record.threadName,
+            'process': record.process,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    把日志放入有界队列，由LogQueue的后台线程写到targets中的handler，调用方不等待文件io和rotation的锁
+
+    队列满时按drop_policy丢弃：'drop_new' 丢弃本条；'drop_oldest' 丢弃队列中最早的一条。
+    keep_level及以上的日志先等待block_timeout秒，仍然满时才丢弃；丢弃数按级别计数，有空位时补写一条警告
+    """
+
+    def __init__(self, log_queue, targets):
+        """
+        :param log_queue: LogQueue
+        :param targets: 原logger的handler列表
+        """
+        super().__init__(log_queue.queue)
+        self.log_queue = log_queue
+        self.targets = targets
+
+    def prepare(self, record):
+        # 在调用方线程中格式化消息(参数可能在之后被修改)，异常栈也转为文本，record中不再引用traceback
+        record = logging.makeLogRecord(record.__dict__)
+        message = truncate(record.getMessage(), settings.LOG_MESSAGE_MAX_LENGTH)
+        if record.exc_info:
+            message = f'{message}\n{logging.Formatter().formatException(record.exc_info)}'
+        elif record.exc_text:
+            message = f'{message}\n{record.exc_text}'
+        if record.stack_info:
+            message = f'{message}\n{record.stack_info}'
+        record.msg, record.args = message, None
+        record.exc_info = record.exc_text = record.stack_info = None
+        return self.targets, record
+
+    def enqueue(self, item):
+        self.log_queue.put(item, item[1].levelno)
+
+    def emit(self, record):
+        try:
+            self.log_queue.ensure_started()
+            self.enqueue(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+class _Listener(QueueListener):
+
+    def handle(self, item):
+        targets, record = item
+        for handler in targets:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def enqueue_sentinel(self):
+        # 队列有界，等待写线程腾出位置
+        self.queue.put(self._sentinel)
+
+
+class LogQueue(object):
+    """
+    进程内所有logger共用的有界日志队列和后台写线程
+    """
+
+    def __init__(self, maxsize=None, drop_policy=None, keep_level=None, block_timeout=None):
+        """
+        :param maxsize: 队列长度
+        :param drop_policy: 'drop_new' / 'drop_oldest'
+        :param keep_level: 该级别及以上的日志在队列满时先等待，不立即丢弃
+        :param block_timeout: 等待的最长时间(秒)
+        """
+        self.queue = queue.Queue(settings.LOG_QUEUE_MAXSIZE if maxsize is None else maxsize)
+        self.drop_policy = settings.LOG_QUEUE_DROP_POLICY if drop_policy is None else drop_policy
+        keep_level = settings.LOG_QUEUE_KEEP_LEVEL if keep_level is None else keep_level
+        self.keep_level = keep_level if isinstance(keep_level, int) else logging.getLevelName(keep_level)
+        self.block_timeout = settings.LOG_QUEUE_BLOCK_TIMEOUT if block_timeout is None else block_timeout
+        self.dropped = collections.Counter()
+        self._unreported = collections.Counter()
+        self._lock = threading.Lock()
+        self._listener = None
+        # gunicorn --preload fork出的worker中没有父进程的写线程，队列和锁也可能正被父进程的写线程持有，重新创建
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self.queue = queue.Queue(self.queue.maxsize)
+        self._unreported = collections.Counter()
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def _put(self, item, levelno):
+        """
+        :return: 放入队列时返回True，被丢弃时返回False
+        """
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+        if levelno >= self.keep_level:
+            try:
+                self.queue.put(item, timeout=self.block_timeout)
+                return True
+            except queue.Full:
+                pass
+        if self.drop_policy == DROP_OLDEST:
+            try:
+                oldest = self.queue.get_nowait()
+                if oldest is None:
+                    # 写线程停止的标记，放回队列
+                    self.queue.put_nowait(oldest)
+                else:
+                    self._count_drop(oldest[1].levelno)
+                    self.queue.put_nowait(item)
+                    return True
+            except (queue.Empty, queue.Full):
+                pass
+        self._count_drop(levelno)
+        return False
+
+    def _count_drop(self, levelno):
+        with self._lock:
+            self.dropped[logging.getLevelName(levelno)] += 1
+            self._unreported[logging.getLevelName(levelno)] += 1
+
+    def put(self, item, levelno):
+        if self._put(item, levelno) and self._unreported:
+            with self._lock:
+                unreported, self._unreported = self._unreported, collections.Counter()
+            if unreported:
+                record = logging.makeLogRecord({
+                    'name': 'info', 'levelno': logging.WARNING, 'levelname': 'WARNING', 'pathname': __file__,
+                    'filename': os.path.basename(__file__), 'msg': f'log queue full, dropped {dict(unreported)}'})
+                try:
+                    self.queue.put_nowait((item[0], record))
+                except queue.Full:
+                    with self._lock:
+                        self._unreported.update(unreported)
+
+    def ensure_started(self):
+        """
+        第一次写日志时启动写线程
+        """
+        if self._listener is not None:
+            return
+        with self._lock:
+            if self._listener is None:
+                listener = _Listener(self.queue)
+                listener.start()
+                self._listener = listener
+
+    def stop(self):
+        """
+        写完队列中的日志后停止写线程
+        """
+        with self._lock:
+            listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.stop()
+
+    def stats(self):
+        """
+        :return: 队列中的日志数和各级别的丢弃数
+        """
+        with self._lock:
+            return {'queued': self.queue.qsize(), 'dropped': dict(self.dropped)}
+
+
+log_queue = None
+
+
+def configure_logging(config):
+    """
+    settings.LOGGING_CONFIG：按LOGGING配置handler后，LOG_QUEUE_ENABLED时把各logger的handler换成DroppingQueueHandler，
+    LOG_JSON时文件日志使用json格式
+
+    :param config: settings.LOGGING
+    """
+    global log_queue
+    if settings.LOG_JSON:
+        config = dict(config, formatters=dict(config.get('formatters') or {}, json={'()': JsonFormatter}),
+                      handlers={name: dict(handler, formatter='json') if 'filename' in handler else handler
+                                for name, handler in (config.get('handlers') or {}).items()})
+    logging.config.dictConfig(config)
+    if not settings.LOG_QUEUE_ENABLED:
+        return
+    if log_queue is None:
+        log_queue = LogQueue()
+        atexit.register(log_queue.stop)
+    for name in config.get('loggers') or {}:
+        logger = logging.getLogger(name)
+        targets = [handler for handler in logger.handlers if not isinstance(handler, DroppingQueueHandler)]
+        if targets:
+            logger.handlers = [DroppingQueueHandler(log_queue, targets)]
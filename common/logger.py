@@ -1,7 +1,34 @@
 import logging
 
+from maze_google_doc import settings
+
 logger = logging.getLogger("info")
 
 
+def truncate(text, limit):
+    """
+    :return: 超过limit个字符时截断并注明原长度
+    """
+    if limit and len(text) > limit:
+        return f'{text[:limit]}...(truncated, {len(text)} chars)'
+    return text
+
+
+class payload(object):
+    """
+    记录请求参数、google响应等大小不定的内容，超过LOG_PAYLOAD_MAX_LENGTH的部分截断，如 logger.info(payload(in_data))
+    """
+
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = settings.LOG_PAYLOAD_MAX_LENGTH if limit is None else limit
+
+    def __str__(self):
+        return truncate(str(self.value), self.limit)
+
+    def __format__(self, format_spec):
+        return format(str(self), format_spec)
+
+
 if __name__ == '__main__':
     logger.info('aaaa')
@@ -0,0 +1,264 @@
+import asyncio
+import bisect
+import threading
+import time
+
+from maze_google_doc import settings
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """
+    按标签累计的计数器
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name, tuple(zip(self.labelnames, key)), value
+
+
+class Gauge(Counter):
+    """
+    按标签记录当前值，如队列长度
+    """
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(object):
+    """
+    按标签统计的直方图，buckets为各桶的上界(秒)
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(settings.METRICS_LATENCY_BUCKETS if buckets is None else buckets))
+        # {标签值: [各桶计数..., sum, count]}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def get(self, **labels):
+        """
+        :return: (count, sum)
+        """
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            values = self._values.get(key)
+            return (values[-1], values[-2]) if values else (0, 0.0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(value)) for key, value in self._values.items())
+        for key, value in values:
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, value):
+                cumulative += count
+                yield f'{self.name}_bucket', labels + (('le', _format_value(float(bound))),), cumulative
+            yield f'{self.name}_bucket', labels + (('le', '+Inf'),), value[-1]
+            yield f'{self.name}_sum', labels, value[-2]
+            yield f'{self.name}_count', labels, value[-1]
+
+
+class MetricsRegistry(object):
+    """
+    进程内的指标，render()输出prometheus text格式；gunicorn等多进程部署时每个worker进程各自统计
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation, labelnames=()):
+        metric = Gauge(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=None):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+google_api_requests = registry.counter(
+    'google_api_requests_total', 'Google API http requests (each attempt) by API method and status.',
+    ('method', 'status'))
+google_api_duration = registry.histogram(
+    'google_api_request_duration_seconds', 'Network time of Google API http requests by API method.', ('method',))
+google_api_retries = registry.counter(
+    'google_api_retries_total', 'Google API requests retried after rate limit or server errors.', ('method',))
+google_api_limiter_wait = registry.counter(
+    'google_api_limiter_wait_seconds_total', 'Time spent waiting in the Google API token buckets.', ('method',))
+http_request_duration = registry.histogram(
+    'http_request_duration_seconds', 'Latency of requests served by this process by view, method and status.',
+    ('view', 'method', 'status'))
+
+delete_queue_length = registry.gauge(
+    'google_doc_delete_queue_length', 'Temporary Drive files waiting in the deferred delete queue of this process.')
+deleted_files = registry.counter(
+    'google_doc_deleted_files_total', 'Temporary Drive files removed by the delete queue or the orphan sweeper.',
+    ('source', 'status'))
+
+
+def view_name(request):
+    """
+    :return: 处理请求的view名称，未匹配到url时为unmatched
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    view_class = getattr(match.func, 'view_class', None)
+    return view_class.__name__ if view_class is not None else match.func.__name__
+
+
+class ClosingIterator(object):
+    """
+    streaming响应内容的迭代器，迭代结束或被关闭(django在响应发送完或连接断开后调用response.close)时调用一次on_close
+    """
+
+    def __init__(self, content, on_close):
+        self._iterator = iter(content)
+        self._on_close = on_close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close()
+
+
+class MetricsMiddleware(object):
+    """
+    统计每个请求的耗时，并在响应头Server-Timing中给出本次请求中google api调用的耗时分解
+
+    streaming响应(导出、NDJSON等)的主要耗时在生成内容时，耗时在内容发送完时记录；此时响应头已经发出，不带Server-Timing
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # 与django的MiddlewareMixin相同：ASGI下作为协程中间件，async view等待google api时不占用线程
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        from common.api_executor import reset_call_timings
+
+        if self.is_async:
+            return self.__acall__(request)
+        timings = reset_call_timings()
+        start = time.monotonic()
+        return self.record(request, self.get_response(request), timings, start)
+
+    async def __acall__(self, request):
+        from common.api_executor import reset_call_timings
+
+        timings = reset_call_timings()
+        start = time.monotonic()
+        return self.record(request, await self.get_response(request), timings, start)
+
+    @classmethod
+    def record(cls, request, response, timings, start):
+        if response.streaming:
+            response.streaming_content = ClosingIterator(response.streaming_content,
+                                                         lambda: cls.observe(request, response, start))
+            return response
+        duration = cls.observe(request, response, start)
+        if settings.METRICS_SERVER_TIMING_ENABLED:
+            response['Server-Timing'] = timings.server_timing(duration)
+        return response
+
+    @staticmethod
+    def observe(request, response, start):
+        """
+        :return: 请求耗时(秒)
+        """
+        duration = time.monotonic() - start
+        if settings.METRICS_ENABLED:
+            http_request_duration.observe(duration, view=view_name(request), method=request.method,
+                                          status=response.status_code)
+        return duration
@@ -0,0 +1,172 @@
+import contextvars
+import itertools
+import os
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+
+from django.db import connection
+from google.auth.transport.requests import Request
+
+from common.credentials import SharedTokenCredentials, TokenRefresher
+from common.logger import logger
+from common.transport import reset_shared_adapter
+from common.utils import GoogleAuthType, GoogleDocOperator, load_credentials
+from maze_google_doc import settings
+
+
+# 每个请求使用google api前调用的函数，由应用注册(如在AppConfig.ready中注册同步缓存失效通知)
+_prepare_hooks = []
+
+
+def add_prepare_hook(fn):
+    """
+    注册GoogleDocOperatorPool.prepare时调用的函数，重复注册只保留一个
+
+    :param fn: 无参数的函数
+    """
+    if fn not in _prepare_hooks:
+        _prepare_hooks.append(fn)
+
+
+class GoogleDocOperatorPool(object):
+    """
+    进程内可复用的GoogleDocOperator池
+
+    池内所有operator共用同一份凭证（token只在过期时刷新一次），service由静态discovery文档构建；
+    每个请求checkout一个operator，用完后checkin归还。googleapiclient的service依赖的httplib2不是线程安全的，
+    所以同一时刻一个operator只会被一个线程使用。
+    """
+
+    def __init__(self, auth_type=GoogleAuthType.SERVICE_ACCOUNT_KEY, max_idle=None, credentials=None):
+        """
+        :param auth_type: 认证方式
+        :param max_idle: 池中最多保留的空闲operator数量，超出部分归还时直接丢弃
+        :param credentials: 指定池使用的凭证，为空时按auth_type加载
+        """
+        self.auth_type = auth_type
+        self.initial_credentials = credentials
+        self.max_idle = settings.GOOGLE_OPERATOR_POOL_SIZE if max_idle is None else max_idle
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._credentials = self.initial_credentials
+        self._idle = queue.LifoQueue()
+        # 线程不会被fork到子进程，子进程重新启动
+        self._refresher = None
+
+    def _check_fork(self):
+        # gunicorn preload等场景下池可能在fork前创建，子进程不能复用父进程的连接
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    logger.info(f'operator pool created in process {self._pid}, resetting for {os.getpid()}')
+                    reset_shared_adapter()
+                    self._reset()
+
+    def get_credentials(self):
+        """
+        返回池共享的凭证，必要时加锁刷新，保证同一进程内同时只有一个线程在做token交换
+
+        :return: google auth credentials
+        """
+        with self._lock:
+            if self._credentials is None:
+                self._credentials = load_credentials(self.auth_type)
+            if isinstance(self._credentials, SharedTokenCredentials) and self._refresher is None \
+                    and settings.GOOGLE_TOKEN_REFRESHER_ENABLED:
+                # 在共享token过期前主动刷新，请求路径上不需要等待token交换
+                self._refresher = TokenRefresher(self._credentials).start()
+            if not self._credentials.valid:
+                self._credentials.refresh(Request())
+            return self._credentials
+
+    def prepare(self):
+        """
+        每个请求使用google api前调用：检查fork，执行注册的prepare hook
+
+        :return: 池共享的凭证
+        """
+        self._check_fork()
+        for hook in _prepare_hooks:
+            hook()
+        return self.get_credentials()
+
+    def acquire(self):
+        """
+        取出一个空闲operator，没有时新建
+
+        :return: GoogleDocOperator
+        """
+        credentials = self.prepare()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return GoogleDocOperator(self.auth_type, credentials=credentials)
+
+    def release(self, operator):
+        """
+        归还operator
+
+        :param operator: 由acquire取得的operator
+        """
+        if self._pid != os.getpid() or self._idle.qsize() >= self.max_idle:
+            return
+        self._idle.put(operator)
+
+    @contextmanager
+    def checkout(self):
+        """
+        with operator_pool.checkout() as operator: ...
+        """
+        operator = self.acquire()
+        try:
+            yield operator
+        finally:
+            self.release(operator)
+
+    def imap_unordered(self, fn, tasks, max_workers, max_pending=None):
+        """
+        用有限的线程并发执行fn(operator, task)，每个线程各自checkout一个operator，按完成顺序返回结果
+
+        :param fn: fn(operator, task)
+        :param tasks: 任务列表
+        :param max_workers: 最大并发线程数
+        :param max_pending: 已提交但结果尚未被取走的最大任务数，默认一次提交全部任务；
+            结果占用内存较多(如下载的文件)时用于限制调用方消费较慢时积压的结果
+        :return: 结果的迭代器，fn抛出的异常会在迭代到该任务时重新抛出
+        """
+        def run(task):
+            try:
+                with self.checkout() as operator:
+                    return fn(operator, task)
+            finally:
+                # 线程池中的线程会使用各自的数据库连接(如数据库缓存)，用完及时关闭
+                connection.close()
+
+        tasks = iter(tasks)
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='google-op') as executor:
+            def submit(count):
+                # 在调用方的context中执行，google api耗时计入调用方请求的CallTimings
+                return {executor.submit(contextvars.copy_context().run, run, task)
+                        for task in itertools.islice(tasks, count)}
+
+            if max_pending is None:
+                for future in as_completed(submit(None)):
+                    yield future.result()
+                return
+            pending = submit(max_pending)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+                    pending |= submit(1)
+
+    def idle_count(self):
+        return self._idle.qsize()
+
+
+operator_pool = GoogleDocOperatorPool()
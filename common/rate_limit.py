@@ -0,0 +1,138 @@
+import threading
+import time
+
+from django.db import IntegrityError, OperationalError
+from django.db.models import F
+
+from common.logger import logger
+from maze_google_doc import settings
+
+
+class RateLimitedError(Exception):
+    """ google api请求被限流：令牌桶中需要等待太久，或重试后google仍返回限流错误 """
+
+    def __init__(self, msg='', retry_after=None):
+        """
+        :param msg: 错误信息
+        :param retry_after: 建议客户端等待多少秒后再重试
+        """
+        Exception.__init__(self, msg)
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    """
+    所有worker进程共享的令牌桶，状态保存在RateLimitBucket表中
+
+    取令牌时按 上次令牌数 + 经过时间 * rate 补充(不超过capacity)后扣除，令牌不足时允许扣成负数并返回需要等待的时间，
+    调用方sleep后再发请求(预约式)，所以每次取令牌只需要一次读和一次按版本号的条件更新，不需要跨进程的锁。
+    每个进程一次预取local_reserve个令牌，进程内的线程先用预取的令牌，减少对数据库的访问；
+    预取时不持有进程内的锁，同时需要令牌的其他线程等待这一次预取的结果，不各自访问数据库。
+    """
+
+    # 预取的令牌在该时间(秒)内未用完即作废，避免空闲进程囤积令牌
+    LOCAL_RESERVE_TTL = 1.0
+    # 条件更新冲突(其他进程同时取令牌)或数据库繁忙时的最大尝试次数
+    MAX_UPDATE_ATTEMPTS = 20
+
+    def __init__(self, name, rate, capacity, local_reserve=None):
+        """
+        :param name: 令牌桶名称
+        :param rate: 每秒补充的令牌数
+        :param capacity: 桶容量，即允许的突发请求数
+        :param local_reserve: 每个进程一次预取的令牌数
+        """
+        self.name = name
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        local_reserve = settings.GOOGLE_RATE_LIMIT_LOCAL_RESERVE if local_reserve is None else local_reserve
+        self.local_reserve = max(1, min(int(local_reserve), int(capacity)))
+        self._lock = threading.Condition()
+        # 是否有线程正在从共享令牌桶预取
+        self._refilling = False
+        self._local_tokens = 0
+        # 预取的令牌可以使用的时间和作废的时间(time.time())
+        self._local_available_at = 0.0
+        self._local_expires_at = 0.0
+
+    def acquire(self, tokens=1, max_wait=None):
+        """
+        取出tokens个令牌，需要等待时sleep到令牌可用
+
+        :param tokens: 令牌数，batch请求按其中的子请求数计算
+        :param max_wait: 最长等待时间(秒)，需要等待更久时不扣令牌，抛出RateLimitedError
+        :return: 在令牌桶中等待的时间(秒)
+        """
+        wait = self.reserve(tokens, max_wait)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def reserve(self, tokens=1, max_wait=None):
+        """
+        预约tokens个令牌但不等待
+
+        :return: 令牌可用前需要等待的时间(秒)
+        """
+        with self._lock:
+            while True:
+                now = time.time()
+                if self._local_tokens >= tokens and now < self._local_expires_at:
+                    self._local_tokens -= tokens
+                    return max(0.0, self._local_available_at - now)
+                if not self._refilling:
+                    break
+                self._lock.wait()
+            self._refilling = True
+        # 访问数据库(可能因冲突重试)时不持有锁，其他线程仍可使用预取的令牌
+        try:
+            count, wait = self._take_shared(tokens, max(tokens, self.local_reserve), max_wait)
+        except BaseException:
+            with self._lock:
+                self._refilling = False
+                self._lock.notify_all()
+            raise
+        with self._lock:
+            now = time.time()
+            self._local_tokens = count - tokens
+            self._local_available_at = now + wait
+            self._local_expires_at = now + wait + self.LOCAL_RESERVE_TTL
+            self._refilling = False
+            self._lock.notify_all()
+        return wait
+
+    def _take_shared(self, tokens, prefetch, max_wait):
+        """
+        从共享令牌桶取令牌：桶内令牌足够时取prefetch个，否则只取需要的tokens个
+
+        :return: (取到的令牌数, 需要等待的时间)
+        """
+        from apps.google_doc.models import RateLimitBucket
+
+        for _ in range(self.MAX_UPDATE_ATTEMPTS):
+            try:
+                bucket, _ = RateLimitBucket.objects.get_or_create(
+                    name=self.name, defaults={'tokens': self.capacity, 'refreshed_at': time.time()})
+                now = time.time()
+                available = min(self.capacity, bucket.tokens + max(0.0, now - bucket.refreshed_at) * self.rate)
+                count = prefetch if available >= prefetch else tokens
+                wait = max(0.0, (count - available) / self.rate)
+                if max_wait is not None and wait > max_wait:
+                    raise RateLimitedError(f'rate limit {self.name} needs {wait:.1f}s for {count} tokens',
+                                           retry_after=wait)
+                updated = RateLimitBucket.objects.filter(id=bucket.id, version=bucket.version).update(
+                    tokens=available - count, refreshed_at=now, version=F('version') + 1)
+                if updated:
+                    return count, wait
+            except (IntegrityError, OperationalError) as e:
+                # IntegrityError: 其他进程同时创建了该行；OperationalError: sqlite等数据库写锁繁忙
+                logger.debug(f'rate limit {self.name} update conflict: {e}')
+            time.sleep(0.005)
+        # 竞争过于激烈时不阻塞业务请求，google返回的限流错误仍会由重试逻辑处理
+        logger.warning(f'rate limit {self.name}: failed to update shared bucket, letting request through')
+        return tokens, 0.0
+
+    def reset_local(self):
+        with self._lock:
+            self._local_tokens = 0
+            self._local_available_at = self._local_expires_at = 0.0
@@ -0,0 +1,99 @@
+import threading
+
+import google_auth_httplib2
+import httplib2
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+
+from maze_google_doc import settings
+
+
+class RequestsHttp(object):
+    """
+    httplib2.Http兼容的transport，供googleapiclient使用，底层为google.auth的AuthorizedSession(requests)
+
+    同一进程内的所有实例共用一个带keep-alive连接池的HTTPAdapter，不同operator之间也能复用到googleapis.com的连接，
+    不需要每个请求重新做TCP/TLS握手；urllib3的连接池是线程安全的，每个session只属于一个operator
+    """
+
+    def __init__(self, credentials, adapter=None, timeout=None, ca_certs=None):
+        """
+        :param credentials: google auth credentials，token过期或401时由AuthorizedSession刷新
+        :param adapter: requests HTTPAdapter，默认使用进程共享的连接池
+        :param timeout: 请求超时时间(秒)
+        :param ca_certs: 校验服务端证书的CA文件，为空时使用默认CA
+        """
+        self.credentials = credentials
+        self.timeout = settings.GOOGLE_HTTP_TIMEOUT if timeout is None else timeout
+        self.session = AuthorizedSession(credentials)
+        adapter = adapter if adapter is not None else get_shared_adapter()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        ca_certs = settings.GOOGLE_HTTP_CA_CERTS if ca_certs is None else ca_certs
+        # 每次请求显式传入，避免被REQUESTS_CA_BUNDLE等环境变量覆盖
+        self.verify = ca_certs or True
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None,
+                **kwargs):
+        """
+        与httplib2.Http.request相同的调用方式和返回值
+
+        :return: (httplib2.Response, bytes)
+        """
+        resp = self.session.request(method, uri, data=body, headers=headers, timeout=self.timeout,
+                                    verify=self.verify, allow_redirects=redirections > 0)
+        info = {key.lower(): value for key, value in resp.headers.items()}
+        if info.pop('content-encoding', None):
+            # requests已经解压过响应内容，与httplib2保持一致，长度按解压后的内容计算
+            info['content-length'] = str(len(resp.content))
+        info['status'] = str(resp.status_code)
+        response = httplib2.Response(info)
+        response.reason = resp.reason
+        return response, resp.content
+
+    def close(self):
+        self.session.close()
+
+
+_shared_adapter = None
+_shared_adapter_lock = threading.Lock()
+
+
+def get_shared_adapter():
+    """
+    返回本进程共享的HTTPAdapter，连接池大小为settings.GOOGLE_HTTP_POOL_MAXSIZE
+    """
+    global _shared_adapter
+    with _shared_adapter_lock:
+        if _shared_adapter is None:
+            _shared_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=settings.GOOGLE_HTTP_POOL_MAXSIZE,
+                                          pool_block=False)
+        return _shared_adapter
+
+
+def reset_shared_adapter():
+    """
+    丢弃共享连接池，fork出的子进程不能复用父进程的连接
+    """
+    global _shared_adapter
+    with _shared_adapter_lock:
+        if _shared_adapter is not None:
+            _shared_adapter.close()
+        _shared_adapter = None
+
+
+def build_http(credentials, transport=None):
+    """
+    按settings.GOOGLE_HTTP_TRANSPORT创建googleapiclient使用的http对象
+
+    :param credentials: google auth credentials
+    :param transport: 'requests' 进程共享连接池的RequestsHttp; 'httplib2' 每个实例独立连接的AuthorizedHttp
+    :return: httplib2.Http兼容的对象
+    """
+    transport = settings.GOOGLE_HTTP_TRANSPORT if transport is None else transport
+    if transport == 'requests':
+        return RequestsHttp(credentials)
+    if transport == 'httplib2':
+        http = httplib2.Http(timeout=settings.GOOGLE_HTTP_TIMEOUT, ca_certs=settings.GOOGLE_HTTP_CA_CERTS)
+        return google_auth_httplib2.AuthorizedHttp(credentials, http=http)
+    raise ValueError(f'unknown google http transport {transport}')
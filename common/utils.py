@@ -1,18 +1,33 @@
 from __future__ import print_function
 from datetime import datetime
 
+import io
+import json
 import os.path
+from contextlib import nullcontext
 from enum import Enum
+from functools import lru_cache
 
 from google.auth.transport.requests import Request
 from google.oauth2 import service_account
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.errors import HttpError
-
-
-from common.logger import logger
+from googleapiclient.http import MediaIoBaseDownload
+
+
+from common.api_executor import get_default_executor
+from common.credentials import wrap_shared_token
+from common.delete_queue import delete_queue as default_delete_queue
+from common.doc_cache import doc_cache as default_doc_cache
+from common.doc_text import iter_doc_blocks
+from common.folder_cache import folder_cache as default_folder_cache, parent_cache as default_parent_cache
+from common.locks import db_lock
+from common.logger import logger, payload
+from common.single_flight import SingleFlight
+from common.transport import build_http
 from maze_google_doc import settings
 
 
@@ -217,50 +232,67 @@ class ResponseCode(Enum):
     SUCCESS = 200
     # 已分析出原因的错误
     REGULAR_ERROR = 400
+    # google api限流，客户端应按Retry-After等待后重试
+    RATE_LIMITED = 429
+    # 同一Idempotency-Key的请求仍在处理中，客户端应按Retry-After等待后重试
+    IN_PROGRESS = 409
     # 未知错误
     UNKNOWN_ERROR = 500
 
 
+class DocCreateMode(Enum):
+    # 一次drive files().create直接在目标目录下创建文档
+    DRIVE_CREATE = 'drive'
+    # docs api创建 -> drive copy到目标目录 -> 删除原文档
+    DOCS_COPY = 'copy'
+
+
+DOCUMENT_MIME_TYPE = 'application/vnd.google-apps.document'
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+# 旧创建方式的临时文档带有的appProperties标记，sweep_orphan_docs只清理带此标记的文档
+TEMP_DOC_APP_PROPERTY = ('mazeGoogleDocTemp', 'true')
+# 导出格式(同时作为文件扩展名) -> drive files.export的mimeType
+EXPORT_FORMATS = {
+    'pdf': 'application/pdf',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'txt': 'text/plain',
+}
+
+# 进程内所有operator共用，合并对同一目录的并发查找/创建
+folder_single_flight = SingleFlight()
+
+
 class GoogleDocOperator(object):
     SCOPES = ['https://www.googleapis.com/auth/documents', 'https://www.googleapis.com/auth/drive',
               'https://www.googleapis.com/auth/drive.file']
 
-    def __init__(self, auth_type=GoogleAuthType.SERVICE_ACCOUNT_KEY):
+    def __init__(self, auth_type=GoogleAuthType.SERVICE_ACCOUNT_KEY, credentials=None, folder_cache=None):
+        """
+        :param auth_type: 认证方式，credentials为空时据此加载凭证
+        :param credentials: 已有的凭证，传入时直接复用（如operator池共享的service account凭证）
+        :param folder_cache: 目录id缓存，默认使用进程共享的common.folder_cache.folder_cache
+        """
         self.doc_service = None
         self.drive_service = None
-        creds = None
-        if auth_type == GoogleAuthType.DESKTOP_OAUTH2:
-            # 桌面的OAUTH2认证,
-            # The file token.json stores the user's access and refresh tokens, and is
-            # created automatically when the authorization flow completes for the first
-            # time.
-            if os.path.exists(settings.GOOGLE_PROJECT_TOKEN_FILE):
-                creds = Credentials.from_authorized_user_file(settings.GOOGLE_PROJECT_TOKEN_FILE, self.SCOPES)
-            # If there are no (valid) credentials available, let the user log in.
-            if not creds or not creds.valid:
-                if creds and creds.expired and creds.refresh_token:
-                    creds.refresh(Request())
-                else:
-                    flow = InstalledAppFlow.from_client_secrets_file(
-                        settings.GOOGLE_PROJECT_CREDENTIALS_FILE, self.SCOPES)
-                    creds = flow.run_local_server(port=0)
-                # Save the credentials for the next run
-                with open(settings.GOOGLE_PROJECT_TOKEN_FILE, 'w') as token:
-                    token.write(creds.to_json())
-        elif auth_type == GoogleAuthType.SERVICE_ACCOUNT_KEY:
-            # web server的 service account认证
-            # 获取访问凭证
-            creds = service_account.Credentials.from_service_account_file(
-                settings.GOOGLE_SERVICE_ACCOUNT_CREDENTIALS_FILE, scopes=self.SCOPES)
+        self.folder_cache = folder_cache if folder_cache is not None else default_folder_cache
+        self.parent_cache = default_parent_cache
+        self.doc_cache = default_doc_cache
+        self.single_flight = folder_single_flight
+        self.delete_queue = default_delete_queue
+        # 所有google api请求经由进程共享的executor发出：共享令牌桶限流，限流和5xx错误退避重试
+        self.executor = get_default_executor()
+        creds = credentials if credentials is not None else load_credentials(auth_type)
+        # docs和drive两个service共用同一个http对象
+        self.http = build_http(creds)
 
         try:
-            self.doc_service = build('docs', 'v1', credentials=creds)
+            self.doc_service = build_service('docs', 'v1', self.http)
         except HttpError as err:
             logger.exception(f'build google doc api service failed, {err}')
             raise err
 
         try:
-            self.drive_service = build('drive', 'v3', credentials=creds)
+            self.drive_service = build_service('drive', 'v3', self.http)
         except HttpError as err:
             logger.exception(f'build google drive api service failed, {err}')
             raise err
@@ -274,67 +306,330 @@ class GoogleDocOperator(object):
         """
         if not self.drive_service:
             raise ValueError('no available drive service')
-        file = self.drive_service.files().get(fileId=doc_id, fields='webViewLink').execute()
+        file = self._execute(self.drive_service.files().get(fileId=doc_id, fields='webViewLink'))
         return file.get('webViewLink')
 
-    def create_doc(self, title, username, direct_folder):
+    def _call_in_folder(self, folder_list, fn):
+        """
+        查找或创建folder_list对应的目录并以其folder id调用fn；
+        若目录已在google drive上被删除(404)，清除该路径的缓存后重新查找或创建目录再试一次
+
+        :param folder_list: 目录名称列表，从左至右目录层次由高到底
+        :param fn: fn(folder_id)
+        :return: fn的返回值
+        """
+        folder_id = self.get_or_create_folder(folder_list)
+        if not folder_id:
+            raise ValueError(f'failed to create folder {folder_list}')
+        try:
+            return fn(folder_id)
+        except HttpError as err:
+            if not is_not_found_error(err):
+                raise
+            logger.warning(f'folder {folder_id} for {folder_list} not found, invalidating cache')
+            self.folder_cache.invalidate_path(folder_list, settings.DOC_ROOT_FOLDER_ID)
+            folder_id = self.get_or_create_folder(folder_list)
+            if not folder_id:
+                raise ValueError(f'failed to create folder {folder_list}')
+            return fn(folder_id)
+
+    def create_doc(self, title, username, direct_folder, mode=None):
         """
         根据username 和 direct_folder在指定位置新建一个文件名为title新文件
 
         :param title: 目标文件文件名
         :param username: user name
         :param direct_folder: 目标文件的直接父文件夹名称
+        :param mode: DocCreateMode，默认取settings.DOC_CREATE_MODE
+        :return: 生成文件file id，生成文件link
+        """
+        mode = DocCreateMode(settings.DOC_CREATE_MODE if mode is None else mode)
+        folder_list = [username, direct_folder]
+        if mode == DocCreateMode.DOCS_COPY:
+            return self._create_doc_by_copy(title, folder_list)
+
+        def create_in_folder(folder_id):
+            # 直接在目标目录下创建google doc，同一个响应中返回webViewLink
+            body = {
+                'name': title,
+                'mimeType': DOCUMENT_MIME_TYPE,
+                'parents': [folder_id]
+            }
+            return self._execute(self.drive_service.files().create(body=body, fields='id,webViewLink'))
+
+        file = self._call_in_folder(folder_list, create_in_folder)
+        logger.info(f'create_doc: created {title} under {folder_list}, response is {payload(file)}')
+        return file.get('id'), file.get('webViewLink')
+
+    def _create_doc_by_copy(self, title, folder_list):
+        """
+        旧的创建方式：先用docs api在默认位置创建文档并打上TEMP_DOC_APP_PROPERTY标记，copy到目标目录后删除原文档
+
+        :param title: 目标文件文件名
+        :param folder_list: 目标目录名称列表
         :return: 生成文件file id，生成文件link
         """
         doc_id = None
         try:
-            folder_id = self.get_or_create_folder([username, direct_folder])
-            if not folder_id:
-                raise ValueError(f'failed to create folder {username} for doc {title}')
-
-            document = self.doc_service.documents().create(body={'title': title}).execute()
-            logger.info(f'create_doc: first request for creating title {title}, response is {document}')
+            document = self._execute(self.doc_service.documents().create(body={'title': title}))
+            logger.info(f'create_doc: first request for creating title {title}, response is {payload(document)}')
             doc_id = document.get('documentId')
             if not doc_id:
                 logger.error('creat the document failed')
                 return None
-
-            # copy到对应google drive目录下
-            body = {
-                'name': title,
-                'parents': [folder_id]
-            }
-            drive_response = self.drive_service.files().copy(fileId=doc_id, body=body).execute()
+            # docs api创建时不能设置appProperties，另外打上临时文档的标记，未能删除时由sweep_orphan_docs清理
+            key, value = TEMP_DOC_APP_PROPERTY
+            self._execute(self.drive_service.files().update(fileId=doc_id, body={'appProperties': {key: value}},
+                                                            fields='id'))
+
+            # copy到对应google drive目录下，拷贝出的文档不带临时文档的标记
+            def copy_to_folder(folder_id):
+                body = {
+                    'name': title,
+                    'parents': [folder_id],
+                    'appProperties': {key: None}
+                }
+                return self._execute(self.drive_service.files().copy(fileId=doc_id, body=body))
+
+            drive_response = self._call_in_folder(folder_list, copy_to_folder)
             document_copy_id = drive_response.get('id')
             return document_copy_id, self._get_webvie_link(document_copy_id)
         finally:
-            # 删除第一个出现在默认位置的文档
+            # 删除第一个出现在默认位置的文档；放入删除队列时由后台线程批量删除，不占用请求时间
             try:
-                if doc_id:
-                    self.drive_service.files().delete(fileId=doc_id).execute()
+                if doc_id and settings.DELETE_QUEUE_ENABLED:
+                    self.delete_queue.put(doc_id)
+                elif doc_id:
+                    self._execute(self.drive_service.files().delete(fileId=doc_id))
                     logger.info(f'File with ID {doc_id} has been deleted successfully.')
             except Exception as e:
                 logger.exception(f'An error occurred while deleting the file id {doc_id}: {e}')
 
-    def get_parent_folders(self, file_id):
+    def _execute(self, request):
+        """
+        通过executor执行单个google api请求
+
+        :param request: googleapiclient HttpRequest
+        :return: 响应内容
+        """
+        return self.executor.execute(request)
+
+    def execute_batch(self, service, requests):
+        """
+        把多个请求按settings.GOOGLE_BATCH_SIZE分批，通过google batch http请求发送，子请求被限流时退避后重试
+
+        :param service: 发起请求的service，如self.drive_service
+        :param requests: [(key, HttpRequest)]，key在本次调用中唯一
+        :return: {key: 响应内容或异常}
+        """
+        return self.executor.execute_batch(service, requests)
+
+    def create_docs(self, items):
+        """
+        批量创建文档：每个不同的目录只解析一次，创建请求通过batch http请求发送
+
+        :param items: [{'title': 文件名, 'username': user name, 'folder': 直接父文件夹名称}]
+        :return: 与items顺序一致的列表，每项为(生成文件file id, 生成文件link)或该项失败的异常
+        """
+        results = [None] * len(items)
+        folder_lists = [[item['username'], item['folder']] for item in items]
+        pending = list(range(len(items)))
+        for attempt in range(2):
+            folder_ids = {}
+            for folder_list in {tuple(folder_lists[i]) for i in pending}:
+                try:
+                    folder_ids[folder_list] = self.get_or_create_folder(list(folder_list))
+                    if not folder_ids[folder_list]:
+                        raise ValueError(f'failed to create folder {list(folder_list)}')
+                except Exception as e:
+                    logger.exception(f'create_docs: failed to resolve folder {list(folder_list)}: {e}')
+                    folder_ids[folder_list] = e
+
+            requests = []
+            for i in pending:
+                folder_id = folder_ids[tuple(folder_lists[i])]
+                if isinstance(folder_id, Exception):
+                    results[i] = folder_id
+                    continue
+                body = {
+                    'name': items[i]['title'],
+                    'mimeType': DOCUMENT_MIME_TYPE,
+                    'parents': [folder_id]
+                }
+                requests.append((i, self.drive_service.files().create(body=body, fields='id,webViewLink')))
+            for i, response in self.execute_batch(self.drive_service, requests).items():
+                results[i] = response if isinstance(response, Exception) else (response.get('id'),
+                                                                               response.get('webViewLink'))
+
+            # 缓存的目录已被删除时，清除缓存后对这些文档重试一次
+            pending = [i for i, _ in requests if is_not_found_error(results[i])]
+            if not pending or attempt:
+                break
+            for folder_list in {tuple(folder_lists[i]) for i in pending}:
+                logger.warning(f'create_docs: folder for {list(folder_list)} not found, invalidating cache')
+                self.folder_cache.invalidate_path(list(folder_list), settings.DOC_ROOT_FOLDER_ID)
+
+        failed = sum(isinstance(result, Exception) for result in results)
+        logger.info(f'create_docs: created {len(items) - failed} docs, {failed} failed')
+        return results
+
+    def create_blank_docs(self, folder_id, count, title='Untitled document'):
+        """
+        通过batch http请求在指定目录下创建多个空白文档
+
+        :param folder_id: 目标目录
+        :param count: 文档数量
+        :param title: 文档名
+        :return: 成功创建的file id列表
+        """
+        requests = []
+        for i in range(count):
+            body = {
+                'name': title,
+                'mimeType': DOCUMENT_MIME_TYPE,
+                'parents': [folder_id]
+            }
+            requests.append((i, self.drive_service.files().create(body=body, fields='id')))
+        results = self.execute_batch(self.drive_service, requests)
+        return [results[i]['id'] for i in range(count) if not isinstance(results.get(i), Exception) and results[i]]
+
+    def create_folders(self, items):
+        """
+        通过batch http请求创建多个目录，不检查是否已存在，创建成功的写入folder cache
+
+        :param items: [(parent folder id, folder name)]，不能重复
+        :return: {(parent folder id, folder name): 新目录的folder id或该项失败的异常}
+        """
+        requests = []
+        for parent_id, folder_name in items:
+            body = {
+                'name': folder_name,
+                'mimeType': FOLDER_MIME_TYPE,
+                'parents': [parent_id]
+            }
+            requests.append(((parent_id, folder_name), self.drive_service.files().create(body=body, fields='id')))
+        results = {}
+        for key, response in self.execute_batch(self.drive_service, requests).items():
+            if not isinstance(response, Exception) and not response.get('id'):
+                response = ValueError(f'failed to create folder {key[1]} under {key[0]}')
+            results[key] = response if isinstance(response, Exception) else response['id']
+        self.folder_cache.set_many([(parent_id, folder_name, folder_id)
+                                    for (parent_id, folder_name), folder_id in results.items()
+                                    if not isinstance(folder_id, Exception)])
+        return results
+
+    def move_doc(self, doc_id, title, from_folder_id, to_folder_id):
+        """
+        一次files().update把文档改名并从from_folder_id移动到to_folder_id
+
+        :param doc_id: 文档file id
+        :param title: 新文件名
+        :param from_folder_id: 原父目录
+        :param to_folder_id: 目标父目录
+        :return: file id，文件link
+        """
+        file = self._execute(self.drive_service.files().update(
+            fileId=doc_id, addParents=to_folder_id, removeParents=from_folder_id, body={'name': title},
+            fields='id,webViewLink'))
+        return file.get('id'), file.get('webViewLink')
+
+    def resolve_copy_targets(self, source_file_id, copies):
+        """
+        为批量拷贝解析每份拷贝的目标目录：指定了username和folder的放到对应目录下，否则放到源文件所在目录；
+        源文件父目录和每个不同的目标目录都只查询一次
+
+        :param source_file_id: 源文件
+        :param copies: [{'title': 新文件名, 'username': 可选, 'folder': 可选}]
+        :return: 与copies顺序一致的列表，每项为目标folder id或该项失败的异常
+        """
+        folder_ids = {}
+
+        def resolve(folder_list):
+            key = tuple(folder_list)
+            if key not in folder_ids:
+                try:
+                    if folder_list:
+                        folder_id = self.get_or_create_folder(folder_list)
+                    else:
+                        parents = self.get_parent_folders(source_file_id)
+                        folder_id = parents[0] if parents else None
+                    if not folder_id:
+                        raise ValueError(f'failed to find target folder {folder_list} for {source_file_id}')
+                    folder_ids[key] = folder_id
+                except Exception as e:
+                    logger.exception(f'resolve_copy_targets: {e}')
+                    folder_ids[key] = e
+            return folder_ids[key]
+
+        return [resolve([copy['username'], copy['folder']] if copy.get('username') else []) for copy in copies]
+
+    def copy_to_folders(self, source_file_id, targets):
+        """
+        通过一个batch http请求把源文件拷贝到多个目录
+
+        :param source_file_id: 源文件
+        :param targets: [(key, 新文件名, 目标folder id)]
+        :return: {key: (生成文件file id, 生成文件link)或该项失败的异常}
+        """
+        requests = []
+        for key, title, folder_id in targets:
+            body = {
+                'name': title,
+                'parents': [folder_id]
+            }
+            requests.append((key, self.drive_service.files().copy(
+                fileId=source_file_id, body=body, fields='id,webViewLink,parents')))
+        return {key: response if isinstance(response, Exception) else (response.get('id'),
+                                                                       response.get('webViewLink'))
+                for key, response in self.execute_batch(self.drive_service, requests).items()}
+
+    def get_parent_folders(self, file_id, use_cache=True):
         """
         获得google doc指定文件（夹）的父文件夹列表file id 列表
 
         :param file_id:
+        :param use_cache: 是否优先使用parent cache中的结果
         :return: 文件夹列表file id 列表
         """
-        file = self.drive_service.files().get(fileId=file_id, fields='parents').execute()
+        if use_cache:
+            parents = self.parent_cache.get(file_id)
+            if parents:
+                return parents
+        file = self._execute(self.drive_service.files().get(fileId=file_id, fields='parents'))
         parents = file.get('parents')
+        if parents:
+            self.parent_cache.set(file_id, parents)
         return parents
 
     def make_copy(self, source_file_id, new_tile):
         """
         在同文件夹对指定文件做一份拷贝，文件名为new_tile
+        源文件的父目录会被缓存，热门模板的拷贝只需要一次drive调用
 
         :param source_file_id: 源文件
         :param new_tile: 新文件名
         :return: 生成文件file id，生成文件link
         """
+        cached = self.parent_cache.get(source_file_id) is not None
+        try:
+            drive_response = self._copy_to_parent(source_file_id, new_tile)
+        except HttpError as err:
+            if not (cached and is_not_found_error(err)):
+                raise
+            # 缓存的父目录可能已被删除或移动，重新查询后再试一次
+            logger.warning(f'make_copy: cached parents of {source_file_id} are stale, retrying')
+            self.parent_cache.delete(source_file_id)
+            drive_response = self._copy_to_parent(source_file_id, new_tile)
+        return drive_response.get('id'), drive_response.get('webViewLink')
+
+    def _copy_to_parent(self, source_file_id, new_tile):
+        """
+        把源文件拷贝到其第一个父目录下，同一个响应中返回id、webViewLink和parents
+
+        :param source_file_id: 源文件
+        :param new_tile: 新文件名
+        :return: drive files().copy的响应
+        """
         folder_id = None
         parents = self.get_parent_folders(source_file_id)
         if parents:
@@ -346,9 +641,8 @@ class GoogleDocOperator(object):
             'name': new_tile,
             'parents': [folder_id]
         }
-        drive_response = self.drive_service.files().copy(fileId=source_file_id, body=body).execute()
-        document_copy_id = drive_response.get('id')
-        return document_copy_id, self._get_webvie_link(document_copy_id)
+        return self._execute(self.drive_service.files().copy(
+            fileId=source_file_id, body=body, fields='id,webViewLink,parents'))
 
     def get_doc(self, doc_id):
         """
@@ -360,44 +654,184 @@ class GoogleDocOperator(object):
         'namedStyles': .., 'revisionId': 'ANeT5PQ1_xnZmnAbW2MeoOK8ldgtpps2xvoFpvez8qpeGsbb2jTMNzzQrAz4pfb9iu',
         'suggestionsViewMode': 'SUGGESTIONS_INLINE', 'documentId': '1IUDZmR0P9Z0AdWTnZnL12kJrMHMVl7pA1bU6p2gkeCU'}
         """
-        document = self.doc_service.documents().get(documentId=doc_id).execute()
+        document = self._execute(self.doc_service.documents().get(documentId=doc_id))
         return document
 
-    def get_or_create_folder(self, folder_list, parent_folder_id=settings.DOC_ROOT_FOLDER_ID):
+    def get_doc_version(self, doc_id):
         """
-        在指定的parent folder下面查找指定名称的folder,没有则进行创建，返回目标folder的file id
-        假定parent folder下最多只有一个名称为folder_name的目录
+        一次很小的drive files().get，取得文档当前的version和modifiedTime
 
-        :param folder_list: 查找或创建的目录名称列表，从左至右目录层次由高到底
+        :param doc_id: doc id
+        :return: {'version': '12', 'modifiedTime': '2023-06-01T08:00:00.000Z'}
+        """
+        return self._execute(self.drive_service.files().get(fileId=doc_id, fields='version,modifiedTime'))
+
+    def get_cached_doc(self, doc_id):
+        """
+        返回doc的get结果，先用get_doc_version判断缓存是否仍然有效，文档未修改时不重新下载
+
+        :param doc_id: doc id
+        :return: common.doc_cache.DocEntry，body为序列化后的json bytes
+        """
+        version = self.get_doc_version(doc_id).get('version')
+        entry = self.doc_cache.get(doc_id, version)
+        if entry is None:
+            # 文档修改后大量轮询请求同时未命中时，只下载一次
+            entry = self.single_flight.do(('doc', doc_id, version),
+                                          lambda: self.doc_cache.set(doc_id, version, self.get_doc(doc_id)))
+        return entry
+
+    def get_changes_start_page_token(self):
+        """
+        :return: drive changes feed当前的startPageToken，之后的修改从这个token开始列出
+        """
+        return self._execute(self.drive_service.changes().getStartPageToken())['startPageToken']
+
+    def list_changes(self, page_token, page_size=None):
+        """
+        列出page_token之后drive上的一页修改
+
+        :param page_token: startPageToken或上一页的nextPageToken
+        :param page_size: 每页的修改数量，默认settings.DRIVE_CHANGES_PAGE_SIZE
+        :return: 形如：
+        {'changes': [{'fileId': '...', 'removed': False, 'file': {'id': '...', 'name': 'essay', 'mimeType': '...',
+        'parents': ['...'], 'trashed': False, 'version': '12'}}], 'nextPageToken': '...'}
+        最后一页没有nextPageToken，而是返回下次轮询使用的newStartPageToken
+        """
+        return self._execute(self.drive_service.changes().list(
+            pageToken=page_token,
+            pageSize=page_size or settings.DRIVE_CHANGES_PAGE_SIZE,
+            includeRemoved=True,
+            spaces='drive',
+            fields='nextPageToken,newStartPageToken,'
+                   'changes(fileId,removed,file(id,name,mimeType,parents,trashed,version))'))
+
+    def export_doc(self, doc_id, fmt, chunk_size=None):
+        """
+        通过drive files.export按Range分块下载导出的文档，每下载一块就返回，不在内存中保留整个文件；
+        每块是一次经过限流和重试的请求
+
+        :param doc_id: doc id
+        :param fmt: EXPORT_FORMATS中的格式
+        :param chunk_size: 每块的字节数，默认settings.EXPORT_CHUNK_SIZE
+        :return: bytes的生成器
+        """
+        buffer = io.BytesIO()
+        request = self.drive_service.files().export_media(fileId=doc_id, mimeType=EXPORT_FORMATS[fmt])
+        downloader = MediaIoBaseDownload(buffer, request, chunksize=chunk_size or settings.EXPORT_CHUNK_SIZE)
+        chunk_request = _DownloadChunkRequest(downloader, request.methodId)
+        done = False
+        while not done:
+            _, done = self._execute(chunk_request)
+            data = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            if data:
+                yield data
+
+    def iter_doc_blocks(self, doc_id):
+        """
+        按文档顺序逐个生成文档正文中的标题、段落、列表项和表格单元格，见common.doc_text.iter_doc_blocks
+
+        :param doc_id: doc id
+        :return: 文字块的生成器
+        """
+        return iter_doc_blocks(json.loads(self.get_cached_doc(doc_id).body))
+
+    def list_files(self, q, page_size=None, fields='id, name'):
+        """
+        列出符合q的文件，跟随nextPageToken翻页
+
+        :param q: drive查询条件
+        :param page_size: 每页的数量，默认由google决定(100)
+        :param fields: 每个文件返回的字段
+        :return: 文件的生成器，形如：{'id': '...', 'name': 'essay'}
+        """
+        page_token = None
+        while True:
+            response = self._execute(self.drive_service.files().list(
+                q=q, spaces='drive', pageSize=page_size, pageToken=page_token,
+                fields=f'nextPageToken, files({fields})'))
+            yield from response.get('files', [])
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return
+
+    def list_folders(self, q, page_size=None, fields='id, name'):
+        """
+        列出符合q的未删除目录，见list_files
+
+        :param q: drive查询条件，与目录类型、未删除的条件做and
+        """
+        return self.list_files(f"mimeType='{FOLDER_MIME_TYPE}' and trashed=false and {q}", page_size, fields)
+
+    def delete_files(self, file_ids):
+        """
+        通过batch http请求删除多个文件，已不存在(404)的视为删除成功
+
+        :param file_ids: file id列表
+        :return: {file id: 删除失败的异常}，全部成功时为空
+        """
+        requests = [(file_id, self.drive_service.files().delete(fileId=file_id)) for file_id in dict.fromkeys(file_ids)]
+        return {file_id: response for file_id, response in self.execute_batch(self.drive_service, requests).items()
+                if isinstance(response, Exception) and not is_not_found_error(response)}
+
+    def _get_or_create_single_folder(self, folder_name, parent_folder_id):
+        """
+        查找或创建parent folder下的单层目录，持有跨进程的数据库锁，避免多个worker重复创建同名目录
+
+        :param folder_name: 目录名称
         :param parent_folder_id: 直接父目录
         :return: 目标folder的file id
         """
-        if len(folder_list) == 1:
-            folder_name = folder_list[0]
-            print('aaaa')
-            print(parent_folder_id)
-            # 假设只有一个符合结果，目前
-            response = self.drive_service.files().list(
-                q=f"mimeType='application/vnd.google-apps.folder' and name='{folder_name}' and "
-                  f"'{parent_folder_id}' in parents", spaces='drive', fields='files(id, name)').execute()
-            if response.get('files'):
-                return response['files'][0]['id']
+        with folder_lock(parent_folder_id, folder_name):
+            # 等锁期间其他进程可能已完成创建
+            cached_folder_id = self.folder_cache.get(parent_folder_id, folder_name)
+            if cached_folder_id:
+                return cached_folder_id
+
+            # 假设只有一个符合结果，目前；drive可能返回空页和nextPageToken，需要翻页直到找到
+            for folder in self.list_folders(f"name='{folder_name}' and '{parent_folder_id}' in parents"):
+                result = folder['id']
+                self.folder_cache.set(parent_folder_id, folder_name, result)
+                return result
 
             logger.info(f'no folder named {folder_name} under file ID {parent_folder_id}， creating...')
             file_metadata = {
                 'name': folder_name,
-                'mimeType': 'application/vnd.google-apps.folder',
+                'mimeType': FOLDER_MIME_TYPE,
                 'parents': [parent_folder_id]
             }
 
-            file = self.drive_service.files().create(body=file_metadata, fields='id').execute()
+            file = self._execute(self.drive_service.files().create(body=file_metadata, fields='id'))
             result = file.get('id')
             if result:
                 logger.info(f'created {folder_name} under folder with file id {parent_folder_id}, '
                             f'target folder id: {result}')
+                self.folder_cache.set(parent_folder_id, folder_name, result)
             else:
                 logger.info(f'failed to create {folder_name} under folder with file id {parent_folder_id}')
             return result
+
+    def get_or_create_folder(self, folder_list, parent_folder_id=settings.DOC_ROOT_FOLDER_ID):
+        """
+        在指定的parent folder下面查找指定名称的folder,没有则进行创建，返回目标folder的file id
+        假定parent folder下最多只有一个名称为folder_name的目录
+        每层目录的查找结果都会写入folder cache，整条路径都命中缓存时不需要访问google drive
+
+        :param folder_list: 查找或创建的目录名称列表，从左至右目录层次由高到底
+        :param parent_folder_id: 直接父目录
+        :return: 目标folder的file id
+        """
+        if len(folder_list) == 1:
+            folder_name = folder_list[0]
+            cached_folder_id = self.folder_cache.get(parent_folder_id, folder_name)
+            if cached_folder_id:
+                return cached_folder_id
+
+            # 同一进程内同一目录只由一个线程查找/创建，其余线程等待其结果
+            return self.single_flight.do((parent_folder_id, folder_name), self._get_or_create_single_folder,
+                                         folder_name, parent_folder_id)
         else:
             current_folder_id = parent_folder_id
             for folder_name in folder_list:
@@ -408,6 +842,109 @@ class GoogleDocOperator(object):
             return current_folder_id
 
 
+class _DownloadChunkRequest(object):
+    """
+    把MediaIoBaseDownload的一次next_chunk包装成可由GoogleApiExecutor执行的请求
+    """
+
+    def __init__(self, downloader, method_id):
+        self.downloader = downloader
+        self.methodId = method_id
+
+    def execute(self):
+        # 失败时downloader的进度不变，executor重试时重新请求同一块
+        return self.downloader.next_chunk()
+
+
+def is_not_found_error(err):
+    """
+    判断google api异常是否为404，例如缓存的folder id在google drive上已被删除
+
+    :param err: Exception
+    :return: bool
+    """
+    return isinstance(err, HttpError) and getattr(err.resp, 'status', None) == 404
+
+
+def folder_lock(parent_folder_id, folder_name):
+    """
+    查找或创建parent folder下名为folder_name的目录时持有的跨进程数据库锁，FOLDER_DB_LOCK_ENABLED为False时不加锁
+
+    :return: context manager
+    """
+    if not settings.FOLDER_DB_LOCK_ENABLED:
+        return nullcontext()
+    return db_lock(f'folder:{parent_folder_id}/{folder_name}')
+
+
+def load_credentials(auth_type=GoogleAuthType.SERVICE_ACCOUNT_KEY):
+    """
+    按认证方式加载google api凭证
+
+    :param auth_type: GoogleAuthType
+    :return: google auth credentials
+    """
+    creds = None
+    if auth_type == GoogleAuthType.DESKTOP_OAUTH2:
+        # 桌面的OAUTH2认证,
+        # The file token.json stores the user's access and refresh tokens, and is
+        # created automatically when the authorization flow completes for the first
+        # time.
+        if os.path.exists(settings.GOOGLE_PROJECT_TOKEN_FILE):
+            creds = Credentials.from_authorized_user_file(settings.GOOGLE_PROJECT_TOKEN_FILE,
+                                                          GoogleDocOperator.SCOPES)
+        # If there are no (valid) credentials available, let the user log in.
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    settings.GOOGLE_PROJECT_CREDENTIALS_FILE, GoogleDocOperator.SCOPES)
+                creds = flow.run_local_server(port=0)
+            # Save the credentials for the next run
+            with open(settings.GOOGLE_PROJECT_TOKEN_FILE, 'w') as token:
+                token.write(creds.to_json())
+    elif auth_type == GoogleAuthType.SERVICE_ACCOUNT_KEY:
+        # web server的 service account认证
+        # 获取访问凭证
+        creds = service_account.Credentials.from_service_account_file(
+            settings.GOOGLE_SERVICE_ACCOUNT_CREDENTIALS_FILE, scopes=GoogleDocOperator.SCOPES)
+        # access token保存在共享缓存中，所有worker进程共用，新建的凭证不需要重新交换token
+        creds = wrap_shared_token(creds)
+    return creds
+
+
+@lru_cache(maxsize=None)
+def get_discovery_document(service_name, version):
+    """
+    读取google-api-python-client自带的静态discovery文档，每个进程只解析一次
+
+    :param service_name: e.g. drive
+    :param version: e.g. v3
+    :return: 解析后的discovery文档
+    """
+    content = get_static_doc(service_name, version)
+    if content is None:
+        raise ValueError(f'no bundled discovery document for {service_name} {version}')
+    return json.loads(content)
+
+
+def build_service(service_name, version, http):
+    """
+    使用静态discovery文档构建google api service，避免build()每次重新加载和解析discovery文档
+
+    :param service_name: e.g. drive
+    :param version: e.g. v3
+    :param http: 已带认证的http对象，见common.transport.build_http
+    :return: googleapiclient Resource
+    """
+    document = get_discovery_document(service_name, version)
+    if settings.GOOGLE_API_ROOT_URL:
+        # 指向本地的google api替身服务(见benchmarks/fake_google.py)，batch请求的地址也由rootUrl生成
+        document = dict(document, rootUrl=settings.GOOGLE_API_ROOT_URL, mtlsRootUrl=settings.GOOGLE_API_ROOT_URL)
+    return build_from_document(document, http=http)
+
+
 if __name__ == '__main__':
     operator = GoogleDocOperator(GoogleAuthType.SERVICE_ACCOUNT_KEY)
     # print(operator.get_or_create_folder(['aaaa', 'bbb']))
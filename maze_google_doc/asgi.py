@@ -4,13 +4,18 @@ ASGI config for maze_google_doc project.
 It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
-https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 """
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'maze_google_doc.settings')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+from apps.google_doc.async_views import AsyncViewsASGIHandler  # noqa: E402
+
+# 与django.core.asgi.get_asgi_application()相同，new_doc、copy_doc由asyncio的view处理，见apps.google_doc.async_views
+application = AsyncViewsASGIHandler()
@@ -0,0 +1,14 @@
+"""
+ASGI部署时使用的URL Configuration，见apps.google_doc.async_views.AsyncViewsASGIHandler
+
+new_doc、copy_doc指向asyncio的view(不满足条件的请求仍交给同步的view)，其余与maze_google_doc.urls相同
+"""
+from django.conf.urls import url
+
+from apps.google_doc import async_views
+from maze_google_doc.urls import urlpatterns as wsgi_urlpatterns
+
+urlpatterns = [
+    url(r'^api/v1/new_doc/?$', async_views.new_doc),
+    url(r'^api/v1/copy_doc/?$', async_views.copy_doc),
+] + wsgi_urlpatterns
@@ -46,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'common.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -83,9 +84,13 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # 测试中有多线程/协程并发写入，内存中的sqlite会直接报table is locked，测试数据库使用文件以便等待锁
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')},
     }
 }
 
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -106,6 +111,26 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+# google_doc 缓存需要被所有worker共享，默认使用数据库缓存(需先执行 python manage.py createcachetable)，
+# 也可以在settings_local.py中换成memcached/redis等后端
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'google_doc': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'google_doc_cache',
+        'TIMEOUT': 24 * 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.0/topics/i18n/
 
@@ -217,10 +242,24 @@ LOGGING = {
     }
 }
 
+# 日志由各logger的DroppingQueueHandler放入有界队列，后台线程写文件和stdout，请求线程不等待日志io；
+# 队列满时按DROP_POLICY('drop_new'/'drop_oldest')丢弃并计数，KEEP_LEVEL及以上的日志先最多等待BLOCK_TIMEOUT秒
+LOGGING_CONFIG = 'common.log_queue.configure_logging'
+LOG_QUEUE_ENABLED = True
+LOG_QUEUE_MAXSIZE = 10000
+LOG_QUEUE_DROP_POLICY = 'drop_new'
+LOG_QUEUE_KEEP_LEVEL = 'ERROR'
+LOG_QUEUE_BLOCK_TIMEOUT = 1
+# 文件日志输出为每行一个json
+LOG_JSON = False
+# 单条日志消息(不含异常栈)的最大字符数；请求参数、google响应等内容以LOG_PAYLOAD_MAX_LENGTH截断后记录
+LOG_MESSAGE_MAX_LENGTH = 64 * 1024
+LOG_PAYLOAD_MAX_LENGTH = 2000
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'common.authentication.CachedTokenAuthentication',
     ),
 
     'DEFAULT_FILTER_BACKENDS': ('django_filters.rest_framework.DjangoFilterBackend',),
@@ -234,6 +273,10 @@ REST_FRAMEWORK = {
 
 # 接口错误
 UNKNOWN_ERROR_RESP_PROMPT = 'an error occurred on the server'
+RATE_LIMITED_RESP_PROMPT = 'too many requests to google api, please retry later'
+IN_PROGRESS_RESP_PROMPT = 'a request with the same Idempotency-Key is in progress, please retry later'
+# 同一Idempotency-Key的请求仍在处理中时，响应头Retry-After建议的等待时间(秒)
+IDEMPOTENCY_RETRY_AFTER = 5
 
 GOOGLE_PROJECT_CREDENTIALS_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "resources",
                                                "credentials.json")
@@ -242,6 +285,136 @@ GOOGLE_PROJECT_TOKEN_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path
 GOOGLE_SERVICE_ACCOUNT_CREDENTIALS_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
                                                        "resources", "service-account-credentials.json")
 DOC_ROOT_FOLDER_ID = '1LGjQ4TNHkl7yPd4_rvBoXvN_6N1sWxJv'
+# new_doc创建文档的方式: 'drive' 一次drive files().create直接在目标目录下创建;
+# 'copy' 旧方式，docs api创建(并打上临时文档的appProperties标记)后copy到目标目录再删除原文档
+DOC_CREATE_MODE = 'drive'
+# 一个google batch http请求中包含的最大请求数(drive api限制为100)
+GOOGLE_BATCH_SIZE = 100
+# 批量创建接口一次最多接受的文档数量
+BULK_NEW_DOC_MAX_ITEMS = 1000
+# 批量拷贝接口一次最多接受的拷贝数量、每个batch请求中的拷贝数量以及并发的batch请求数
+BULK_COPY_DOC_MAX_ITEMS = 1000
+BULK_COPY_DOC_BATCH_SIZE = 10
+BULK_COPY_DOC_MAX_WORKERS = 4
+# 导出接口每次从drive下载的字节数(Range请求)；批量导出一次最多接受的文档数、并发下载数，
+# 每个已下载未写入zip的文档在内存中最多保留SPOOL_MAX_BYTES字节，超过的部分写入临时文件
+EXPORT_CHUNK_SIZE = 1024 * 1024
+BULK_EXPORT_MAX_ITEMS = 500
+BULK_EXPORT_MAX_WORKERS = 4
+BULK_EXPORT_SPOOL_MAX_BYTES = 4 * 1024 * 1024
+# new_doc的暂存空白文档池：开启后new_doc优先领取DOC_ROOT_FOLDER_ID下WARM_POOL_FOLDER_NAME目录中预先创建的文档，
+# 改名并移动到用户目录；低于low water时后台补充到high water，也可用 python manage.py refill_warm_pool --loop 补充
+WARM_POOL_ENABLED = False
+WARM_POOL_FOLDER_NAME = '_warm_pool'
+WARM_POOL_HIGH_WATER = 50
+WARM_POOL_LOW_WATER = 20
+# 领取后超过该时间(秒)仍未移动或放回的暂存文档(如领取的进程崩溃)，补充时仍在暂存目录的放回暂存池；
+# web进程也至少每隔该时间触发一次后台补充
+WARM_POOL_CLAIM_LEASE = 600
+# 异步任务(new_doc/copy_doc的async=1模式)的worker运行方式: 'in_process' 在web进程内启动worker线程;
+# 'command' 由 python manage.py run_job_worker 单独运行
+JOB_WORKER_MODE = 'in_process'
+# worker线程数、无任务时的轮询间隔(秒)、任务lease时间(秒)和最大尝试次数
+JOB_WORKER_CONCURRENCY = 4
+JOB_POLL_INTERVAL = 1
+JOB_LEASE_SECONDS = 300
+JOB_MAX_ATTEMPTS = 3
+# googleapiclient使用的http transport: 'requests' 基于AuthorizedSession，进程内所有operator共用keep-alive连接池;
+# 'httplib2' 旧方式，每个operator各自的httplib2连接
+GOOGLE_HTTP_TRANSPORT = 'requests'
+# 进程共享连接池的最大连接数，建议不小于gunicorn每个worker的线程数
+GOOGLE_HTTP_POOL_MAXSIZE = 16
+GOOGLE_HTTP_TIMEOUT = 60
+# 校验google api服务端证书的CA文件，为空时使用默认CA；本地https替身服务测试时使用
+GOOGLE_HTTP_CA_CERTS = None
+# google api的rootUrl，为空时使用discovery文档中的地址；本地测试时可指向benchmarks/fake_google.py启动的替身服务
+GOOGLE_API_ROOT_URL = None
+# ASGI部署(maze_google_doc.asgi)时new_doc、copy_doc由asyncio的view处理(使用asgi_urls)，等待google api时不占用线程
+ASYNC_VIEWS_ENABLED = True
+# asyncio http客户端(httpx)的最大并发连接数(即同时进行中的google api请求数)，以及保留的空闲keep-alive连接数
+GOOGLE_ASYNC_HTTP_MAX_CONNECTIONS = 1000
+GOOGLE_ASYNC_HTTP_MAX_IDLE = 500
+# google api限流：drive和docs各一个所有worker进程共享的令牌桶(状态保存在数据库中)，RATE为每秒令牌数，BURST为桶容量
+GOOGLE_RATE_LIMIT_ENABLED = True
+GOOGLE_DRIVE_RATE = 10
+GOOGLE_DRIVE_BURST = 20
+GOOGLE_DOCS_RATE = 5
+GOOGLE_DOCS_BURST = 10
+# 每个进程一次从共享令牌桶预取的令牌数，预取的令牌1秒内未用完即作废；为1时每次调用都访问数据库
+GOOGLE_RATE_LIMIT_LOCAL_RESERVE = 5
+# 在令牌桶中等待超过该时间(秒)的请求直接失败，避免web请求长时间挂起
+GOOGLE_RATE_LIMIT_MAX_WAIT = 10
+# 429、403 rateLimitExceeded/userRateLimitExceeded及5xx错误的最大重试次数，以及指数退避(带随机抖动)的基数和上限(秒)
+GOOGLE_RETRY_MAX_ATTEMPTS = 4
+GOOGLE_RETRY_BACKOFF_BASE = 0.5
+GOOGLE_RETRY_BACKOFF_MAX = 8
+# service account的access token保存在GOOGLE_TOKEN_CACHE_ALIAS对应的共享django cache中，所有worker进程共用
+GOOGLE_TOKEN_CACHE_ENABLED = True
+GOOGLE_TOKEN_CACHE_ALIAS = 'google_doc'
+# 每个进程的后台线程每INTERVAL秒检查一次，token在MARGIN秒内过期时由其中一个进程提前刷新
+GOOGLE_TOKEN_REFRESHER_ENABLED = True
+GOOGLE_TOKEN_REFRESH_INTERVAL = 60
+GOOGLE_TOKEN_REFRESH_MARGIN = 600
+# 缓存中没有可用token时，请求路径上等待其他进程刷新的最长时间(秒)，超时后自行刷新
+GOOGLE_TOKEN_REFRESH_LOCK_TIMEOUT = 10
+# 每个worker进程内GoogleDocOperator池保留的空闲operator数量
+GOOGLE_OPERATOR_POOL_SIZE = 8
+# (父目录id, 目录名) -> 目录id 缓存；共享层为FOLDER_CACHE_ALIAS对应的django cache，
+# 进程内LRU缓存的条目数或时间为0时不使用进程内缓存
+FOLDER_CACHE_ALIAS = 'google_doc'
+FOLDER_CACHE_TIMEOUT = 24 * 3600
+FOLDER_CACHE_LOCAL_MAXSIZE = 10000
+FOLDER_CACHE_LOCAL_TTL = 300
+# 目录缓存预热：python manage.py warm_folder_cache 按层遍历DOC_ROOT_FOLDER_ID下的整棵目录树写入目录缓存，
+# 每次查询合并PARENTS_PER_QUERY个父目录，每页PAGE_SIZE(drive上限1000)个目录；
+# WARM_ON_STARTUP开启后web进程处理第一个请求时在后台线程中预热(管理命令不预热)，WARM_INTERVAL秒内多个进程只有一个实际遍历
+FOLDER_INDEX_PAGE_SIZE = 1000
+FOLDER_INDEX_PARENTS_PER_QUERY = 50
+FOLDER_INDEX_WARM_ON_STARTUP = False
+FOLDER_INDEX_WARM_INTERVAL = 600
+# python manage.py provision_folders 按花名册批量预建目录时，并发发送batch请求的线程数
+ROSTER_PROVISION_CONCURRENCY = 4
+# create_doc旧方式(DOC_CREATE_MODE = 'copy')在默认位置创建的临时文档放入进程内的删除队列，
+# 由后台线程每FLUSH_INTERVAL秒通过batch请求删除，不在请求中同步删除；关闭时在请求中同步删除
+DELETE_QUEUE_ENABLED = True
+DELETE_QUEUE_MAXSIZE = 10000
+DELETE_QUEUE_FLUSH_INTERVAL = 1
+# python manage.py sweep_orphan_docs 删除根目录下创建超过MIN_AGE秒的临时文档，--loop时每INTERVAL秒执行一次
+ORPHAN_SWEEP_MIN_AGE = 3600
+ORPHAN_SWEEP_INTERVAL = 600
+# 进程内 文件id -> 父目录列表 缓存(make_copy的模板文档)的最大条目数和缓存时间(秒)
+PARENT_CACHE_MAXSIZE = 2000
+PARENT_CACHE_TTL = 600
+# 每个进程内get_doc结果缓存的json总字节数上限，以及单个文档的字节数上限(超过的不缓存)
+DOC_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DOC_CACHE_MAX_DOC_BYTES = 8 * 1024 * 1024
+# 根据drive changes feed增量失效缓存：python manage.py poll_drive_changes --loop 轮询DOC_ROOT_FOLDER_ID下的修改，
+# 删除被改名、移动、删除的目录和文档的缓存；开启后各worker进程每SYNC_INTERVAL秒同步一次其他进程的进程内缓存失效通知
+DRIVE_CHANGES_ENABLED = False
+DRIVE_CHANGES_POLL_INTERVAL = 10
+DRIVE_CHANGES_PAGE_SIZE = 1000
+DRIVE_CHANGES_SYNC_INTERVAL = 5
+# 失效通知的保留时间(秒)
+DRIVE_CHANGES_RETENTION = 3600
+# api token认证缓存：token -> 用户 缓存在每个进程内(LRU，MAXSIZE条，TTL秒)，命中时不查询数据库；
+# token被删除或用户被修改(停用)时通过signal失效，其他进程的进程内缓存最多TTL秒后失效。
+# ALIAS为共享层使用的django cache别名(建议memcached/redis，数据库缓存并不比直接查询token更快)，为空时不使用共享层
+AUTH_TOKEN_CACHE_ENABLED = True
+AUTH_TOKEN_CACHE_MAXSIZE = 10000
+AUTH_TOKEN_CACHE_TTL = 60
+AUTH_TOKEN_CACHE_ALIAS = None
+AUTH_TOKEN_CACHE_SHARED_TIMEOUT = 300
+# 进程内的google api调用和请求耗时指标，由 /metrics 以prometheus text格式输出；多进程部署时每个worker各自统计
+METRICS_ENABLED = True
+# 直方图各桶的上界(秒)
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# 响应头Server-Timing中给出本次请求google api调用的耗时分解
+METRICS_SERVER_TIMING_ENABLED = True
+# 创建目录时是否使用跨进程的数据库锁，避免并发请求创建出同名目录
+FOLDER_DB_LOCK_ENABLED = True
+# 数据库锁的等待超时和有效期(秒)
+DB_LOCK_TIMEOUT = 30
+DB_LOCK_LEASE = 60
 
 try:
     from .settings_local import *  # noqa
@@ -18,12 +18,21 @@ from django.contrib import admin
 from django.urls import path
 from rest_framework.authtoken.views import ObtainAuthToken
 
-from apps.google_doc.views import NewDocView, CopyDocView
+from apps.google_doc.views import NewDocView, CopyDocView, BulkNewDocView, BulkCopyDocView, DocView, DocTextView, \
+    DocExportView, BulkDocExportView, JobView, MetricsView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     url(r'^api/v1/new_doc/?$', NewDocView.as_view()),
+    url(r'^api/v1/new_docs/?$', BulkNewDocView.as_view()),
     url(r'^api/v1/copy_doc/?$', CopyDocView.as_view()),
+    url(r'^api/v1/copy_doc/bulk/?$', BulkCopyDocView.as_view()),
+    url(r'^api/v1/doc/export/bulk/?$', BulkDocExportView.as_view()),
+    url(r'^api/v1/doc/(?P<doc_id>[\w-]+)/?$', DocView.as_view()),
+    url(r'^api/v1/doc/(?P<doc_id>[\w-]+)/text/?$', DocTextView.as_view()),
+    url(r'^api/v1/doc/(?P<doc_id>[\w-]+)/export/?$', DocExportView.as_view()),
+    url(r'^api/v1/jobs/(?P<job_id>\d+)/?$', JobView.as_view()),
+    url(r'^metrics/?$', MetricsView.as_view()),
     # curl -H "Content-Type: application/json" --request POST "http://127.0.0.1:8000/api/v1/login/"
     # -d '{"username": "xxx", "password": "xxx"}'
     # 返回形如 {"token":"28f26466c6e541e83b3597060961f25aeef182c3"}